@@ -12,7 +12,7 @@ from google.appengine.ext import ndb
 from flask import has_request_context, request
 
 from roger import auth, config, files, models, notifs, report, slack_api, streams, strings
-from roger import threads
+from roger import threads, timelines
 from roger_common import errors, identifiers, random, security
 
 
@@ -308,12 +308,19 @@ class AccountHandler(object):
         if blocked_account == self.account.key:
             raise errors.InvalidArgument('You cannot block yourself')
         models.Account.add_block(blocked_account, self.account.key)
+        if blocked_account not in self.account.blocked:
+            self.account.blocked.append(blocked_account)
         f1 = models.AccountFollow.unfollow_async(self.account.key, blocked_account)
         f2 = models.AccountFollow.unfollow_async(blocked_account, self.account.key)
         stream = self.streams.get([blocked_account])
         if stream:
             stream.hide()
-        ndb.Future.wait_all([f1, f2])
+        futures = [models.Account.clear_blocks_cache_async([blocked_account, self.account.key])]
+        if f1.get_result()[1]:
+            futures.append(timelines.on_unfollow_async(self.account.key, blocked_account))
+        if f2.get_result()[1]:
+            futures.append(timelines.on_unfollow_async(blocked_account, self.account.key))
+        ndb.Future.wait_all(futures)
 
     def change_identifier(self, old, new, notify_connect=True, primary=False):
         new, identifier_type = identifiers.parse(new)
@@ -564,6 +571,9 @@ class AccountHandler(object):
     def unblock(self, identifier):
         blocked_account = models.Account.resolve_key(identifier)
         models.Account.remove_block(blocked_account, self.account.key)
+        if blocked_account in self.account.blocked:
+            self.account.blocked.remove(blocked_account)
+        models.Account.clear_blocks_cache_async([blocked_account, self.account.key]).get_result()
 
     def update_demographics(self, birthday, gender):
         changed = False
@@ -4,7 +4,7 @@ import logging
 
 from flask import request
 
-from roger import config
+from roger import config, profiler
 from roger_common import errors, flask_extras
 
 
@@ -16,6 +16,8 @@ def enforce_https():
 def set_up(app, **kwargs):
     """Add standard header and error handlers to an API endpoint."""
     app.config['DEBUG'] = config.DEVELOPMENT
+    # Keep track of the RPCs made by every request.
+    profiler.install(app)
     if not config.DEVELOPMENT:
         # Do not allow any requests that are not via HTTPS.
         app.before_request(enforce_https)
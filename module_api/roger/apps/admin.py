@@ -18,8 +18,8 @@ from google.appengine.ext import ndb
 from flask import Flask, render_template, redirect, request
 import pytz
 
-from roger import accounts, bots, config, files, localize, location
-from roger import models, notifs, slack_api, streams, strings, threads
+from roger import accounts, bots, comments, config, files, localize, location
+from roger import models, notifs, profiler, slack_api, streams, strings, threads
 from roger.apps import utils
 from roger_common import bigquery_api, convert, errors, flask_extras, identifiers, random
 
@@ -2251,9 +2251,9 @@ def get_comments_json():
     content_id = int(request.args['content_id'])
     q = models.ContentComment.query(ancestor=ndb.Key('Content', content_id))
     q = q.order(-models.ContentComment.created)
-    comments = q.fetch()
-    lookup = {a.key: a for a in ndb.get_multi({c.creator for c in comments})}
-    data = [c.public(creator=lookup[c.creator], version=53) for c in comments]
+    comment_list = q.fetch()
+    lookup = {a.key: a for a in ndb.get_multi({c.creator for c in comment_list})}
+    data = [c.public(creator=lookup[c.creator], version=53) for c in comment_list]
     return convert.to_json({'data': data}, version=53)
 
 
@@ -2262,17 +2262,10 @@ def post_comments_json():
     content_id = int(request.args['content_id'])
     key = ndb.Key('Content', content_id,
                   'ContentComment', request.args['comment_id'])
-    key.delete()
-    futures = []
-    v = 51
-    c = ndb.get_context()
-    for x in xrange(3):
-        futures += [
-            c.memcache_delete('content_comments_%s_%d_created' % (v - x, content_id)),
-            c.memcache_delete('content_comments_%s_%d_offset' % (v - x, content_id)),
-            c.memcache_delete('content_comments_%s_%d_threaded' % (v - x, content_id)),
-        ]
-    ndb.Future.wait_all(futures)
+    comment = key.get()
+    if comment:
+        comments.delete_async(comment).get_result()
+    models.ContentComment.invalidate_cache_async(key.parent()).get_result()
     return convert.to_json({'success': True})
 
 
@@ -2287,14 +2280,24 @@ def get_decorate_content():
 @app.route('/admin/events.json', methods=['GET'])
 def get_events():
     account_key = ndb.Key('Account', int(request.args.get('account_id')))
-    q = models.AccountEvent.query(ancestor=account_key)
-    q = q.order(-models.AccountEvent.timestamp)
-    cursor = datastore_query.Cursor(urlsafe=request.args.get('cursor'))
-    events, next_cursor, more = q.fetch_page(200, start_cursor=cursor)
+    cursor_value = request.args.get('cursor') or ''
+    # Recent events are listed first, followed by the older compacted days.
+    if cursor_value.startswith('days:'):
+        q = models.AccountEventDay.query(ancestor=account_key)
+        q = q.order(-models.AccountEventDay.timestamp)
+        cursor = datastore_query.Cursor(urlsafe=cursor_value[5:])
+        events, next_cursor, more = q.fetch_page(7, start_cursor=cursor)
+        next_cursor_value = 'days:' + next_cursor.urlsafe() if more else None
+    else:
+        q = models.AccountEvent.query(ancestor=account_key)
+        q = q.order(-models.AccountEvent.timestamp)
+        cursor = datastore_query.Cursor(urlsafe=cursor_value)
+        events, next_cursor, more = q.fetch_page(200, start_cursor=cursor)
+        next_cursor_value = next_cursor.urlsafe() if more else 'days:'
     expanded_events = sorted(itertools.chain.from_iterable(e.items for e in events),
                              key=lambda i: i.timestamp, reverse=True)
     result = {
-        'cursor': next_cursor.urlsafe() if more else None,
+        'cursor': next_cursor_value,
         'data': expanded_events,
     }
     return convert.to_json(result)
@@ -2322,6 +2325,32 @@ def get_dashboard_users_json():
     return convert.to_json(data)
 
 
+@app.route('/admin/profiler.json', methods=['GET'])
+def get_profiler():
+    window = profiler.current_window()
+    if 'window' in request.args:
+        window = int(request.args['window'])
+    endpoints = []
+    for endpoint, stats in profiler.get_stats(window).iteritems():
+        requests = stats.get('requests') or 1
+        rpcs = {k: v for k, v in stats.iteritems() if k not in ('ms', 'requests')}
+        rpc_count = sum(v for k, v in rpcs.iteritems() if not k.endswith('_ms'))
+        endpoints.append({
+            'endpoint': endpoint,
+            'requests': stats.get('requests', 0),
+            'avg_ms': stats.get('ms', 0) / requests,
+            'rpcs_per_request': rpc_count / float(requests),
+            'rpcs': rpcs,
+        })
+    endpoints.sort(key=lambda e: e['rpcs_per_request'], reverse=True)
+    result = {
+        'endpoints': endpoints,
+        'slow_requests': profiler.get_slow_requests(),
+        'window': window,
+    }
+    return convert.to_json(result)
+
+
 @app.route('/admin/push-info.json', methods=['GET'])
 def get_push_info():
     account_key = ndb.Key('Account', int(request.args.get('account_id')))
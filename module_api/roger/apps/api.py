@@ -20,11 +20,10 @@ from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
 from flask import Flask, g, request
-import pytz
 
-from roger import accounts, apple, apps, auth, bots, config, external, files, localize
-from roger import models, notifs, push_service, ratelimit, report, services, slack_api
-from roger import streams, threads, youtube
+from roger import accounts, apple, apps, auth, bots, chat, comments, config, contacts
+from roger import external, files, localize, models, notifs, push_service, ratelimit, report
+from roger import services, slack_api, streams, threads, timelines, youtube
 from roger.apps import utils
 from roger_common import bigquery_api, convert, events, errors, flask_extras
 from roger_common import identifiers, random
@@ -54,101 +53,6 @@ LIMIT
 """
 
 
-QUERY_TOP_ACCOUNTS_FIRST = u"""
-SELECT
-  account_id,
-  COUNT(*) AS score
-FROM
-  roger_reporting.content_first_v1
-WHERE
-  timestamp >= TIMESTAMP("%s") AND
-  timestamp < TIMESTAMP("%s")
-GROUP BY
-  1
-ORDER BY
-  2 DESC
-LIMIT
-  %d
-"""
-
-
-QUERY_TOP_ACCOUNTS_FIRST_TAG = u"""
-SELECT
-  account_id,
-  COUNT(*) AS score
-FROM
-  roger_reporting.content_first_v1
-WHERE
-  tags = "%s" AND
-  timestamp >= TIMESTAMP("%s") AND
-  timestamp < TIMESTAMP("%s")
-GROUP BY
-  1
-ORDER BY
-  2 DESC
-LIMIT
-  %d
-"""
-
-
-QUERY_TOP_ACCOUNTS_PAYMENTS = u"""
-SELECT
-  receiver_id AS account_id,
-  SUM(amount) AS score
-FROM
-  roger_reporting.wallet_payment_v1 p
-WHERE
-  p.receiver_id != p.account_id
-  AND timestamp >= TIMESTAMP("%s")
-  AND timestamp < TIMESTAMP("%s")
-GROUP BY
-  1
-ORDER BY
-  2 DESC
-LIMIT
-  %d
-"""
-
-
-QUERY_TOP_ACCOUNTS_VOTES = u"""
-SELECT
-  creator_id AS account_id,
-  COUNT(*) AS score
-FROM
-  roger_reporting.content_vote_v1
-WHERE
-  account_id != creator_id AND
-  timestamp >= TIMESTAMP("%s") AND
-  timestamp < TIMESTAMP("%s")
-GROUP BY
-  1
-ORDER BY
-  2 DESC
-LIMIT
-  %d
-"""
-
-
-QUERY_TOP_ACCOUNTS_VOTES_TAG = u"""
-SELECT
-  creator_id AS account_id,
-  COUNT(*) AS score
-FROM
-  roger_reporting.content_vote_v1
-WHERE
-  account_id != creator_id AND
-  tags = "%s" AND
-  timestamp >= TIMESTAMP("%s") AND
-  timestamp < TIMESTAMP("%s")
-GROUP BY
-  1
-ORDER BY
-  2 DESC
-LIMIT
-  %d
-"""
-
-
 bigquery_client = bigquery_api.BigQueryClient.for_appengine(
     project_id=config.BIGQUERY_PROJECT,
     dataset_id=config.BIGQUERY_DATASET)
@@ -372,44 +276,41 @@ def post_contacts(session):
     """
     Takes a list of identifiers and returns a map the ones
     that have accounts, and whether they're active.
+
+    With hashed=true, the lines are SHA-256 hashes of identifiers that were
+    previously uploaded and the map is keyed by hash. Hashes that cannot be
+    matched are returned in "unknown" for the client to upload in full.
     """
-    def identity_keys(lines):
-        for line in lines:
-            try:
-                identifier, identifier_type = identifiers.parse(line)
-                if identifier_type not in (identifiers.EMAIL, identifiers.PHONE):
-                    continue
-                yield ndb.Key('Identity', identifier)
-            except:
-                continue
-    lines = request.data.strip().split('\n')
-    futures = ndb.get_multi_async(identity_keys(lines),
-                                  read_policy=ndb.EVENTUAL_CONSISTENCY)
+    hashed = flask_extras.get_flag('hashed')
+    matcher = contacts.Matcher(session.account_key)
+    # Read the request body one line at a time instead of all at once.
+    lines = iter(request.stream.readline, '')
+    if hashed:
+        matcher.match_hashes(lines)
+    else:
+        matcher.match_identifiers(lines)
+    matcher.save()
     account_map = {}
-    for i, future in enumerate(futures):
-        try:
-            identity = future.get_result()
-        except:
-            logging.warning('Erroneous contact %r', lines[i])
-            continue
-        if not identity or not identity.account:
-            continue
-        if g.api_version >= 10:
-            account_map[identity.key.id()] = {
-                'id': identity.account.id(),
-                'active': identity.is_active,
+    for key, (account_id, active) in matcher.matches.iteritems():
+        if g.api_version >= 10 or hashed:
+            account_map[key] = {
+                'id': account_id,
+                'active': active,
             }
         else:
-            if not identity.is_active:
+            if not active:
                 continue
-            identifier, identifier_type = identifiers.parse(identity.key.id())
+            identifier, identifier_type = identifiers.parse(key)
             if identifier_type == identifiers.EMAIL:
-                account_map[identifiers.email(identifier)] = identity.account.id()
+                account_map[identifiers.email(identifier)] = account_id
             else:
-                account_map[identifier] = identity.account.id()
-    logging.debug('Parsed %d lines into %d contact details, %d of which had accounts',
-        len(lines), len(futures), len(account_map))
-    return {'map': account_map}
+                account_map[identifier] = account_id
+    logging.debug('Matched %d lines (%d looked up) into %d contacts with accounts',
+        matcher.num_lines, matcher.num_resolved, len(account_map))
+    result = {'map': account_map}
+    if hashed:
+        result['unknown'] = matcher.unknown
+    return result
 
 
 @app.route('/<version>/content', methods=['GET'])
@@ -432,16 +333,18 @@ def get_content():
     include_extras = flask_extras.get_flag('include_extras')
     session = auth.get_session()
     session_key = session.account_key if session else None
+    blocks = models.Account.get_blocks_async(session_key).get_result() if session else frozenset()
     # Try cache first.
-    cache_key = 'content_%s_%s_%s' % (g.api_version, cache_id, 'extras' if include_extras else 'normal')
-    cache_json = _content_cache_load(cache_key, session_key)
+    cache_key = 'content_entry_%s_%s_%s' % (
+        g.api_version, cache_id, 'extras' if include_extras else 'normal')
+    cache_json = _content_cache_load(cache_key, session_key, blocks)
     if cache_json:
         return convert.Raw(cache_json)
     # Cache miss; get from datastore.
     content = q.get()
     if not content:
         raise errors.ResourceNotFound('Content not found')
-    if session and content.creator in session.account.blocked_by:
+    if content.creator.id() in blocks:
         raise errors.ResourceNotFound('Content not found')
     creator, related_to, voted = content.decoration_info(
         include_creator=True,
@@ -599,16 +502,18 @@ def get_content_content_id(content_id):
     include_extras = flask_extras.get_flag('include_extras')
     session = auth.get_session()
     session_key = session.account_key if session else None
+    blocks = models.Account.get_blocks_async(session_key).get_result() if session else frozenset()
     # Try cache first.
-    cache_key = 'content_%s_id:%d_%s' % (g.api_version, content_id, 'extras' if include_extras else 'normal')
-    cache_json = _content_cache_load(cache_key, session_key)
+    cache_key = 'content_entry_%s_id:%d_%s' % (
+        g.api_version, content_id, 'extras' if include_extras else 'normal')
+    cache_json = _content_cache_load(cache_key, session_key, blocks)
     if cache_json:
         return convert.Raw(cache_json)
     # Cache miss; get from datastore.
     content = models.Content.get_by_id(content_id)
     if not content or not content.visible_by(session_key):
         raise errors.ResourceNotFound('Content not found')
-    if session and content.creator in session.account.blocked_by:
+    if content.creator.id() in blocks:
         raise errors.ResourceNotFound('Content not found')
     creator, related_to, voted = content.decoration_info(
         include_creator=True,
@@ -689,68 +594,72 @@ def get_content_content_id_comments(content_id):
         raise errors.UnsupportedEndpoint()
     content_key = ndb.Key('Content', content_id)
     sort = flask_extras.get_parameter('sort') or 'offset'
-    q = models.ContentComment.query(ancestor=content_key)
-    if sort in ('created', 'threaded'):
-        q = q.order(-models.ContentComment.created)
-    elif sort == 'offset':
-        q = q.order(models.ContentComment.offset)
-        q = q.filter(models.ContentComment.offset >= 0)
-    else:
-        raise errors.InvalidArgument('Invalid sort value')
-    cache_key = 'content_comments_%s_%d_%s' % (g.api_version, content_id, sort)
-    result_json = memcache.get(cache_key)
-    if result_json:
-        logging.debug('Loaded cache key %r', cache_key)
-        return convert.Raw(result_json)
-    future = q.fetch_async()
-    content = content_key.get()
     session = auth.get_session()
     session_key = session.account_key if session else None
+    content_future = content_key.get_async()
+    # Comments from accounts that blocked (or were blocked by) the viewer are left out.
+    blocks_future = models.Account.get_blocks_async(session_key) if session else None
+    if sort == 'threaded' and g.api_version >= 57:
+        # Threads are paged and cached as comments (see roger.comments), not as JSON.
+        cursor = flask_extras.get_parameter('cursor')
+        reply_to = flask_extras.get_parameter('reply_to')
+        if reply_to:
+            reply_to_key = ndb.Key('ContentComment', reply_to, parent=content_key)
+            future = comments.get_replies_async(reply_to_key, config.COMMENT_REPLIES_PAGE_SIZE,
+                                                cursor=cursor)
+        else:
+            future = comments.get_threads_async(content_key, cursor=cursor)
+        cache_key, fragments = None, None
+    else:
+        q = models.ContentComment.query(ancestor=content_key)
+        if sort in ('created', 'threaded'):
+            q = q.order(-models.ContentComment.created)
+        elif sort == 'offset':
+            q = q.order(models.ContentComment.offset)
+            q = q.filter(models.ContentComment.offset >= 0)
+        else:
+            raise errors.InvalidArgument('Invalid sort value')
+        generation = models.ContentComment.get_cache_generation_async(content_key).get_result()
+        cache_key = 'content_comment_fragments_%s_%d_%s_%d' % (
+            g.api_version, content_id, sort, generation)
+        # The cache is shared by all viewers, as the JSON of every comment with the id of
+        # its creator so that blocked accounts can be filtered out when serving it.
+        fragments = memcache.get(cache_key)
+        future = q.fetch_async() if fragments is None else None
+    content = content_future.get_result()
     if not content or not content.visible_by(session_key):
         raise errors.ResourceNotFound('Content not found')
     if session and content.creator in session.account.blocked_by:
         raise errors.ResourceNotFound('Content not found')
-    comments = future.get_result()
-    lookup = {a.key: a for a in ndb.get_multi({c.creator for c in comments})}
-    # For threaded sort, place replies under their parent comment and sort them ascending.
-    if sort == 'threaded':
-        comments_by_id = {}
-        threads = collections.OrderedDict()
-        for c in comments:
-            c_id = c.key.id()
-            comments_by_id[c_id] = c
-            if not c.reply_to:
-                if c_id not in threads:
-                    threads[c_id] = []
-                continue
-            p_id = c.reply_to.id()
-            if p_id in threads:
-                threads[p_id].insert(0, c_id)
-            else:
-                threads[p_id] = [c_id]
-        comments = []
-        for p_id, replies in threads.iteritems():
-            if p_id not in comments_by_id:
-                logging.error('Could not find parent %r (%d replies)', p_id, len(replies))
-                continue
-            comments.append(comments_by_id[p_id])
-            for c_id in replies:
-                comments.append(comments_by_id[c_id])
-    data = []
-    for c in comments:
-        creator = lookup[c.creator]
-        if session and c.creator in session.account.blocked_by:
-            # Don't show comments from users that have blocked viewer.
-            continue
-        if session and session_key in creator.blocked_by:
-            # Don't show comments from users blocked by the viewer.
-            continue
-        data.append(c.public(creator=creator, version=g.api_version))
-    result_json = convert.to_json({'data': data}, **g.public_options)
-    cache_ttl = 3600
-    memcache.set(cache_key, result_json, time=cache_ttl)
-    logging.debug('Saved to cache key %r (ttl: %d)', cache_key, cache_ttl)
-    return convert.Raw(result_json)
+    blocks = blocks_future.get_result() if blocks_future else frozenset()
+    if fragments is None:
+        if cache_key:
+            comment_list, next_cursor = future.get_result(), None
+            if sort == 'threaded':
+                # Older clients get every comment with replies placed under their parent.
+                comment_list = _thread_comments(comment_list)
+        elif reply_to:
+            comment_list, next_cursor = future.get_result()
+        else:
+            # Place replies under their top-level comment.
+            threads, next_cursor = future.get_result()
+            comment_list = [c for root, replies in threads for c in [root] + replies]
+        lookup = {a.key: a for a in ndb.get_multi({c.creator for c in comment_list})}
+        if not cache_key:
+            data = [c.public(creator=lookup[c.creator], version=g.api_version)
+                    for c in comment_list if c.creator.id() not in blocks]
+            return {'cursor': next_cursor, 'data': data}
+        fragments = []
+        for c in comment_list:
+            data = c.public(creator=lookup[c.creator], version=g.api_version)
+            fragments.append((c.creator.id(), convert.to_json(data, **g.public_options)))
+        cache_ttl = 3600
+        memcache.set(cache_key, fragments, time=cache_ttl)
+        logging.debug('Saved to cache key %r (ttl: %d)', cache_key, cache_ttl)
+    else:
+        logging.debug('Loaded cache key %r', cache_key)
+    data_json = ','.join(j for account_id, j in fragments if account_id not in blocks)
+    return convert.Raw('{"data":[%s]}' % (data_json,))
 
 
 @app.route('/<version>/content/<content_id>/comments/<comment_id>', methods=['DELETE'])
@@ -772,20 +681,11 @@ def delete_content_content_id_comments_comment_id(session, content_id, comment_i
         else:
             creator = comment.creator.get()
         # FIXME: Spamming this endpoint could reduce comment count to 0.
-        futures = [
-            comment.key.delete_async(),
-            _change_content_comment_count_async(creator, comment, -1),
-        ]
-        if g.api_version:
-            v = int(g.api_version)
-            c = ndb.get_context()
-            for x in (-1, 0, 1):
-                futures += [
-                    c.memcache_delete('content_comments_%s_%d_created' % (v + x, content_id)),
-                    c.memcache_delete('content_comments_%s_%d_offset' % (v + x, content_id)),
-                    c.memcache_delete('content_comments_%s_%d_threaded' % (v + x, content_id)),
-                ]
-        _wait_all(futures)
+        _wait_all([
+            comments.delete_async(comment),
+            content.count_comment_async(creator, -1),
+        ])
+        models.ContentComment.invalidate_cache_async(content_key).get_result()
         return {'success': True}
     if not content.visible_by(session.account_key):
         raise errors.ResourceNotFound('Content not found')
@@ -837,14 +737,15 @@ def put_content_content_id_comments_offset(session, content_id, offset=-1):
         text=text)
     hub = notifs.Hub(content.creator)
     futures = [
-        comment.put_async(),
+        comments.add_async(comment),
         hub.emit_async(notifs.ON_CONTENT_COMMENT,
             comment=comment,
             commenter=session.account,
             content=content),
-        _change_content_comment_count_async(session.account, comment, 1),
+        content.count_comment_async(session.account),
     ]
-    # Notify users mentioned in the comment and/or previous commenters.
+    # Notify users mentioned in the comment and/or previous commenters. This also adds
+    # the hashtags in the comment to the content.
     # TODO: Add creator of `parent` (from `reply_to_key`) as another mention.
     task = taskqueue.Task(
         countdown=2,
@@ -855,15 +756,6 @@ def put_content_content_id_comments_offset(session, content_id, offset=-1):
                 'creator_id': content.creator.id(),
                 'mentions': ','.join(identifiers.find_mentions(text))})
     futures.append(_add_task_async(task, queue_name=config.INTERNAL_QUEUE))
-    if g.api_version:
-        v = int(g.api_version)
-        c = ndb.get_context()
-        for x in (-1, 0, 1):
-            futures += [
-                c.memcache_delete('content_comments_%s_%d_created' % (v + x, content_id)),
-                c.memcache_delete('content_comments_%s_%d_offset' % (v + x, content_id)),
-                c.memcache_delete('content_comments_%s_%d_threaded' % (v + x, content_id)),
-            ]
     _wait_all(futures)
     return comment.public(creator=session.account, version=g.api_version)
 
@@ -1254,41 +1146,41 @@ def get_content_tags(tags):
         raise errors.InvalidArgument('Invalid limit')
     session = auth.get_session()
     session_key = session.account_key if session else None
+    # Content by accounts that blocked (or were blocked by) the viewer is left out.
+    blocks_future = models.Account.get_blocks_async(session_key) if session else None
     cursor_urlsafe = flask_extras.get_parameter('cursor')
     is_first_page = not cursor_urlsafe
-    if is_first_page:
-        # Attempt to get the data from cache (first page only).
-        tags_string = '+'.join(sorted(tags))
-        cache_key = 'content_%s_%s_%s_%d' % (g.api_version, tags_string, sort, limit)
-        cache_json = memcache.get(cache_key)
-    else:
-        cache_json = None
-    if cache_json:
+    # Attempt to get the data from cache. Pages are keyed by their position in the list.
+    tags_string = '+'.join(sorted(tags))
+    cache_key = 'content_fragments_%s_%s_%s_%d_%s' % (g.api_version, tags_string, sort, limit,
+                                                      cursor_urlsafe or '')
+    cached = memcache.get(cache_key)
+    if cached is not None:
         logging.debug('Loaded cache key %r', cache_key)
-        return convert.Raw(_load_and_inject_votes(cache_json, session_key))
+        blocks = blocks_future.get_result() if blocks_future else frozenset()
+        return convert.Raw(_join_content_fragments(cached, blocks, session_key))
     # Read the data from datastore.
     q = models.Content.query()
     for tag in tags:
         q = q.filter(models.Content.tags == tag)
     if sort == 'hot':
         cache_ttl = 300
-        q = q.order(-models.Content.sort_index)
+        sort_prop = models.Content.sort_index
     elif sort == 'recent':
         cache_ttl = 60
-        q = q.order(-models.Content.created)
+        sort_prop = models.Content.created
     elif sort == 'top':
         cache_ttl = 3600
-        q = q.order(-models.Content.sort_bonus)
+        sort_prop = models.Content.sort_bonus
     else:
         raise errors.InvalidArgument('Invalid sort value')
-    cursor = datastore_query.Cursor(urlsafe=cursor_urlsafe)
-    content_future = q.fetch_page_async(limit, start_cursor=cursor)
+    content_future = utils.fetch_keyset_page_async(q, sort_prop, limit, cursor_urlsafe)
     if is_first_page and tags == {'published', 'reaction'} and sort == 'recent':
         q2 = models.Content.query()
         q2 = q2.filter(models.Content.tags == 'featured')
         q2 = q2.order(-models.Content.created)
         extra_list = q2.fetch(limit // 3 + 1)
-        content_list, next_cursor, more = content_future.get_result()
+        content_list, next_cursor_urlsafe = content_future.get_result()
         content_keys = set(c.key for c in content_list)
         for i, extra in enumerate(e for e in extra_list if e.key not in content_keys):
             i = 2 + i * 4
@@ -1296,46 +1188,32 @@ def get_content_tags(tags):
                 break
             content_list[i:i] = [extra]
     else:
-        content_list, next_cursor, more = content_future.get_result()
+        content_list, next_cursor_urlsafe = content_future.get_result()
     # Hide some content.
     content_list = _filter_content(content_list, hide_flagged=('featured' not in tags and sort == 'recent'))
-    # Look up extra data for the content list.
-    lookup, votes = models.Content.decorate(content_list,
-                                            include_creator=True,
-                                            include_related=True,
-                                            for_account_key=session_key)
-    next_cursor_urlsafe = next_cursor.urlsafe() if more else None
-    # Build the result and a payload to cache.
-    cache_data = []
-    data = []
-    for i, content in enumerate(content_list):
+    # Look up extra data for the content list. Votes are injected per viewer below.
+    lookup, _ = models.Content.decorate(content_list, include_creator=True, include_related=True)
+    # The page is cached as the JSON of every item with the id of its creator so that it
+    # can be shared by all viewers and filtered for the viewer's blocks when it is served.
+    fragments = []
+    for content in content_list:
+        # Create a marker that marks the content id so we can replace it with vote data.
+        cache_marker = config.CONTENT_CACHE_MARKER + str(content.key.id())
         result = {
             'content': content,
             'creator': lookup[content.creator],
             'related_to': lookup.get(content.related_to),
-            'voted': votes[i] is not None,
+            'voted': cache_marker,
         }
-        data.append(result)
-        if is_first_page:
-            # Create a marker that marks the content id so we can replace it with vote data.
-            cache_marker = config.CONTENT_CACHE_MARKER + str(content.key.id())
-            cache_data.append(dict(result, voted=cache_marker))
+        fragments.append((content.creator.id(), convert.to_json(result, **g.public_options)))
     if (tags == {'featured'} or tags == {'featured prank', 'reaction'}) and sort == 'hot':
         # Scramble featured content.
-        if is_first_page:
-            random.shuffle(cache_data)
-        random.shuffle(data)
-    if is_first_page:
-        if g.api_version >= 45:
-            cache_data = {'cursor': next_cursor_urlsafe, 'data': cache_data}
-        else:
-            cache_data = {'data': cache_data}
-        cache_json = convert.to_json(cache_data, **g.public_options)
-        memcache.set(cache_key, cache_json, time=cache_ttl)
-        logging.debug('Saved to cache key %r (ttl: %d)', cache_key, cache_ttl)
-    if g.api_version < 45:
-        return {'data': data}
-    return {'cursor': next_cursor_urlsafe, 'data': data}
+        random.shuffle(fragments)
+    cached = (next_cursor_urlsafe, fragments)
+    memcache.set(cache_key, cached, time=cache_ttl)
+    logging.debug('Saved to cache key %r (ttl: %d)', cache_key, cache_ttl)
+    blocks = blocks_future.get_result() if blocks_future else frozenset()
+    return convert.Raw(_join_content_fragments(cached, blocks, session_key))
 
 
 @app.route('/<version>/device', methods=['GET'])
@@ -1740,7 +1618,8 @@ def put_original():
     session = auth.get_session()
     if not content or (session and not content.visible_by(session.account.key)):
         raise errors.ResourceNotFound('Content not found')
-    if session and content.creator in session.account.blocked_by:
+    blocks = models.Account.get_blocks_async(session.account_key).get_result() if session else ()
+    if content.creator.id() in blocks:
         raise errors.ResourceNotFound('Content not found')
     creator, related_to, voted = content.decoration_info(
         include_creator=True,
@@ -1775,49 +1654,48 @@ def get_original():
     q = q.filter(models.Content.tags == 'original')
     if sort == 'hot':
         q = q.filter(models.Content.tags == 'is hot')
-        q = q.order(-models.Content.sort_index)
+        sort_prop = models.Content.sort_index
         cache_ttl = 600
     elif sort == 'recent':
         q = q.filter(models.Content.tags == 'is reacted')
-        q = q.order(-models.Content.created)
+        sort_prop = models.Content.created
         cache_ttl = 60 if not cursor_urlsafe else 600
     elif sort == 'top':
-        q = q.order(-models.Content.sort_bonus)
+        sort_prop = models.Content.sort_bonus
         cache_ttl = 86400
     else:
         raise errors.InvalidArgument('Invalid sort value')
-    cursor = datastore_query.Cursor(urlsafe=cursor_urlsafe)
-    content_list, next_cursor, more = q.fetch_page(limit, start_cursor=cursor)
-    # Look up extra data for the content list.
-    related_futures = []
+    content_list, next_cursor_urlsafe = utils.fetch_keyset_page(q, sort_prop, limit, cursor_urlsafe)
+    # Originals that predate top reactions fall back to querying their reactions
+    # until the backfill_top_reactions job has reached them.
+    related_futures = {}
     for content in content_list:
+        if content.top_reactions_updated or not content.related_count:
+            continue
         q = models.Content.query()
         q = q.filter(models.Content.related_to == content.key)
         q = q.filter(models.Content.tags == 'reaction')
         q = q.order(-models.Content.sort_bonus)
-        related_futures.append(q.fetch_async(10))
+        related_futures[content.key] = q.fetch_async(10)
+    # Look up the top reactions and the accounts in one batch.
     creator_keys = set(c.creator for c in content_list if c.creator.id() != config.ANONYMOUS_ID)
     poster_keys = set(c.first_related_creator for c in content_list if c.first_related_creator)
     poster_keys.add(ndb.Key('Account', config.REACTION_CAM_ID))
-    account_lookup = {a.key: a for a in ndb.get_multi(creator_keys | poster_keys) if a}
+    reaction_keys = set(k for c in content_list for k in c.top_reactions)
+    lookup = {e.key: e for e in ndb.get_multi(list(creator_keys | poster_keys | reaction_keys)) if e}
     # Build the result and a payload to cache.
-    result = {'cursor': next_cursor.urlsafe() if more else None, 'data': []}
-    for i, content in enumerate(content_list):
-        related_source = related_futures[i].get_result()
-        related = []
-        for r in related_source:
-            if 'repost' in r.tags:
-                continue
-            if any(r.creator == rr.creator for rr in related):
-                continue
-            related.append(r)
-            if len(related) >= 5:
-                break
+    result = {'cursor': next_cursor_urlsafe, 'data': []}
+    for content in content_list:
+        if content.key in related_futures:
+            related_source = related_futures[content.key].get_result()
+        else:
+            related_source = [lookup.get(k) for k in content.top_reactions]
+        related = models.Content.pick_top_reactions(related_source)
         poster_key = content.first_related_creator or ndb.Key('Account', config.REACTION_CAM_ID)
         result['data'].append({
             'content': content,
-            'creator': account_lookup.get(content.creator),
-            'poster': account_lookup.get(poster_key),
+            'creator': lookup.get(content.creator),
+            'poster': lookup.get(poster_key),
             'related': related,
         })
     cache_json = convert.to_json(result, **g.public_options)
@@ -1834,36 +1712,23 @@ def get_pay_feed():
     if cache_json:
         logging.debug('Loaded cache key %r', cache_key)
         return convert.Raw(cache_json)
-    # TODO: Improve and index this query to fetch less duds.
-    q = models.WalletTransaction.query()
-    q = q.order(-models.WalletTransaction.timestamp)
-    txs = q.fetch(1000)
-    # Filter out transactions where coins were removed.
-    txs = filter(lambda tx: tx.delta > 0, txs)
-    # Filter out transactions where user bought coins.
-    txs = filter(lambda tx: tx.receiver != tx.sender, txs)
-    # Don't show free coins via admin (sent by @reaction.cam).
-    txs = filter(lambda tx: tx.sender != ndb.Key('Account', config.REACTION_CAM_ID), txs)
+    payments = models.WalletPayment.latest_query().fetch(20)
     # Get all accounts decorated.
-    keys = set(k for tx in txs for k in [tx.receiver, tx.sender])
-    lookup = {a.key: a for a in ndb.get_multi(keys)}
+    keys = set(k for p in payments for k in [p.receiver, p.sender])
+    lookup = {a.key: a for a in ndb.get_multi(keys) if a}
     # Create data structure for feed.
     data = []
-    for tx in txs:
-        comment = re.sub(r'^Payment \((.*?)\)$', r'\1', tx.comment)
-        if comment == 'None':
-            comment = None
-        if not comment and convert.unix_timestamp_ms(tx.timestamp) % 1000 < 950:
-            # Skip ~95% of bot transactions.
+    for p in payments:
+        if p.receiver not in lookup or p.sender not in lookup:
             continue
         data.append({
-            'amount': tx.delta,
-            'comment': comment,
-            'receiver': lookup[tx.receiver],
-            'sender': lookup[tx.sender],
-            'timestamp': tx.timestamp,
+            'amount': p.amount,
+            'comment': p.comment,
+            'receiver': lookup[p.receiver],
+            'sender': lookup[p.sender],
+            'timestamp': p.timestamp,
         })
-    result = {'data': data[:20]}
+    result = {'data': data}
     cache_json = convert.to_json(result, **g.public_options)
     cache_ttl = 300
     memcache.set(cache_key, cache_json, time=cache_ttl)
@@ -2123,12 +1988,7 @@ def post_profile_me_chat_announce(session):
     text = flask_extras.get_parameter('text')
     if not text:
         raise errors.InvalidArgument('Missing text')
-    taskqueue.add(url='/_ah/jobs/chat_announce',
-                  params={'owner_id': session.account_id,
-                          'channel_id': str(session.account_id),
-                          'text': text},
-                  queue_name=config.INTERNAL_QUEUE,
-                  retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0))
+    chat.announce(session.account_key, str(session.account_id), text)
     return {'success': True}
 
 
@@ -2216,6 +2076,8 @@ def delete_profile_me_following_identifier(session, identifier):
     a, b = future.get_result()
     if not b:
         logging.debug('Request did not result in an unfollow')
+        return {'success': True}
+    timelines.on_unfollow_async(session.account_key, account_key).get_result()
     return {'success': True}
 
 
@@ -2238,6 +2100,7 @@ def put_profile_me_following_identifiers(session, identifiers):
     if b_list:
         hubs = [accounts.get_handler(b).notifs for b in b_list]
         futures = [h.emit_async(notifs.ON_ACCOUNT_FOLLOW, follower=a) for h in hubs]
+        futures.append(timelines.on_follow_async(a.key, [b.key for b in b_list]))
         _wait_all(futures)
     else:
         logging.debug('Request did not result in a follow')
@@ -2270,38 +2133,22 @@ def get_profile_me_following_content_tag(session, tag):
         assert 0 < limit <= 500
     except:
         raise errors.InvalidArgument('Invalid limit')
-    # Get all the individual feeds of accounts followed by session account.
-    session_future = _get_single_feed_async(session.account_key, tag)
-    account_keys, _, _ = models.AccountFollow.fetch_following_page(session.account_key,
-                                                                   100, keys_only=True)
-    futures = [session_future] + [_get_single_feed_async(k, tag) for k in account_keys]
-    _wait_all(futures)
-    futures_and_feeds = [f.get_result() for f in futures]
-    futures, feeds = zip(*futures_and_feeds)
-    # Weave the feeds together into one feed.
-    content_list = sorted(itertools.chain.from_iterable(feeds),
-                          key=lambda c: c.created, reverse=True)
-    # Restrict the content list to the limit, then decorate it.
-    logging.debug('Fetched %d Content entities for feed of max %d', len(content_list), limit)
-    content_list = content_list[:limit]
+    content_list, next_cursor = timelines.get_page(session.account_key, tag, limit,
+                                                   cursor=flask_extras.get_parameter('cursor'))
     lookup, votes = models.Content.decorate(content_list,
+        include_creator=True,
         include_related=True,
         for_account_key=session.account_key)
-    # Add in the creators in the lookup.
-    for future in futures:
-        account = future.get_result()
-        lookup[account.key] = account
-    # Build the final result.
     data = []
     for i, content in enumerate(content_list):
         result = {
             'content': content,
-            'creator': lookup[content.creator],
+            'creator': lookup.get(content.creator),
             'related_to': lookup.get(content.related_to),
             'voted': votes[i] is not None,
         }
         data.append(result)
-    return {'data': data}
+    return {'cursor': next_cursor, 'data': data}
 
 
 @app.route('/<version>/profile/me/notifications/', methods=['GET'])
@@ -2518,35 +2365,11 @@ def post_profile_identifier_chat_mentions(session, identifier):
     plus_ids = set(flask_extras.get_parameter_list('identifier'))
     if not mentions and not plus_ids:
         return {'success': True}
-    owner_future = models.Account.resolve_async(identifier)
-    key_futures = [(m, models.Account.resolve_key_async(m)) for m in mentions | plus_ids]
-    # Track both unique account keys and which identifiers were used to get them.
-    mention_dict = collections.defaultdict(list)
-    for m, f in key_futures:
-        mention_key = f.get_result()
-        if not mention_key or mention_key == session.account_key:
-            continue
-        mention_dict[mention_key].append(m)
-    owner = owner_future.get_result()
-    if not owner:
+    owner_key = models.Account.resolve_key(identifier)
+    if not owner_key:
         raise errors.InvalidArgument('Invalid identifier')
-    futures = []
-    for mention_key in mention_dict.iterkeys():
-        logging.debug('Notifying %d of mention in chat message by %d',
-                      mention_key.id(), session.account_id)
-        hub = notifs.Hub(mention_key)
-        if any(m in mentions for m in mention_dict[mention_key]):
-            event_name = notifs.ON_CHAT_MENTION
-        else:
-            # The account was not mentioned in the text.
-            event_name = notifs.ON_CHAT_MESSAGE
-        f = hub.emit_async(event_name,
-            channel_id=str(owner.key.id()),
-            owner=owner,
-            sender=session.account,
-            text=text)
-        futures.append(f)
-    _wait_all(futures)
+    # Mentions are resolved and notified by jobs, however many accounts there are.
+    chat.mention(session.account_key, owner_key, text, plus_ids)
     return {'success': True}
 
 
@@ -3221,6 +3044,14 @@ def get_requests_public_tags(tags):
         tags.add('approved')
     # Sort.
     sort = flask_extras.get_parameter('sort') or 'hot'
+    if sort == 'hot':
+        sort_prop = models.ContentRequestPublic.sort_index
+    elif sort == 'recent':
+        sort_prop = models.ContentRequestPublic.requested
+    elif sort == 'reward':
+        sort_prop = models.ContentRequestPublic.reward
+    else:
+        raise errors.InvalidArgument('Invalid sort value')
     # Limit.
     try:
         limit = int(flask_extras.get_parameter('limit') or 50)
@@ -3249,23 +3080,26 @@ def get_requests_public_tags(tags):
         q = q.filter(models.ContentRequestPublic.requested_by == session.account_key)
     for tag in tags:
         q = q.filter(models.ContentRequestPublic.tags == tag)
-    # TODO: Respect sort parameter.
-    q = q.order(-models.ContentRequestPublic.sort_index)
-    cursor = datastore_query.Cursor(urlsafe=cursor_urlsafe)
-    request_list, next_cursor, more = q.fetch_page(limit, start_cursor=cursor)
+    request_list, next_cursor_urlsafe = utils.fetch_keyset_page(q, sort_prop, limit, cursor_urlsafe)
     lookup_keys = set()
     lookup_keys.update(r.content for r in request_list)
-    lookup_keys.update(r.wallet for r in request_list if r.wallet)
+    # Only requests whose reward has not been copied from the wallet yet need the wallet.
+    lookup_keys.update(r.wallet for r in request_list if not r.has_reward)
     lookup = {e.key: e for e in ndb.get_multi(lookup_keys)}
     data = []
     for request in request_list:
-        reward = lookup[request.wallet].balance if request.wallet else None
+        if not request.wallet:
+            reward = None
+        elif request.has_reward:
+            reward = request.reward
+        else:
+            reward = lookup[request.wallet].balance
         data.append({
             'content': lookup[request.content],
             'request': request.public(reward=reward, version=g.api_version),
         })
     result = {
-        'cursor': next_cursor.urlsafe() if more else None,
+        'cursor': next_cursor_urlsafe,
         'data': data,
     }
     if cache_key:
@@ -4205,8 +4039,14 @@ def post_threads_thread_id(session, thread_id):
 def get_threads_thread_id_messages(session, thread_id):
     cursor_urlsafe = flask_extras.get_parameter('cursor')
     cursor = datastore_query.Cursor(urlsafe=cursor_urlsafe)
+    try:
+        limit = int(flask_extras.get_parameter('limit') or 50)
+        assert 0 < limit <= 100
+    except:
+        raise errors.InvalidArgument('Invalid limit')
     handler = threads.Handler(session.account_key)
-    thread, messages, next_cursor = handler.get_recent_messages(thread_id, cursor=cursor)
+    thread, messages, next_cursor = handler.get_recent_messages(thread_id, cursor=cursor,
+                                                                limit=limit)
     if any(a.account in session.account.blocked_by for a in thread.accounts):
         raise errors.ResourceNotFound('Thread not found')
     return {
@@ -4248,65 +4088,43 @@ def get_top_accounts_category(category='votes'):
         if ' ' in tag or len(tag) > 20:
             raise errors.InvalidArgument('Invalid tag')
         tag = tag.lower()
-    # Calculate time range to get ranks for.
-    tz = pytz.timezone('America/New_York')
-    midnight = pytz.utc.localize(datetime.utcnow()).astimezone(tz)
-    midnight = midnight.replace(hour=0, minute=0, second=0, microsecond=0)
-    midnight = midnight.astimezone(pytz.utc)
-    ts_max = midnight.strftime('%Y-%m-%d %H:%M')
-    midnight += timedelta(days=-7)
-    ts_min = midnight.strftime('%Y-%m-%d %H:%M')
-    # Attempt to load from cache.
-    if tag:
-        cache_key = 'top_accounts_%s_%s_%s_%s_%s' % (g.api_version, category, tag, ts_min, ts_max)
-    else:
-        cache_key = 'top_accounts_%s_%s_%s_%s' % (g.api_version, category, ts_min, ts_max)
+    if category == 'creators':
+        return _get_top_creators()
+    # Leaderboards are precomputed by a cron job, so the cache only changes with the window.
+    snapshot_key = models.TopAccountsSnapshot.make_key(category, tag)
+    ts_max = models.TopAccountsSnapshot.current_window()[1]
+    cache_key = 'top_accounts_%s_%s_%d' % (
+        g.api_version, _b64hash(snapshot_key.id()), convert.unix_timestamp(ts_max))
     result_json = memcache.get(cache_key)
     if result_json:
         logging.debug('Loaded cache key %r', cache_key)
         return convert.Raw(result_json)
-    top_list = []
-    if category == 'creators':
-        account_keys = [ndb.Key('Account', aid) for aid in config.TOP_CREATOR_IDS]
-        accounts = ndb.get_multi(account_keys[:30])
-        for account in accounts:
-            top_list.append({
-                'account': account,
-                'score': account.content_reaction_count,
-            })
+    snapshot = snapshot_key.get()
+    if not snapshot:
+        # This leaderboard has never been computed, so it stays empty until the task is done.
+        _schedule_top_accounts_update(category, tag)
+        return {'data': []}
+    if snapshot.is_current:
+        cache_ttl = 86400
     else:
-        # Get the data from BigQuery.
-        if tag:
-            if category == 'first':
-                query = QUERY_TOP_ACCOUNTS_FIRST_TAG
-            elif category == 'votes':
-                query = QUERY_TOP_ACCOUNTS_VOTES_TAG
-            query = query % (tag.replace('"', '\\"'), ts_min, ts_max, 50)
-        else:
-            if category == 'first':
-                query = QUERY_TOP_ACCOUNTS_FIRST
-            elif category == 'payments':
-                query = QUERY_TOP_ACCOUNTS_PAYMENTS
-            elif category == 'votes':
-                query = QUERY_TOP_ACCOUNTS_VOTES
-            query = query % (ts_min, ts_max, 50)
-        logging.debug('Running query:%s', query)
-        rows = list(bigquery_client.query(query).rows())
-        account_keys = [ndb.Key('Account', int(r.account_id)) for r in rows]
-        lookup = {a.key.id(): a for a in ndb.get_multi(account_keys) if a}
-        for r in rows:
-            account = lookup.get(int(r.account_id))
-            if not account:
-                logging.debug('Could not include account %r', r.account_id)
-                continue
-            top_list.append({
-                'account': account,
-                'score': int(r.score),
-            })
+        # Serve the last good snapshot while a fresh one is computed.
+        _schedule_top_accounts_update(category, tag)
+        cache_ttl = 300
+    account_keys = [ndb.Key('Account', account_id) for account_id, _ in snapshot.rows]
+    lookup = {a.key.id(): a for a in ndb.get_multi(account_keys) if a}
+    top_list = []
+    for account_id, score in snapshot.rows:
+        account = lookup.get(account_id)
+        if not account:
+            logging.debug('Could not include account %r', account_id)
+            continue
+        top_list.append({
+            'account': account,
+            'score': score,
+        })
     result = {'data': top_list}
     # Save data in cache before returning it.
     result_json = convert.to_json(result, **g.public_options)
-    cache_ttl = 86400
     memcache.set(cache_key, result_json, time=cache_ttl)
     logging.debug('Saved to cache key %r (ttl: %d)', cache_key, cache_ttl)
     return convert.Raw(result_json)
@@ -4419,35 +4237,24 @@ def _b64hash(value):
     return hashlib.md5(value).digest().encode('base64').strip('\n=')
 
 
-@ndb.transactional_tasklet
-def _change_content_comment_count_async(creator, comment, count):
-    content_key = comment.key.parent()
-    content = yield content_key.get_async()
-    content.add_comment_count(creator, count=count)
-    old_tags = set(content.tags)
-    content.add_tags(re.findall('#(\\w+)', comment.text))
-    new_tags = set(content.tags) - old_tags
-    if new_tags:
-        logging.debug('Added tags from comment: %s', ', '.join(new_tags))
-    logging.debug('Updated content %d comment count to %d',
-                  content_key.id(), content.comment_count)
-    yield content.put_async()
-    raise ndb.Return(content)
-
-
-def _content_cache_load(cache_key, session_key=None):
-    cache_json = memcache.get(cache_key)
-    if not cache_json:
+def _content_cache_load(cache_key, session_key=None, blocks=frozenset()):
+    cached = memcache.get(cache_key)
+    if not cached:
         return None
     logging.debug('Loaded cache key %r', cache_key)
+    creator_id, cache_json = cached
+    if creator_id in blocks:
+        raise errors.ResourceNotFound('Content not found')
     return _load_and_inject_votes(cache_json, session_key)
 
 
 def _content_cache_save(cache_key, result_dict, cache_ttl=3600):
-    cache_marker = config.CONTENT_CACHE_MARKER + str(result_dict['content'].key.id())
+    content = result_dict['content']
+    cache_marker = config.CONTENT_CACHE_MARKER + str(content.key.id())
     cache_dict = dict(result_dict, voted=cache_marker)
     cache_json = convert.to_json(cache_dict, **g.public_options)
-    memcache.set(cache_key, cache_json, time=cache_ttl)
+    # The creator is cached with the JSON so that blocks can be checked on a cache hit.
+    memcache.set(cache_key, (content.creator.id(), cache_json), time=cache_ttl)
     logging.debug('Saved to cache key %r (ttl: %d)', cache_key, cache_ttl)
 
 
@@ -4490,15 +4297,24 @@ def _get_request_entries_with_content_async(request_key, status):
     raise ndb.Return(list(zip(entries, contents)))
 
 
-@ndb.tasklet
-def _get_single_feed_async(account_key, tag):
-    account_future = account_key.get_async()
-    q = models.Content.query()
-    q = q.filter(models.Content.creator == account_key)
-    q = q.filter(models.Content.tags == tag)
-    q = q.order(-models.Content.created)
-    content_list = yield q.fetch_async(limit=10)
-    raise ndb.Return((account_future, content_list))
+def _get_top_creators():
+    cache_key = 'top_accounts_%s_creators' % (g.api_version,)
+    result_json = memcache.get(cache_key)
+    if result_json:
+        logging.debug('Loaded cache key %r', cache_key)
+        return convert.Raw(result_json)
+    account_keys = [ndb.Key('Account', aid) for aid in config.TOP_CREATOR_IDS]
+    top_list = []
+    for account in ndb.get_multi(account_keys[:30]):
+        top_list.append({
+            'account': account,
+            'score': account.content_reaction_count,
+        })
+    result_json = convert.to_json({'data': top_list}, **g.public_options)
+    cache_ttl = 86400
+    memcache.set(cache_key, result_json, time=cache_ttl)
+    logging.debug('Saved to cache key %r (ttl: %d)', cache_key, cache_ttl)
+    return convert.Raw(result_json)
 
 
 _TOP_ACCOUNTS_INDEX = None
@@ -4577,6 +4393,16 @@ def _handle_content_was_deleted(creator, content, related_to):
     task.add(queue_name=config.INTERNAL_QUEUE)
 
 
+def _join_content_fragments(cached, blocks, session_key):
+    next_cursor_urlsafe, fragments = cached
+    data_json = ','.join(j for account_id, j in fragments if account_id not in blocks)
+    if g.api_version < 45:
+        cache_json = '{"data":[%s]}' % (data_json,)
+    else:
+        cache_json = '{"cursor":%s,"data":[%s]}' % (json.dumps(next_cursor_urlsafe), data_json)
+    return _load_and_inject_votes(cache_json, session_key)
+
+
 def _load_and_inject_votes(cache_json, session_key):
     vote_keys = []
     # Split the string so that the left part ends after '"voted":' and the right part
@@ -4602,6 +4428,50 @@ def _load_and_inject_votes(cache_json, session_key):
     return ''.join(chain)
 
 
+def _schedule_top_accounts_update(category, tag=None):
+    _, ts_max = models.TopAccountsSnapshot.current_window()
+    # Use a named task so that concurrent requests only schedule one update per window.
+    name = 'top-accounts-%s-%s-%d' % (
+        category, hashlib.md5((tag or u'').encode('utf-8')).hexdigest(),
+        convert.unix_timestamp(ts_max))
+    task = taskqueue.Task(
+        name=name,
+        url='/_ah/cron/update_top_accounts',
+        params={'category': category, 'tag': tag or '', 'requested': 'true'},
+        retry_options=taskqueue.TaskRetryOptions(task_retry_limit=2))
+    try:
+        task.add(queue_name=config.INTERNAL_QUEUE)
+        logging.debug('Scheduled update of top accounts (%s, %r)', category, tag)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def _thread_comments(comment_list):
+    # Expects comments newest first and puts replies (oldest first) after their parent.
+    comments_by_id = {}
+    threads = collections.OrderedDict()
+    for c in comment_list:
+        c_id = c.key.id()
+        comments_by_id[c_id] = c
+        if not c.reply_to:
+            if c_id not in threads:
+                threads[c_id] = []
+            continue
+        p_id = c.reply_to.id()
+        if p_id in threads:
+            threads[p_id].insert(0, c_id)
+        else:
+            threads[p_id] = [c_id]
+    result = []
+    for p_id, replies in threads.iteritems():
+        if p_id not in comments_by_id:
+            logging.error('Could not find parent %r (%d replies)', p_id, len(replies))
+            continue
+        result.append(comments_by_id[p_id])
+        result.extend(comments_by_id[c_id] for c_id in replies)
+    return result
+
+
 @ndb.tasklet
 def _upload_to_youtube_async(creator, content):
     auth = yield creator.get_auth_key('youtube').get_async()
@@ -7,13 +7,14 @@ import json
 import logging
 import re
 
-from google.appengine.api import taskqueue, urlfetch
+from google.appengine.api import memcache, taskqueue, urlfetch
+from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
 import feedparser
 from flask import Flask, request
 
-from roger import accounts, config, files, models, slack_api
+from roger import accounts, config, files, ledger, models, slack_api
 from roger.apps import utils
 from roger_common import bigquery_api, convert, flask_extras
 
@@ -225,15 +226,95 @@ bigquery_client = bigquery_api.BigQueryClient.for_appengine(
     )
 
 
+@app.route('/_ah/cron/audit_wallets', methods=['GET', 'POST'])
+def audit_wallets():
+    """Verify the transaction chain of every wallet that changed recently."""
+    if request.method == 'GET':
+        threshold = datetime.utcnow() - config.WALLET_AUDIT_WINDOW
+        q = models.Wallet.query(models.Wallet.updated > threshold)
+        tasks = [taskqueue.Task(method='POST', url=request.path, params={'wallet_id': k.id()})
+                 for k in q.iter(keys_only=True)]
+        queue = taskqueue.Queue(config.INTERNAL_QUEUE)
+        for i in xrange(0, len(tasks), 100):
+            queue.add(tasks[i:i+100])
+        logging.debug('Scheduled %d wallet audit(s)', len(tasks))
+        return ''
+    wallet_key = models.Wallet.key_from_id(request.form['wallet_id'])
+    state, done, problems = ledger.audit(wallet_key, limit=config.WALLET_AUDIT_LIMIT)
+    if problems:
+        slack_api.message(channel='#review', hook_id='reactioncam',
+                          text='Wallet `%s` failed its ledger audit (%d problem(s))' % (
+                              wallet_key.id(), len(problems)))
+    elif not done:
+        # Continue from the checkpoint that was just written.
+        taskqueue.add(method='POST', url=request.path, params={'wallet_id': wallet_key.id()},
+                      queue_name=config.INTERNAL_QUEUE)
+    logging.debug('Audited %d transaction(s) for wallet %r', state.tx_count, wallet_key.id())
+    return ''
+
+
+@app.route('/_ah/cron/compact_account_events', methods=['GET', 'POST'])
+def compact_account_events():
+    """Pack old account events into one entity per account and day."""
+    cutoff = datetime.utcnow() - config.ACCOUNT_EVENTS_COMPACT_AGE
+    if request.method == 'GET':
+        # Find the accounts that have events old enough to be compacted.
+        q = models.AccountEvent.query(models.AccountEvent.timestamp < cutoff)
+        keys = q.fetch(config.ACCOUNT_EVENTS_COMPACT_SCAN, keys_only=True)
+        account_ids = set(k.parent().id() for k in keys)
+        tasks = [taskqueue.Task(method='POST', url=request.path, params={'account_id': i})
+                 for i in account_ids]
+        queue = taskqueue.Queue(config.INTERNAL_QUEUE)
+        for i in xrange(0, len(tasks), 100):
+            queue.add(tasks[i:i+100])
+        logging.debug('Scheduled event compaction for %d account(s)', len(tasks))
+        return ''
+    account_key = ndb.Key('Account', int(request.form['account_id']))
+    q = models.AccountEvent.query(models.AccountEvent.timestamp < cutoff, ancestor=account_key)
+    q = q.order(models.AccountEvent.timestamp)
+    keys = q.fetch(config.ACCOUNT_EVENTS_COMPACT_BATCH, keys_only=True)
+    if not keys:
+        return ''
+    count = models.AccountEventDay.compact(account_key, keys)
+    logging.debug('Compacted %d event(s) with %d item(s) for account %d',
+                  len(keys), count, account_key.id())
+    if len(keys) == config.ACCOUNT_EVENTS_COMPACT_BATCH:
+        # There may be more events to compact for this account.
+        taskqueue.add(method='POST', url=request.path, params={'account_id': account_key.id()},
+                      queue_name=config.INTERNAL_QUEUE)
+    return ''
+
+
 @app.route('/_ah/cron/create_deletion_jobs', methods=['GET'])
 def delete_expired_chunks():
     # The latest possible timestamp for expired chunks.
-    delete_before = convert.unix_timestamp(datetime.utcnow() - config.CHUNK_MAX_AGE)
-    taskqueue.add(
-        method='GET',
-        url='/_ah/jobs/delete_chunks',
-        params={'delete_before': delete_before},
-        queue_name=config.DELETE_CHUNKS_QUEUE_NAME)
+    threshold = datetime.utcnow() - config.CHUNK_MAX_AGE
+    q = models.Chunk.query(models.Chunk.persist == False).order(models.Chunk.end)
+    oldest = q.get()
+    if not oldest or oldest.end >= threshold:
+        logging.info('There are no expired chunks to delete')
+        return ''
+    logging.info('Oldest expired chunk ended %s before the deletion threshold',
+                 threshold - oldest.end)
+    # Split the expired time range into slices that can be deleted in parallel.
+    delete_after = convert.unix_timestamp(oldest.end)
+    delete_before = convert.unix_timestamp(threshold)
+    step = (delete_before - delete_after) // config.DELETE_CHUNKS_SLICES + 1
+    run = str(delete_before)
+    tasks = []
+    for start in xrange(delete_after, delete_before, step):
+        tasks.append(taskqueue.Task(
+            method='GET',
+            url='/_ah/jobs/delete_chunks',
+            params={
+                'cleanup_storage': 'true' if config.DELETE_CHUNKS_CLEANUP_STORAGE else 'false',
+                'delete_after': start,
+                'delete_before': min(start + step, delete_before),
+                'run': run,
+            }))
+    memcache.set('delete_chunks_%s_slices' % (run,), len(tasks), time=86400)
+    taskqueue.Queue(config.DELETE_CHUNKS_QUEUE_NAME).add(tasks)
+    logging.info('Scheduled %d chunk deletion slice(s) for run %s', len(tasks), run)
     return ''
 
 
@@ -364,6 +445,36 @@ def report_to_bigquery():
     return ''
 
 
+@app.route('/_ah/cron/rerank_content', methods=['GET', 'POST'])
+def rerank_content():
+    """Decay the sort index of recent content that has stopped getting new bonuses."""
+    if request.method == 'GET':
+        # The cutoff is fixed for the whole run since cursors only work for the same query.
+        created_after = convert.unix_timestamp(datetime.utcnow() - config.CONTENT_RERANK_AGE)
+        taskqueue.add(method='POST', url=request.path, params={'created_after': created_after},
+                      queue_name=config.INTERNAL_QUEUE)
+        return ''
+    now = datetime.utcnow()
+    created_after = int(request.form['created_after'])
+    q = models.Content.query(models.Content.created >= datetime.utcfromtimestamp(created_after))
+    cursor = datastore_query.Cursor(urlsafe=request.form.get('cursor'))
+    content_list, next_cursor, more = q.fetch_page(config.CONTENT_RERANK_PAGE_SIZE,
+                                                   start_cursor=cursor)
+    ranks = models.Content.decay_sort_indexes(content_list, now)
+    # Only write the content that moved enough, with a fresh read in a transaction.
+    futures = [models.Content.rerank_async(c.key, now=now,
+                                           min_change=config.CONTENT_RERANK_MIN_CHANGE)
+               for c, (sort_index, _) in zip(content_list, ranks)
+               if c.sort_index - sort_index > config.CONTENT_RERANK_MIN_CHANGE]
+    updated = sum(1 for f in futures if f.get_result())
+    logging.debug('Reranked %d of %d content', updated, len(content_list))
+    if more and next_cursor:
+        taskqueue.add(method='POST', url=request.path,
+                      params={'created_after': created_after, 'cursor': next_cursor.urlsafe()},
+                      queue_name=config.INTERNAL_QUEUE)
+    return ''
+
+
 @app.route('/_ah/cron/update_content_requests', methods=['GET'])
 def update_content_requests():
     tags = {'approved', 'default'}
@@ -373,6 +484,8 @@ def update_content_requests():
     q = q.order(-models.ContentRequestPublic.sort_index)
     futures = []
     delay = 0
+    # Identifies this run in the names of the page tasks it chains.
+    run = str(convert.unix_timestamp(datetime.utcnow()))
     for request in q:
         # TODO: Improved condition to avoid checking depleted requests.
         # TODO: Add way to manually update content request entries when request is closed.
@@ -383,10 +496,11 @@ def update_content_requests():
             url='/_ah/jobs/update_content_request_entries',
             params={
                 'request_id': str(request.key.id()),
+                'run': run,
                 'wallet_id': str(request.wallet.id()),
                 'wallet_owner_id': str(request.wallet_owner.id()),
             },
-            retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0))
+            retry_options=taskqueue.TaskRetryOptions(task_retry_limit=3))
         futures.append(_add_task_async(task, queue_name=config.INTERNAL_QUEUE))
         delay += 5
     _wait_all(futures)
@@ -394,6 +508,37 @@ def update_content_requests():
     return ''
 
 
+@app.route('/_ah/cron/update_top_accounts', methods=['GET', 'POST'])
+def update_top_accounts():
+    """Precompute the top accounts leaderboards so the API never has to query BigQuery."""
+    TAS = models.TopAccountsSnapshot
+    # Schedule an update for every leaderboard that is out of date.
+    if request.method == 'GET':
+        keys = [TAS.make_key(c) for c in TAS.CATEGORIES]
+        pairs = zip(keys, ndb.get_multi(keys))
+        # Keep updating tag leaderboards that have been requested recently.
+        threshold = datetime.utcnow() - config.TOP_ACCOUNTS_TAG_TTL
+        pairs.extend((s.key, s) for s in TAS.query(TAS.requested > threshold))
+        tasks = []
+        for key, snapshot in pairs:
+            if snapshot and snapshot.is_current:
+                continue
+            category, _, tag = key.id().partition(':')
+            tasks.append(taskqueue.Task(method='POST', url=request.path,
+                                        params={'category': category, 'tag': tag}))
+        queue = taskqueue.Queue(config.INTERNAL_QUEUE)
+        for i in xrange(0, len(tasks), 100):
+            queue.add(tasks[i:i+100])
+        logging.debug('Scheduled %d top accounts update(s)', len(tasks))
+        return ''
+    category = request.form['category']
+    tag = request.form.get('tag') or None
+    # Note: If this fails the previous snapshot will keep being served.
+    utils.update_top_accounts_snapshot(category, tag,
+                                       requested=flask_extras.get_flag('requested'))
+    return ''
+
+
 @app.route('/_ah/cron/update_top_creators', methods=['GET'])
 def update_top_creators():
     account_keys = [ndb.Key('Account', aid) for aid in config.TOP_CREATOR_IDS]
@@ -2,12 +2,13 @@
 
 from collections import defaultdict
 from datetime import datetime, timedelta
+import hashlib
 import json
 import logging
 import re
 import urllib
 
-from google.appengine.api import search, taskqueue, urlfetch
+from google.appengine.api import memcache, search, taskqueue, urlfetch
 from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
@@ -15,8 +16,8 @@ from flask import Flask, request
 import pytz
 import twitter
 
-from roger import accounts, config, files, localize, models
-from roger import notifs, slack_api, streams, youtube
+from roger import accounts, chat, comments, config, files, localize, models
+from roger import notifs, slack_api, streams, threads, timelines, youtube
 from roger.apps import utils
 from roger_common import convert, errors, events, flask_extras, identifiers, random
 
@@ -91,6 +92,134 @@ def announce_team_join():
     return ''
 
 
+@app.route('/_ah/jobs/backfill_comment_reply_counts', methods=['POST'])
+def backfill_comment_reply_counts():
+    """Stores reply counts on top-level comments that predate the count."""
+    cursor = datastore_query.Cursor(urlsafe=request.form.get('cursor'))
+    q = models.ContentComment.query(models.ContentComment.reply_to == None)
+    comment_keys, next_cursor, more = q.fetch_page(100, keys_only=True, start_cursor=cursor)
+    futures = []
+    if more:
+        task = taskqueue.Task(
+            url='/_ah/jobs/backfill_comment_reply_counts',
+            params={'cursor': next_cursor.urlsafe()})
+        futures.append(_add_task_async(task, queue_name=config.INTERNAL_QUEUE))
+    futures.extend(comments.recount_replies_async(k) for k in comment_keys)
+    _wait_all(futures)
+    logging.debug('Recounted replies to %d comment(s)', len(comment_keys))
+    return ''
+
+
+@app.route('/_ah/jobs/backfill_request_rewards', methods=['POST'])
+def backfill_request_rewards():
+    """Copies the balance of reward wallets onto requests that predate the reward property."""
+    cursor = datastore_query.Cursor(urlsafe=request.form.get('cursor'))
+    q = models.ContentRequestPublic.query()
+    request_list, next_cursor, more = q.fetch_page(100, start_cursor=cursor)
+    futures = []
+    if more:
+        task = taskqueue.Task(
+            url='/_ah/jobs/backfill_request_rewards',
+            params={'cursor': next_cursor.urlsafe()})
+        futures.append(_add_task_async(task, queue_name=config.INTERNAL_QUEUE))
+    request_list = [r for r in request_list if not r.has_reward]
+    wallets = ndb.get_multi([r.wallet for r in request_list])
+    for r, wallet in zip(request_list, wallets):
+        if not wallet:
+            logging.warning('Request %d has a missing wallet', r.key.id())
+            continue
+        version = wallet.total_received + wallet.total_sent
+        futures.append(models.ContentRequestPublic.set_reward_async(r.key, wallet.balance, version))
+    _wait_all(futures)
+    logging.debug('Backfilled rewards for %d request(s)', len(request_list))
+    return ''
+
+
+@app.route('/_ah/jobs/backfill_thread_inboxes', methods=['POST'])
+def backfill_thread_inboxes():
+    """Creates inbox entries for threads that were created before inboxes existed."""
+    cursor = datastore_query.Cursor(urlsafe=request.form.get('cursor'))
+    q = models.Thread.query()
+    thread_list, next_cursor, more = q.fetch_page(config.THREAD_INBOX_BACKFILL_PAGE_SIZE,
+                                                  start_cursor=cursor)
+    futures = []
+    if more:
+        task = taskqueue.Task(
+            url='/_ah/jobs/backfill_thread_inboxes',
+            params={'cursor': next_cursor.urlsafe()})
+        futures.append(_add_task_async(task, queue_name=config.INTERNAL_QUEUE))
+    for thread in thread_list:
+        futures.extend(models.ThreadInboxEntry.add_from_thread_async(a.account, thread)
+                       for a in thread.accounts)
+    _wait_all(futures)
+    logging.debug('Backfilled inboxes for %d thread(s)', len(thread_list))
+    return ''
+
+
+@app.route('/_ah/jobs/backfill_timelines', methods=['POST'])
+def backfill_timelines():
+    """Copies recent content by followed accounts into the timelines of their followers."""
+    cursor = datastore_query.Cursor(urlsafe=request.form.get('cursor'))
+    q = models.AccountFollow.query()
+    follows, next_cursor, more = q.fetch_page(config.TIMELINE_BACKFILL_PAGE_SIZE,
+                                              start_cursor=cursor)
+    futures = []
+    if more:
+        task = taskqueue.Task(
+            url='/_ah/jobs/backfill_timelines',
+            params={'cursor': next_cursor.urlsafe()})
+        futures.append(_add_task_async(task, queue_name=config.INTERNAL_QUEUE))
+    creators = ndb.get_multi(list(set(f.account for f in follows)))
+    lookup = {c.key: c for c in creators if c}
+    for follow in follows:
+        creator = lookup.get(follow.account)
+        if not creator:
+            continue
+        futures.append(timelines.add_recent_content_async(follow.key.parent(), creator))
+    _wait_all(futures)
+    logging.debug('Backfilled timelines for %d follow(s)', len(follows))
+    return ''
+
+
+@app.route('/_ah/jobs/backfill_top_reactions', methods=['POST'])
+def backfill_top_reactions():
+    """Computes the top reactions of originals that predate them."""
+    cursor = datastore_query.Cursor(urlsafe=request.form.get('cursor'))
+    q = models.Content.query(models.Content.tags == 'original')
+    content_list, next_cursor, more = q.fetch_page(100, start_cursor=cursor)
+    futures = []
+    if more:
+        task = taskqueue.Task(
+            url='/_ah/jobs/backfill_top_reactions',
+            params={'cursor': next_cursor.urlsafe()})
+        futures.append(_add_task_async(task, queue_name=config.INTERNAL_QUEUE))
+    pending = [c for c in content_list if not c.top_reactions_updated]
+    futures.extend(models.Content.update_top_reactions_async(c.key) for c in pending)
+    _wait_all(futures)
+    logging.debug('Backfilled top reactions of %d/%d original(s)', len(pending), len(content_list))
+    return ''
+
+
+@app.route('/_ah/jobs/backfill_wallet_payments', methods=['POST'])
+def backfill_wallet_payments():
+    """Adds transactions that predate the payment feed to it."""
+    cursor = datastore_query.Cursor(urlsafe=request.form.get('cursor'))
+    q = models.WalletTransaction.query(models.WalletTransaction.delta > 0)
+    tx_list, next_cursor, more = q.fetch_page(500, start_cursor=cursor)
+    futures = []
+    if more:
+        task = taskqueue.Task(
+            url='/_ah/jobs/backfill_wallet_payments',
+            params={'cursor': next_cursor.urlsafe()})
+        futures.append(_add_task_async(task, queue_name=config.INTERNAL_QUEUE))
+    # Payments use the id of their transaction so running this again is harmless.
+    payments = filter(None, map(models.WalletPayment.from_transaction, tx_list))
+    futures.extend(ndb.put_multi_async(payments))
+    _wait_all(futures)
+    logging.debug('Backfilled %d payment(s) from %d transaction(s)', len(payments), len(tx_list))
+    return ''
+
+
 @app.route('/_ah/jobs/chat_announce', methods=['POST'])
 def chat_announce():
     owner_id = int(request.form['owner_id'])
@@ -98,10 +227,8 @@ def chat_announce():
     text = request.form['text']
     cursor = datastore_query.Cursor(urlsafe=request.form.get('cursor'))
     owner_key = ndb.Key('Account', owner_id)
-    owner_future = owner_key.get_async()
     keys, next_cursor, more = models.AccountFollow.fetch_followers_page(
-        owner_key, 50, keys_only=True, start_cursor=cursor)
-    owner = owner_future.get_result()
+        owner_key, config.CHAT_ANNOUNCE_PAGE_SIZE, keys_only=True, start_cursor=cursor)
     futures = []
     if more:
         task = taskqueue.Task(
@@ -112,10 +239,59 @@ def chat_announce():
                     'cursor': next_cursor.urlsafe()},
             retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0))
         futures.append(_add_task_async(task, queue_name=config.INTERNAL_QUEUE))
-    logging.debug('Notifying %d/%d followers that %d is on chat: %r',
-        len(keys), owner.follower_count, owner_id, text)
-    futures.extend(_notify_follower_chat_async(k, owner, channel_id, text) for k in keys)
+    # The followers are notified in batches by tasks that run in parallel.
+    futures.append(chat.schedule_delivery_async(notifs.ON_CHAT_OWNER_JOIN, keys, owner_key,
+                                                channel_id, text))
     _wait_all(futures)
+    logging.debug('Scheduled notifying %d followers that %d is on chat: %r',
+                  len(keys), owner_id, text)
+    return ''
+
+
+@app.route('/_ah/jobs/chat_deliver', methods=['POST'])
+def chat_deliver():
+    account_keys = [ndb.Key('Account', int(i)) for i in request.form['account_ids'].split(',')]
+    event_name = request.form['event_name']
+    owner_future = ndb.Key('Account', int(request.form['owner_id'])).get_async()
+    sender_id = request.form.get('sender_id')
+    sender = ndb.Key('Account', int(sender_id)).get() if sender_id else None
+    owner = owner_future.get_result()
+    if not owner:
+        logging.warning('Chat owner %s no longer exists', request.form['owner_id'])
+        return ''
+    delivered = chat.deliver_async(event_name, account_keys, owner,
+                                   request.form['channel_id'], request.form['text'],
+                                   sender=sender).get_result()
+    logging.debug('Delivered %s to %d/%d account(s)', event_name, delivered, len(account_keys))
+    return ''
+
+
+@app.route('/_ah/jobs/chat_mentions', methods=['POST'])
+def chat_mentions():
+    channel_id = request.form['channel_id']
+    owner_key = ndb.Key('Account', int(request.form['owner_id']))
+    sender_key = ndb.Key('Account', int(request.form['sender_id']))
+    text = request.form['text']
+    events = chat.resolve_mentions_async(sender_key, text,
+                                         request.form.getlist('identifier')).get_result()
+    keys_by_event = defaultdict(list)
+    for account_key, event_name in events.iteritems():
+        keys_by_event[event_name].append(account_key)
+    if len(events) > config.CHAT_DELIVERY_BATCH_SIZE:
+        _wait_all([chat.schedule_delivery_async(e, keys, owner_key, channel_id, text,
+                                                sender_key=sender_key)
+                   for e, keys in keys_by_event.iteritems()])
+        logging.debug('Scheduled notifying %d account(s) of chat message by %d',
+                      len(events), sender_key.id())
+        return ''
+    # Few enough accounts to notify right away.
+    owner, sender = ndb.get_multi([owner_key, sender_key])
+    if not owner:
+        logging.warning('Chat owner %d no longer exists', owner_key.id())
+        return ''
+    _wait_all([chat.deliver_async(e, keys, owner, channel_id, text, sender=sender)
+               for e, keys in keys_by_event.iteritems()])
+    logging.debug('Notified %d account(s) of chat message by %d', len(events), sender_key.id())
     return ''
 
 
@@ -245,9 +421,13 @@ def content_comment_extras():
     interested_keys.discard(commenter_key)
     interested_keys.discard(creator_key)
     interested_keys.discard(None)
-    # Notify away!
     content = content_future.get_result()
     futures = []
+    # Hashtags in the comment are added as tags on the content.
+    hashtags = set(re.findall('#(\\w+)', comment.text))
+    if content and hashtags:
+        futures.append(_add_content_tags_async(content_key, hashtags))
+    # Notify away!
     for account_key in interested_keys:
         hub = notifs.Hub(account_key)
         futures.append(hub.emit_async(notifs.ON_CONTENT_COMMENT,
@@ -258,7 +438,7 @@ def content_comment_extras():
         try:
             f.get_result()
         except:
-            logging.exception('Failed to notify an account.')
+            logging.exception('Failed to update content or notify an account.')
     return ''
 
 
@@ -289,6 +469,10 @@ def content_followers():
     logging.debug('Notifying %d/%d followers about content %d by %d',
         len(keys), creator.follower_count, content_id, creator_id)
     futures.extend(_notify_follower_content_async(k, creator, content) for k in keys)
+    if not timelines.is_large_creator(creator):
+        futures.append(models.AccountTimelineEntry.add_async(keys, content))
+    elif not creator.timeline_merged:
+        futures.append(timelines.mark_large_creator_async(creator_key))
     _wait_all(futures)
     return ''
 
@@ -470,22 +654,73 @@ def recount_reactions():
 
 @app.route('/_ah/jobs/delete_chunks')
 def delete_chunks():
+    """Deletes the expired chunks in one time slice, continuing in a new task if needed."""
     cursor = datastore_query.Cursor(urlsafe=request.args.get('cursor'))
+    cleanup_storage = request.args.get('cleanup_storage') == 'true'
+    delete_after = int(request.args.get('delete_after') or 0)
     delete_before = int(request.args['delete_before'])
-    threshold = datetime.utcfromtimestamp(delete_before)
-    query = models.Chunk.query(models.Chunk.end < threshold,
+    run = request.args.get('run')
+    query = models.Chunk.query(models.Chunk.end >= datetime.utcfromtimestamp(delete_after),
+                               models.Chunk.end < datetime.utcfromtimestamp(delete_before),
                                models.Chunk.persist == False)
-    keys, next_cursor, more = query.fetch_page(1000, keys_only=True, start_cursor=cursor)
-    if next_cursor and more:
-        # There are still more chunks to delete after this batch.
+    deadline = datetime.utcnow() + config.DELETE_CHUNKS_TASK_TIME
+    deleted = 0
+    queued = 0
+    futures = []
+    more = True
+    while more:
+        # Storage cleanup needs the payload so only load full chunks in that case.
+        page, cursor, more = query.fetch_page(config.DELETE_CHUNKS_BATCH_SIZE,
+                                              keys_only=not cleanup_storage,
+                                              start_cursor=cursor)
+        if cleanup_storage:
+            keys = [c.key for c in page]
+            # Queue the files before their chunks are deleted so that no path can be lost.
+            paths = [c.payload for c in page if c.payload and files.is_shortlived(c.payload)]
+            tasks = [taskqueue.Task(url='/_ah/jobs/delete_files', params={'path': paths[i:i+100]})
+                     for i in xrange(0, len(paths), 100)]
+            _add_task_list_async(tasks, queue_name=config.DELETE_CHUNKS_QUEUE_NAME).get_result()
+            queued += len(paths)
+        else:
+            keys = page
+        # Let the previous batch finish deleting while the next one is being fetched.
+        _wait_all(futures)
+        futures = ndb.delete_multi_async(keys)
+        deleted += len(keys)
+        if more and datetime.utcnow() > deadline:
+            break
+    _wait_all(futures)
+    if more:
+        # There are still more chunks to delete in this slice.
         taskqueue.add(
             method='GET',
             url='/_ah/jobs/delete_chunks',
-            params={'cursor': next_cursor.urlsafe(), 'delete_before': delete_before},
+            params={
+                'cleanup_storage': 'true' if cleanup_storage else 'false',
+                'cursor': cursor.urlsafe(),
+                'delete_after': delete_after,
+                'delete_before': delete_before,
+                'run': run,
+            },
             queue_name=config.DELETE_CHUNKS_QUEUE_NAME)
-    # Delete the chunks.
-    ndb.delete_multi(keys)
-    logging.info('Deleted %d expired chunks', len(keys))
+    logging.info('Deleted %d expired chunks (%d files queued for deletion)', deleted, queued)
+    if not run:
+        return ''
+    total = memcache.incr('delete_chunks_%s_deleted' % (run,), deleted, initial_value=0)
+    if not more and memcache.decr('delete_chunks_%s_slices' % (run,)) == 0:
+        # The run id is the deletion threshold, which was CHUNK_MAX_AGE before the run started.
+        started = datetime.utcfromtimestamp(int(run)) + config.CHUNK_MAX_AGE
+        logging.info('Deletion run %s deleted %d chunks in %s',
+                     run, total or 0, datetime.utcnow() - started)
+    return ''
+
+
+@app.route('/_ah/jobs/delete_files', methods=['POST'])
+def delete_files():
+    paths = request.form.getlist('path')
+    for path in paths:
+        files.delete(path)
+    logging.info('Deleted %d short-lived files', len(paths))
     return ''
 
 
@@ -766,6 +1001,15 @@ def notify_batch():
     return ''
 
 
+@app.route('/_ah/jobs/prefetch_thread_messages', methods=['POST'])
+def prefetch_thread_messages():
+    thread_id = request.form['thread_id']
+    cursor_urlsafe = request.form['cursor']
+    limit = int(request.form['limit'])
+    threads.prefetch_page(thread_id, cursor_urlsafe, limit)
+    return ''
+
+
 @app.route('/_ah/jobs/set_up_new_service', methods=['GET'])
 def set_up_new_service():
     # Extract all parameters from the request.
@@ -816,6 +1060,75 @@ def set_quality():
     return ''
 
 
+@app.route('/_ah/jobs/settle_wallet_payouts', methods=['POST'])
+def settle_wallet_payouts():
+    """Pays out all queued rewards for a wallet in as few transactions as possible."""
+    wallet_id = flask_extras.get_parameter('wallet_id')
+    wallet_key = models.Wallet.key_from_id(wallet_id)
+    try:
+        q = taskqueue.Queue(config.WALLET_PAYOUT_QUEUE_NAME)
+        tasks = q.lease_tasks_by_tag(config.WALLET_PAYOUT_LEASE_TIME.total_seconds(),
+                                     config.WALLET_PAYOUT_LEASE_AMOUNT,
+                                     tag=wallet_id)
+        logging.debug('Leased %d payout(s) for wallet %r', len(tasks), wallet_id)
+    except taskqueue.TransientError:
+        logging.warning('Could not lease payouts due to transient error')
+        return '', 503
+    if not tasks:
+        return ''
+    # Multiple payouts may have been queued for the same entry, only pay it once.
+    payouts = {}
+    for task in tasks:
+        payout = json.loads(task.payload)
+        payouts[payout['entry_id']] = payout
+    wallet_owner_key = ndb.Key('Account', payouts.values()[0]['wallet_owner_id'])
+    entry_keys = [ndb.Key('ContentRequestPublicEntry', p['entry_id']) for p in payouts.itervalues()]
+    content_keys = [ndb.Key('Content', p['content_id']) for p in payouts.itervalues()]
+    entries = [(k, c) for k, c in zip(entry_keys, ndb.get_multi(content_keys)) if c]
+    futures = []
+    batch_size = models.ContentRequestPublicEntry.REWARD_BATCH_SIZE
+    # All batches pay out of the same wallet so they have to run one after the other.
+    for i in xrange(0, len(entries), batch_size):
+        batch = entries[i:i+batch_size]
+        future = models.ContentRequestPublicEntry.reward_multi_async(batch, wallet_owner_key, wallet_key)
+        for (entry_key, _), amount in zip(batch, future.get_result()):
+            if not amount:
+                continue
+            # Tell app to update if user is looking at the request.
+            request_id, account_id = models.ContentRequestPublicEntry.split_key(entry_key)
+            hub = notifs.Hub(ndb.Key('Account', account_id))
+            futures.append(hub.emit_async(notifs.ON_PUBLIC_REQUEST_UPDATE, request_id=request_id))
+    _wait_all(futures)
+    # Delete the tasks now that we're done with them.
+    q.delete_tasks(tasks)
+    if len(tasks) == config.WALLET_PAYOUT_LEASE_AMOUNT:
+        # There may be more payouts waiting in the queue.
+        _schedule_wallet_payouts(wallet_key)
+    return ''
+
+
+@app.route('/_ah/jobs/timeline_follow', methods=['POST'])
+def timeline_follow():
+    account_key = ndb.Key('Account', int(request.form['account_id']))
+    creator = ndb.Key('Account', int(request.form['creator_id'])).get()
+    if not creator:
+        return ''
+    count = timelines.add_recent_content_async(account_key, creator).get_result()
+    logging.debug('Added %d content by %d to the timeline of %d',
+        count, creator.key.id(), account_key.id())
+    return ''
+
+
+@app.route('/_ah/jobs/timeline_unfollow', methods=['POST'])
+def timeline_unfollow():
+    account_key = ndb.Key('Account', int(request.form['account_id']))
+    creator_key = ndb.Key('Account', int(request.form['creator_id']))
+    count = timelines.remove_creator_async(account_key, creator_key).get_result()
+    logging.debug('Removed %d content by %d from the timeline of %d',
+        count, creator_key.id(), account_key.id())
+    return ''
+
+
 @app.route('/_ah/jobs/track_login', methods=['POST'])
 def track_login():
     account_key = models.Account.resolve_key(request.form['account_id'])
@@ -874,55 +1187,60 @@ def track_login():
 
 @app.route('/_ah/jobs/update_content_request_entries', methods=['POST'])
 def update_content_request_entries():
+    """Rewards one page of active entries and chains a task for the next page."""
     request_id = int(flask_extras.get_parameter('request_id'))
+    run = flask_extras.get_parameter('run') or ''
     wallet_id = flask_extras.get_parameter('wallet_id')
     assert wallet_id
+    wallet_key = models.Wallet.key_from_id(wallet_id)
     wallet_owner_id = int(flask_extras.get_parameter('wallet_owner_id'))
+    wallet_owner_key = ndb.Key('Account', wallet_owner_id)
+    cursor = datastore_query.Cursor(urlsafe=request.form.get('cursor'))
     request_key = ndb.Key('ContentRequestPublic', request_id)
     q = models.ContentRequestPublicEntry.query()
     q = q.filter(models.ContentRequestPublicEntry.request == request_key)
     q = q.filter(models.ContentRequestPublicEntry.status == 'active')
     q = q.order(-models.ContentRequestPublicEntry.created)
-    futures = []
-    tasks = []
-    job_count = 0
-    delay = 10  # 10 seconds to allow YouTube update to finish.
-    content_ids = []
-    for entry in q:
+    entries, next_cursor, more = q.fetch_page(config.CONTENT_REQUEST_ENTRIES_PAGE_SIZE,
+                                              start_cursor=cursor)
+    if more:
+        # The task name makes retries of this page safe to schedule the next page again.
+        name = 'update-entries-%d-%s-%s' % (request_id, run,
+                                            hashlib.md5(next_cursor.urlsafe()).hexdigest())
         task = taskqueue.Task(
-            countdown=delay,
-            url='/_ah/jobs/update_content_request_entry',
+            name=name,
+            url='/_ah/jobs/update_content_request_entries',
             params={
-                'account_id': str(entry.account.id()),
-                'content_id': str(entry.content.id()),
-                'request_id': str(entry.request.id()),
+                'cursor': next_cursor.urlsafe(),
+                'request_id': str(request_id),
+                'run': run,
                 'wallet_id': wallet_id,
                 'wallet_owner_id': str(wallet_owner_id),
-                'youtube_id': entry.youtube_id,
             },
-            retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0))
-        tasks.append(task)
-        if len(tasks) == 100:
-            futures.append(_add_task_list_async(tasks, queue_name=config.INTERNAL_QUEUE))
-            tasks = []
-        delay += 1
-        job_count += 1
-        content_ids.append(entry.content.id())
-    del q, task, tasks
-    if content_ids:
-        # Update YouTube views on all content ids.
-        futures.append(_update_youtube_views_async(content_ids))
-        job_count += 1
-    del content_ids
-    _wait_all(futures)
-    logging.debug('Scheduled %d update job(s) for request %d', job_count, request_id)
+            retry_options=taskqueue.TaskRetryOptions(task_retry_limit=3))
+        try:
+            task.add(queue_name=config.INTERNAL_QUEUE)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+    if not entries:
+        return ''
+    # Update YouTube views on the content of this page before checking for rewards.
+    content_keys = [e.content for e in entries]
+    _update_youtube_views_async([k.id() for k in content_keys]).get_result()
+    payouts = []
+    for entry, content in zip(entries, ndb.get_multi(content_keys)):
+        if content and _should_reward_content(content):
+            payouts.append((entry.key, content.key))
+    if payouts:
+        # All entries of a request are paid by the same wallet.
+        _queue_wallet_payouts(wallet_key, wallet_owner_key, payouts)
+    logging.debug('Queued %d/%d payout(s) for request %d', len(payouts), len(entries), request_id)
     return ''
 
 
 @app.route('/_ah/jobs/update_content_request_entry', methods=['POST'])
 def update_content_request_entry():
     account_id = int(flask_extras.get_parameter('account_id'))
-    account_key = ndb.Key('Account', account_id)
     content_id = int(flask_extras.get_parameter('content_id'))
     content_key = ndb.Key('Content', content_id)
     request_id = int(flask_extras.get_parameter('request_id'))
@@ -939,21 +1257,12 @@ def update_content_request_entry():
     # Load the content outside of a transaction.
     content = content_key.get()
     assert content
-    last_update = content.youtube_views_updated
-    if not content.youtube_broken and last_update and not force_update:
-        skip = (datetime.utcnow() - last_update) > timedelta(minutes=20)
-    else:
-        skip = False
-    if skip:
+    if not force_update and not _should_reward_content(content):
         # Assume that there is no new info to deal with to save ourselves a transaction.
         logging.debug('YouTube views did not change recently, skipping update')
         return ''
-    future = models.ContentRequestPublicEntry.reward_async(entry_key, content, wallet_owner_key, wallet_key)
-    amount = future.get_result()
-    if amount:
-        # Tell app to update if user is looking at the request.
-        hub = notifs.Hub(account_key)
-        hub.emit(notifs.ON_PUBLIC_REQUEST_UPDATE, request_id=request_id)
+    # Queue the payout so that all entries paid by this wallet settle in a few transactions.
+    _queue_wallet_payouts(wallet_key, wallet_owner_key, [(entry_key, content_key)])
     return ''
 
 
@@ -1066,6 +1375,20 @@ def update_youtube_views_batched():
     return ''
 
 
+@ndb.transactional_tasklet
+def _add_content_tags_async(content_key, tags):
+    content = yield content_key.get_async()
+    if not content:
+        return
+    old_tags = set(content.tags)
+    content.add_tags(tags)
+    new_tags = set(content.tags) - old_tags
+    if not new_tags:
+        return
+    logging.debug('Added tags from comment: %s', ', '.join(new_tags))
+    yield content.put_async()
+
+
 @ndb.tasklet
 def _add_task_async(task, **kwargs):
     yield task.add_async(**kwargs)
@@ -1074,7 +1397,8 @@ def _add_task_async(task, **kwargs):
 @ndb.tasklet
 def _add_task_list_async(tasks, queue_name=None):
     queue = taskqueue.Queue(queue_name) if queue_name else taskqueue.Queue()
-    yield queue.add_async(tasks)
+    # Up to 100 tasks can be added per call.
+    yield [queue.add_async(tasks[i:i+100]) for i in xrange(0, len(tasks), 100)]
 
 
 def _create_or_join_channel(account, auth, channel):
@@ -1217,12 +1541,6 @@ def _notify_fb_friends_async(account, access_token):
     raise ndb.Return(len(futures))
 
 
-def _notify_follower_chat_async(account_key, owner, channel_id, text):
-    hub = notifs.Hub(account_key)
-    return hub.emit_async(notifs.ON_CHAT_OWNER_JOIN,
-        channel_id=channel_id, owner=owner, text=text)
-
-
 def _notify_follower_content_async(account_key, creator, content):
     hub = notifs.Hub(account_key)
     return hub.emit_async(notifs.ON_CONTENT_CREATED,
@@ -1293,6 +1611,21 @@ def _put_content_in_search_index(creator, content):
     search.Index('original2').put(document)
 
 
+def _queue_wallet_payouts(wallet_key, wallet_owner_key, payouts):
+    tasks = []
+    for entry_key, content_key in payouts:
+        payload = json.dumps({
+            'content_id': content_key.id(),
+            'entry_id': entry_key.id(),
+            'wallet_owner_id': wallet_owner_key.id(),
+        })
+        tasks.append(taskqueue.Task(method='PULL', tag=wallet_key.id(), payload=payload))
+    queue = taskqueue.Queue(config.WALLET_PAYOUT_QUEUE_NAME)
+    for i in xrange(0, len(tasks), 100):
+        queue.add(tasks[i:i+100])
+    _schedule_wallet_payouts(wallet_key)
+
+
 @ndb.tasklet
 def _recount_content_reactions_async(content_key):
     q = models.Content.query()
@@ -1356,6 +1689,20 @@ def _schedule_requests_async(account):
     yield tuple(futures)
 
 
+def _schedule_wallet_payouts(wallet_key):
+    # Only allow one settle job per wallet per time window.
+    window = convert.unix_timestamp(datetime.utcnow()) // config.WALLET_PAYOUT_DELAY
+    name = 'settle-%s-%d' % (re.sub(r'[^a-zA-Z0-9_-]', '-', wallet_key.id()), window)
+    task = taskqueue.Task(name=name,
+                          countdown=config.WALLET_PAYOUT_DELAY,
+                          url='/_ah/jobs/settle_wallet_payouts',
+                          params={'wallet_id': wallet_key.id()})
+    try:
+        task.add(queue_name=config.INTERNAL_QUEUE)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
 @ndb.tasklet
 def _send_content_requests_async(requester, accounts, content_id, comment=None):
     r, a_keys, c = yield (
@@ -1478,6 +1825,14 @@ def _set_content_thumbnail_async(content_key, thumb_url):
     logging.debug('Set thumbnail for %d: %s', content.key.id(), content.thumb_url)
 
 
+def _should_reward_content(content):
+    last_update = content.youtube_views_updated
+    if content.youtube_broken or not last_update:
+        return True
+    # No views were gained if the views haven't been updated in a while.
+    return (datetime.utcnow() - last_update) <= timedelta(minutes=20)
+
+
 @ndb.transactional_tasklet
 def _update_streak_async(account_key, first=False):
     account = yield account_key.get_async()
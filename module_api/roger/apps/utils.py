@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import calendar
+from datetime import datetime, timedelta
 import json
 import logging
 import re
@@ -7,12 +9,151 @@ import urllib
 import urlparse
 
 from google.appengine.api import taskqueue, urlfetch
+from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
 from flask import g, request
 
 from roger import accounts, auth, bots, config, files, models, streams
-from roger_common import errors, flask_extras, random
+from roger_common import bigquery_api, errors, flask_extras, random
+
+
+KEYSET_TOKEN_PATTERN = re.compile(r'^(-?\d+)\.(\d+)$')
+
+
+QUERY_TOP_ACCOUNTS_FIRST = u"""
+SELECT
+  account_id,
+  COUNT(*) AS score
+FROM
+  roger_reporting.content_first_v1
+WHERE
+  timestamp >= TIMESTAMP("%s") AND
+  timestamp < TIMESTAMP("%s")
+GROUP BY
+  1
+ORDER BY
+  2 DESC
+LIMIT
+  %d
+"""
+
+
+QUERY_TOP_ACCOUNTS_FIRST_TAG = u"""
+SELECT
+  account_id,
+  COUNT(*) AS score
+FROM
+  roger_reporting.content_first_v1
+WHERE
+  tags = "%s" AND
+  timestamp >= TIMESTAMP("%s") AND
+  timestamp < TIMESTAMP("%s")
+GROUP BY
+  1
+ORDER BY
+  2 DESC
+LIMIT
+  %d
+"""
+
+
+QUERY_TOP_ACCOUNTS_PAYMENTS = u"""
+SELECT
+  receiver_id AS account_id,
+  SUM(amount) AS score
+FROM
+  roger_reporting.wallet_payment_v1 p
+WHERE
+  p.receiver_id != p.account_id
+  AND timestamp >= TIMESTAMP("%s")
+  AND timestamp < TIMESTAMP("%s")
+GROUP BY
+  1
+ORDER BY
+  2 DESC
+LIMIT
+  %d
+"""
+
+
+QUERY_TOP_ACCOUNTS_VOTES = u"""
+SELECT
+  creator_id AS account_id,
+  COUNT(*) AS score
+FROM
+  roger_reporting.content_vote_v1
+WHERE
+  account_id != creator_id AND
+  timestamp >= TIMESTAMP("%s") AND
+  timestamp < TIMESTAMP("%s")
+GROUP BY
+  1
+ORDER BY
+  2 DESC
+LIMIT
+  %d
+"""
+
+
+QUERY_TOP_ACCOUNTS_VOTES_TAG = u"""
+SELECT
+  creator_id AS account_id,
+  COUNT(*) AS score
+FROM
+  roger_reporting.content_vote_v1
+WHERE
+  account_id != creator_id AND
+  tags = "%s" AND
+  timestamp >= TIMESTAMP("%s") AND
+  timestamp < TIMESTAMP("%s")
+GROUP BY
+  1
+ORDER BY
+  2 DESC
+LIMIT
+  %d
+"""
+
+
+bigquery_client = bigquery_api.BigQueryClient.for_appengine(
+    project_id=config.BIGQUERY_PROJECT,
+    dataset_id=config.BIGQUERY_DATASET)
+
+
+def fetch_keyset_page(*args, **kwargs):
+    return fetch_keyset_page_async(*args, **kwargs).get_result()
+
+
+@ndb.tasklet
+def fetch_keyset_page_async(q, prop, limit, token=None):
+    """Fetches a page of results from a query sorted by a property (highest first).
+
+    A page starts after the sort value and id of the last result on the previous page,
+    so the same position always gets the same token (and cache key). Datastore cursors
+    that were handed out before tokens existed are still accepted.
+
+    Returns the results and the token for the next page (None if there are no more).
+    """
+    after = _parse_keyset_token(prop, token)
+    if after:
+        value, last_id = after
+        # Results that share a sort value are ordered by key in the index.
+        tied = q.filter(prop == value, ndb.Model._key > ndb.Key(q.kind, last_id))
+        results = yield tied.fetch_async(limit + 1)
+        if len(results) <= limit:
+            older = q.filter(prop < value).order(-prop)
+            results += (yield older.fetch_async(limit + 1 - len(results)))
+        more = len(results) > limit
+    elif token:
+        cursor = datastore_query.Cursor(urlsafe=token)
+        results, _, more = yield q.order(-prop).fetch_page_async(limit, start_cursor=cursor)
+    else:
+        results = yield q.order(-prop).fetch_async(limit + 1)
+        more = len(results) > limit
+    results = results[:limit]
+    next_token = _make_keyset_token(prop, results[-1]) if more and results else None
+    raise ndb.Return((results, next_token))
 
 
 def get_or_create_content(*args, **kwargs):
@@ -261,6 +402,44 @@ def set_up_session(handler, participants=None):
     return session
 
 
+def update_top_accounts_snapshot(category, tag=None, requested=False):
+    """Computes the current window of a top accounts leaderboard from BigQuery and saves
+    it as a snapshot, unless it is already up to date.
+    """
+    TAS = models.TopAccountsSnapshot
+    key = TAS.make_key(category, tag)
+    ts_min, ts_max = TAS.current_window()
+    snapshot = key.get()
+    if snapshot and snapshot.ts_max == ts_max:
+        logging.debug('Top accounts for %s are already up to date', key.id())
+        return snapshot
+    ts_args = (ts_min.strftime('%Y-%m-%d %H:%M'), ts_max.strftime('%Y-%m-%d %H:%M'), 50)
+    if tag:
+        if category == 'first':
+            query = QUERY_TOP_ACCOUNTS_FIRST_TAG
+        elif category == 'votes':
+            query = QUERY_TOP_ACCOUNTS_VOTES_TAG
+        query = query % ((tag.replace('"', '\\"'),) + ts_args)
+    else:
+        if category == 'first':
+            query = QUERY_TOP_ACCOUNTS_FIRST
+        elif category == 'payments':
+            query = QUERY_TOP_ACCOUNTS_PAYMENTS
+        elif category == 'votes':
+            query = QUERY_TOP_ACCOUNTS_VOTES
+        query = query % ts_args
+    logging.debug('Running query:%s', query)
+    rows = [[int(r.account_id), int(r.score)] for r in bigquery_client.query(query).rows()]
+    if not snapshot:
+        snapshot = TAS(key=key, category=category, tag=tag)
+    if requested:
+        snapshot.requested = datetime.utcnow()
+    snapshot.populate(rows=rows, ts_max=ts_max, ts_min=ts_min)
+    snapshot.put()
+    logging.debug('Saved %d top accounts for %s (%s - %s)', len(rows), key.id(), *ts_args[:2])
+    return snapshot
+
+
 def upload_and_send(stream):
     extras = flask_extras.get_flag_dict('allow_duplicate', 'export',
                                         'mute_notification', 'persist')
@@ -339,3 +518,23 @@ def upload_and_send(stream):
     if stream.service_id == 'ifttt' and stream.account.username != 'ifttt':
         ping_ifttt(stream.service_owner or stream.account)
     return True
+
+
+def _make_keyset_token(prop, entity):
+    value = prop._get_value(entity)
+    if isinstance(value, datetime):
+        value = calendar.timegm(value.timetuple()) * 1000000 + value.microsecond
+    return '%d.%d' % (value, entity.key.id())
+
+
+def _parse_keyset_token(prop, token):
+    match = KEYSET_TOKEN_PATTERN.match(token or '')
+    if not match:
+        return None
+    value, key_id = int(match.group(1)), int(match.group(2))
+    if isinstance(prop, ndb.DateTimeProperty):
+        try:
+            value = datetime(1970, 1, 1) + timedelta(microseconds=value)
+        except OverflowError:
+            raise errors.InvalidArgument('Invalid cursor')
+    return value, key_id
@@ -11,7 +11,7 @@ from google.appengine.ext import ndb
 
 from flask import g, has_request_context, request
 
-from roger import config, external, localize, models, proto, services, slack_api
+from roger import config, external, localize, models, profiler, proto, services, slack_api
 from roger_common import convert, errors, events, flask_extras
 from roger_common import identifiers, random, security
 
@@ -241,6 +241,8 @@ def authed_request(allow_nonactive=False, set_view_account=False, update_last_ac
             finally:
                 time_3 = time.clock()
                 logging.debug('Account %d', session.account_id)
+                profiler.note_phase('auth_ms', int((time_2 - time_1) * 1000))
+                profiler.note_phase('handler_ms', int((time_3 - time_2) * 1000))
             return result
         return wrap
     return decorator
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from roger import config, models, notifs
+from roger_common import identifiers
+
+
+def announce(owner_key, channel_id, text):
+    """Schedules notifying all followers of an account that it's on chat."""
+    taskqueue.add(url='/_ah/jobs/chat_announce',
+                  params={'owner_id': owner_key.id(),
+                          'channel_id': channel_id,
+                          'text': text},
+                  queue_name=config.INTERNAL_QUEUE,
+                  retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0))
+
+
+@ndb.tasklet
+def deliver_async(event_name, account_keys, owner, channel_id, text, sender=None):
+    """Notifies a batch of accounts of a chat event concurrently.
+
+    Returns the number of accounts that were notified.
+    """
+    kwargs = {'channel_id': channel_id, 'owner': owner, 'text': text}
+    if sender:
+        kwargs['sender'] = sender
+    futures = [notifs.Hub(k).emit_async(event_name, **kwargs) for k in account_keys]
+    delivered = 0
+    for future in futures:
+        try:
+            yield future
+            delivered += 1
+        except:
+            logging.exception('Failed to notify an account.')
+    raise ndb.Return(delivered)
+
+
+def mention(sender_key, owner_key, text, extra_identifiers=()):
+    """Schedules notifying the accounts mentioned in a chat message.
+
+    Accounts in extra_identifiers are notified of the message even if not mentioned.
+    """
+    taskqueue.add(url='/_ah/jobs/chat_mentions',
+                  params={'channel_id': str(owner_key.id()),
+                          'identifier': sorted(extra_identifiers),
+                          'owner_id': owner_key.id(),
+                          'sender_id': sender_key.id(),
+                          'text': text},
+                  queue_name=config.INTERNAL_QUEUE,
+                  retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0))
+
+
+@ndb.tasklet
+def resolve_mentions_async(sender_key, text, extra_identifiers=()):
+    """Finds the accounts to notify of a chat message and the event for each of them."""
+    mentions = identifiers.find_mentions(text)
+    values = sorted(mentions | set(extra_identifiers))
+    keys = yield models.Account.resolve_identifiers_async(values)
+    events = {}
+    for value, key in zip(values, keys):
+        if not key or key == sender_key:
+            continue
+        if value in mentions:
+            events[key] = notifs.ON_CHAT_MENTION
+        else:
+            # The account was not mentioned in the text.
+            events.setdefault(key, notifs.ON_CHAT_MESSAGE)
+    raise ndb.Return(events)
+
+
+@ndb.tasklet
+def schedule_delivery_async(event_name, account_keys, owner_key, channel_id, text,
+                            sender_key=None):
+    """Splits notifying many accounts of a chat event into tasks that run in parallel."""
+    tasks = []
+    size = config.CHAT_DELIVERY_BATCH_SIZE
+    for i in xrange(0, len(account_keys), size):
+        params = {'account_ids': ','.join(str(k.id()) for k in account_keys[i:i+size]),
+                  'channel_id': channel_id,
+                  'event_name': event_name,
+                  'owner_id': owner_key.id(),
+                  'text': text}
+        if sender_key:
+            params['sender_id'] = sender_key.id()
+        tasks.append(taskqueue.Task(
+            url='/_ah/jobs/chat_deliver',
+            params=params,
+            retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0)))
+    queue = taskqueue.Queue(config.INTERNAL_QUEUE)
+    # Up to 100 tasks can be added per call.
+    yield [queue.add_async(tasks[i:i+100]) for i in xrange(0, len(tasks), 100)]
+    raise ndb.Return(len(tasks))
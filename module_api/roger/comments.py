@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from google.appengine.datastore import datastore_query
+from google.appengine.ext import ndb
+
+from roger import config, models
+
+
+@ndb.tasklet
+def add_async(comment):
+    """Saves a new comment and adds it to the cached comment threads of its content."""
+    parent = yield _put_comment_async(comment)
+    # Invalidate after the comment is saved so that it can't be left out of a cached list.
+    generation = yield models.ContentComment.invalidate_cache_async(comment.key.parent())
+
+    def update(page):
+        if not generation or page['generation'] != generation - 1:
+            # The cached page may be missing another comment.
+            return False
+        page['generation'] = generation
+        threads = page['threads']
+        if any(c.key == comment.key for root, replies in threads for c in [root] + replies):
+            # The same comment was posted again.
+            return True
+        if not comment.reply_to:
+            threads.insert(0, (comment, []))
+            # Let the page grow a bit before it has to be rebuilt from the datastore.
+            return len(threads) <= config.COMMENT_THREADS_PAGE_SIZE * 2
+        for root, replies in threads:
+            if root.key != comment.reply_to:
+                continue
+            root.reply_count = parent.reply_count
+            if len(replies) < config.COMMENT_REPLIES_PREVIEW:
+                replies.append(comment)
+            break
+        return True
+
+    yield _update_cached_threads_async(comment.key.parent(), update)
+
+
+@ndb.tasklet
+def delete_async(comment):
+    """Deletes a comment and drops the cached comment threads of its content."""
+    yield _delete_comment_async(comment)
+    yield ndb.get_context().memcache_delete(_threads_cache_key(comment.key.parent()))
+
+
+def get_replies(*args, **kwargs):
+    return get_replies_async(*args, **kwargs).get_result()
+
+
+@ndb.tasklet
+def get_replies_async(comment_key, limit, cursor=None):
+    """Gets a page of replies to a comment, oldest first."""
+    q = models.ContentComment.query(ancestor=comment_key.parent())
+    q = q.filter(models.ContentComment.reply_to == comment_key)
+    q = q.order(models.ContentComment.created)
+    start_cursor = datastore_query.Cursor(urlsafe=cursor)
+    replies, next_cursor, more = yield q.fetch_page_async(limit, start_cursor=start_cursor)
+    raise ndb.Return((replies, next_cursor.urlsafe() if more else None))
+
+
+def get_threads(*args, **kwargs):
+    return get_threads_async(*args, **kwargs).get_result()
+
+
+@ndb.tasklet
+def get_threads_async(content_key, cursor=None):
+    """Gets a page of top-level comments on content (newest first) with their first few
+    replies (oldest first).
+
+    Returns a list of (comment, replies) tuples and a cursor for the next page (or None).
+    The first page is cached and kept up to date as comments are added.
+    """
+    context = ndb.get_context()
+    cache_key = _threads_cache_key(content_key)
+    if not cursor:
+        # The generation is read before the datastore so that a page that was loaded before
+        # a comment was added is stored under an older generation and never served.
+        generation, page = yield (models.ContentComment.get_cache_generation_async(content_key),
+                                  context.memcache_get(cache_key))
+        if page is not None and page['generation'] == generation:
+            raise ndb.Return((page['threads'], page['cursor']))
+    q = models.ContentComment.query(ancestor=content_key)
+    q = q.filter(models.ContentComment.reply_to == None)
+    q = q.order(-models.ContentComment.created)
+    start_cursor = datastore_query.Cursor(urlsafe=cursor)
+    roots, next_cursor, more = yield q.fetch_page_async(config.COMMENT_THREADS_PAGE_SIZE,
+                                                       start_cursor=start_cursor)
+    next_cursor = next_cursor.urlsafe() if more else None
+    pages = yield [get_replies_async(c.key, config.COMMENT_REPLIES_PREVIEW) for c in roots]
+    threads = [(root, replies) for root, (replies, _) in zip(roots, pages)]
+    if not cursor:
+        page = {'cursor': next_cursor, 'generation': generation, 'threads': threads}
+        yield context.memcache_set(cache_key, page, time=config.COMMENT_THREADS_CACHE_TTL)
+    raise ndb.Return((threads, next_cursor))
+
+
+@ndb.transactional_tasklet
+def recount_replies_async(comment_key):
+    """Counts the replies to a comment and stores the count on the comment."""
+    q = models.ContentComment.query(ancestor=comment_key.parent())
+    q = q.filter(models.ContentComment.reply_to == comment_key)
+    comment, count = yield comment_key.get_async(), q.count_async()
+    if comment and comment.reply_count != count:
+        comment.reply_count = count
+        yield comment.put_async()
+    raise ndb.Return(count)
+
+
+@ndb.transactional_tasklet
+def _delete_comment_async(comment):
+    futures = [comment.key.delete_async()]
+    if comment.reply_to:
+        parent = yield comment.reply_to.get_async()
+        if parent and parent.reply_count > 0:
+            parent.reply_count -= 1
+            futures.append(parent.put_async())
+    yield futures
+
+
+@ndb.transactional_tasklet
+def _put_comment_async(comment):
+    # The comment and the comment it replies to share an entity group (the content).
+    if not comment.reply_to:
+        yield comment.put_async()
+        raise ndb.Return(None)
+    existing, parent = yield comment.key.get_async(), comment.reply_to.get_async()
+    if not parent or existing:
+        # Reposting the same reply doesn't count it twice.
+        yield comment.put_async()
+        raise ndb.Return(parent)
+    parent.reply_count += 1
+    yield ndb.put_multi_async([comment, parent])
+    raise ndb.Return(parent)
+
+
+def _threads_cache_key(content_key):
+    return 'content_comment_threads_%d' % (content_key.id(),)
+
+
+@ndb.tasklet
+def _update_cached_threads_async(content_key, update):
+    context = ndb.get_context()
+    cache_key = _threads_cache_key(content_key)
+    for _ in xrange(3):
+        page = yield context.memcache_gets(cache_key)
+        if page is None:
+            # Nothing cached, the next request will load from the datastore.
+            return
+        if not update(page):
+            break
+        stored = yield context.memcache_cas(cache_key, page,
+                                            time=config.COMMENT_THREADS_CACHE_TTL)
+        if stored:
+            return
+    logging.debug('Dropping cached comment threads for content %d', content_key.id())
+    yield context.memcache_delete(cache_key)
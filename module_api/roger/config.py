@@ -56,6 +56,9 @@ SUGGESTION_POOL_SUBREDDITS = [
 TOP_CREATOR_IDS = [
 ]
 
+# How long a tagged top accounts leaderboard keeps being updated after it was requested.
+TOP_ACCOUNTS_TAG_TTL = timedelta(days=7)
+
 ITUNES_PRODUCTS = {
     'RCOINS80': {'active': True, 'type': 'currency', 'amount': 80},
     'RCOINS165': {'active': True, 'type': 'currency', 'amount': 165},
@@ -94,6 +97,7 @@ INTERNAL_QUEUE = 'jobs'
 LOCATION_QUEUE_NAME = 'jobs'
 SERVICE_QUEUE_NAME = 'jobs'
 TOP_TALKER_QUEUE_NAME = 'jobs'
+WALLET_PAYOUT_QUEUE_NAME = 'wallet-payouts'
 
 if DEVELOPMENT:
     AUDIO_QUEUE_NAME = 'default'
@@ -159,6 +163,60 @@ if PRODUCTION:
 else:
     BIGQUERY_DATASET = 'roger_reporting_dev'
 
+# Chat notifications are delivered by parallel tasks that each notify a batch of accounts.
+CHAT_ANNOUNCE_PAGE_SIZE = 1000  # Followers to schedule notifications for per task.
+CHAT_DELIVERY_BATCH_SIZE = 100
+
+# Contact uploads are looked up in windows and remembered per account.
+CONTACTS_CACHE_TTL = 21600  # Seconds to remember whether a contact has an account.
+CONTACTS_MAX_CONCURRENT_WINDOWS = 4
+CONTACTS_WINDOW_SIZE = 500
+
+# Active content request entries are rewarded one page at a time.
+CONTENT_REQUEST_ENTRIES_PAGE_SIZE = 100
+
+# Threaded comments are paged by top-level comment with a preview of their replies.
+COMMENT_REPLIES_PAGE_SIZE = 50
+COMMENT_REPLIES_PREVIEW = 5
+COMMENT_THREADS_CACHE_TTL = 3600  # Seconds to keep the first page of threads.
+COMMENT_THREADS_PAGE_SIZE = 50
+
+# Comment counts are kept in sharded counters and folded into the content this often (seconds).
+CONTENT_COMMENT_SHARDS = 5  # Each fold writes to 2 counters with this many shards each.
+CONTENT_COMMENTS_FOLD_DELAY = 10
+
+# Recent content has its sort index decayed in pages until the decay bottoms out (~5 days).
+CONTENT_RERANK_AGE = timedelta(days=6)
+CONTENT_RERANK_MIN_CHANGE = 60  # Smaller drops in sort index are not written.
+CONTENT_RERANK_PAGE_SIZE = 500
+
+# Reactions re-rank the top reactions of their original at most this often (seconds).
+TOP_REACTIONS_UPDATE_DELAY = 60
+
+# Pages of thread messages are cached by cursor (older messages never change).
+THREAD_MESSAGES_CACHE_TTL = 3600  # Seconds to remember a page or a cursor.
+
+# Threads that predate inbox entries are copied to every participant's inbox in pages.
+THREAD_INBOX_BACKFILL_PAGE_SIZE = 100
+
+# Home timelines get content copied in when it's published, except from large creators.
+TIMELINE_BACKFILL_PAGE_SIZE = 50  # Follows to copy recent content for per job.
+TIMELINE_FANOUT_MAX_FOLLOWERS = 10000  # Creators with more followers are merged on read.
+TIMELINE_FOLLOW_CONTENT_COUNT = 20  # Recent content to copy when following someone.
+TIMELINE_LARGE_CREATORS_CACHE_TTL = 600
+TIMELINE_LARGE_CREATORS_MAX = 500
+
+# Queued wallet payouts are settled in batches by a job per wallet.
+WALLET_PAYOUT_DELAY = 10  # Seconds to wait for more payouts before settling.
+WALLET_PAYOUT_LEASE_AMOUNT = 240  # The number of payouts to settle per job.
+WALLET_PAYOUT_LEASE_TIME = timedelta(minutes=5)  # The time to lease a batch.
+
+# Wallet ledgers are audited from their latest checkpoint.
+WALLET_AUDIT_LIMIT = 5000  # The number of transactions to verify per job.
+WALLET_AUDIT_PAGE_SIZE = 500
+WALLET_AUDIT_WINDOW = timedelta(days=1)  # Audit wallets that changed within this time.
+WALLET_CHECKPOINT_INTERVAL = 1000  # The number of transactions between checkpoints.
+
 CLAIMABLE_IDENTIFIER_TYPES = {
     identifiers.EMAIL,
     identifiers.PHONE,
@@ -181,8 +239,31 @@ INVALID_IDENTIFIERS = {
 DEFAULT_ACCOUNT_IMAGES = [
 ]
 
+# Request profiling (see roger.profiler).
+PROFILER_ENABLED = True
+PROFILER_FLUSH_INTERVAL = 60  # Seconds between flushing instance stats to memcache.
+PROFILER_SLOW_REQUEST_MS = 2000  # Requests slower than this have their RPCs saved.
+PROFILER_SLOW_REQUESTS_KEPT = 50
+PROFILER_WINDOW = 3600  # Seconds per aggregation window.
+
+# The accounts that an account blocked or was blocked by are cached for filtering lists.
+ACCOUNT_BLOCKS_CACHE_TTL = 3600
+
+# Account events older than this are packed into one entity per account and day.
+ACCOUNT_EVENTS_COMPACT_AGE = timedelta(days=2)
+ACCOUNT_EVENTS_COMPACT_BATCH = 200  # The number of events to compact per transaction.
+ACCOUNT_EVENTS_COMPACT_SCAN = 5000  # The number of events to scan for accounts per run.
+
 # Chunk/stream settings.
 CHUNK_MAX_AGE = timedelta(days=7)
+UNPLAYED_STREAMS_CACHE_TTL = 86400  # Seconds to keep each account's set of unplayed streams.
+UNPLAYED_STREAMS_CHANGES_TTL = 60  # Seconds to keep changes for accounts without a cached set.
+
+# Expired chunks are deleted in time slices that run in parallel.
+DELETE_CHUNKS_BATCH_SIZE = 500
+DELETE_CHUNKS_CLEANUP_STORAGE = False  # Also delete the short-lived audio files.
+DELETE_CHUNKS_SLICES = 8
+DELETE_CHUNKS_TASK_TIME = timedelta(minutes=5)  # Continue in a new task after this time.
 
 # Challenge settings.
 CHALLENGE_CODE_LENGTH = 6
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+from collections import deque
+import hashlib
+import logging
+import re
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from roger import config
+from roger_common import identifiers
+
+
+HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def contact_hash(identifier):
+    """The hash a client uses to refer to a contact identifier it has uploaded before."""
+    if isinstance(identifier, unicode):
+        identifier = identifier.encode('utf-8')
+    return hashlib.sha256(identifier).hexdigest()
+
+
+class Matcher(object):
+    """Matches contact identifiers against identities, remembering results per account.
+
+    Results are cached by contact hash for a while so that repeat uploads only need to
+    resolve identifiers that were not seen before. Cached misses are remembered too,
+    which means a contact that signs up can take up to the cache TTL to show up.
+    """
+
+    def __init__(self, account_key):
+        self.account_key = account_key
+        self.matches = {}
+        self.num_lines = 0
+        self.num_resolved = 0
+        self.unknown = []
+        self._cache = None
+        self._dirty = set()
+
+    def match_hashes(self, lines):
+        """Matches contact hashes against previous results.
+
+        Hashes that are not known are added to unknown for the client to send again.
+        """
+        self._load_cache()
+        seen = set()
+        for line in lines:
+            self.num_lines += 1
+            h = line.strip().lower()
+            if not HASH_PATTERN.match(h) or h in seen:
+                continue
+            seen.add(h)
+            bucket = self._cache.get(h[0], {})
+            if h[:16] not in bucket:
+                self.unknown.append(h)
+                continue
+            result = bucket[h[:16]]
+            if result:
+                self.matches[h] = result
+
+    def match_identifiers(self, lines):
+        """Matches identifiers, looking up the ones without a previous result in windows."""
+        self._load_cache()
+        seen = set()
+        window = []
+        in_flight = deque()
+        for line in lines:
+            self.num_lines += 1
+            try:
+                identifier, identifier_type = identifiers.parse(line.strip())
+            except:
+                continue
+            if not identifier or identifier_type not in (identifiers.EMAIL, identifiers.PHONE):
+                continue
+            if identifier in seen:
+                continue
+            seen.add(identifier)
+            h = contact_hash(identifier)
+            bucket = self._cache.get(h[0], {})
+            if h[:16] in bucket:
+                if bucket[h[:16]]:
+                    self.matches[identifier] = bucket[h[:16]]
+                continue
+            window.append(identifier)
+            if len(window) < config.CONTACTS_WINDOW_SIZE:
+                continue
+            # Limit the number of concurrent lookups to keep memory and RPCs bounded.
+            if len(in_flight) >= config.CONTACTS_MAX_CONCURRENT_WINDOWS:
+                self._collect(*in_flight.popleft())
+            in_flight.append(self._lookup(window))
+            window = []
+        if window:
+            in_flight.append(self._lookup(window))
+        while in_flight:
+            self._collect(*in_flight.popleft())
+
+    def save(self):
+        if not self._dirty:
+            return
+        mapping = {self._cache_key(b): self._cache[b] for b in self._dirty}
+        memcache.set_multi(mapping, time=config.CONTACTS_CACHE_TTL)
+        self._dirty = set()
+
+    def _cache_key(self, bucket):
+        return 'contacts_%d_%s' % (self.account_key.id(), bucket)
+
+    def _collect(self, identifier_list, future):
+        try:
+            identities = future.get_result()
+        except:
+            logging.exception('Failed to look up %d contact(s)', len(identifier_list))
+            return
+        self.num_resolved += len(identifier_list)
+        for identifier, identity in zip(identifier_list, identities):
+            if identity and identity.account:
+                result = (identity.account.id(), identity.is_active)
+                self.matches[identifier] = result
+            else:
+                result = None
+            h = contact_hash(identifier)
+            self._cache.setdefault(h[0], {})[h[:16]] = result
+            self._dirty.add(h[0])
+
+    def _load_cache(self):
+        if self._cache is not None:
+            return
+        # The cache is split by the first hex digit of the hash to stay below the value limit.
+        keys = {self._cache_key(b): b for b in '0123456789abcdef'}
+        values = memcache.get_multi(keys.keys())
+        self._cache = {keys[k]: v for k, v in values.iteritems()}
+
+    def _lookup(self, identifier_list):
+        keys = [ndb.Key('Identity', i) for i in identifier_list]
+        future = _get_multi_async(keys)
+        return identifier_list, future
+
+
+@ndb.tasklet
+def _get_multi_async(keys):
+    identities = yield ndb.get_multi_async(keys, read_policy=ndb.EVENTUAL_CONSISTENCY)
+    raise ndb.Return(identities)
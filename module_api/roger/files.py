@@ -38,6 +38,17 @@ with open(config.AWS_SECRETS_FILE) as fh:
     __aws_secrets = json.load(fh)
 
 
+def delete(path):
+    """Deletes a short-lived file, ignoring files that no longer exist."""
+    path = _absolute(path)
+    if not is_shortlived(path):
+        raise ValueError('Only short-lived files may be deleted')
+    try:
+        gcs.delete(path)
+    except gcs.NotFoundError:
+        logging.debug('File %r was already deleted', path)
+
+
 def download(path, destination_file_object):
     # Load the file and output it.
     with gcs.open(_absolute(path), 'r') as f:
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+from flask import g, has_request_context
+
+from google.appengine.ext import ndb
+
+from roger import models
+
+
+class AccountMap(dict):
+    """Accounts by key, so that each account is only loaded once.
+
+    Use current() to share a map between everything that handles the same request.
+    """
+
+    def get_multi(self, keys):
+        return self.get_multi_async(keys).get_result()
+
+    @ndb.tasklet
+    def get_multi_async(self, keys):
+        """Gets accounts by key, loading the ones that are not in the map yet."""
+        missing = list(set(k for k in keys if k not in self))
+        if missing:
+            accounts = yield ndb.get_multi_async(missing)
+            for key, account in zip(missing, accounts):
+                if account:
+                    self[key] = account
+        raise ndb.Return([self.get(k) for k in keys])
+
+    def resolve(self, value):
+        try:
+            return self.resolve_list([value])[0]
+        except ValueError:
+            return None
+
+    def resolve_list(self, value_list):
+        return self.resolve_list_async(value_list).get_result()
+
+    @ndb.tasklet
+    def resolve_list_async(self, value_list):
+        """Like Account.resolve_list, but without resolving the same value twice."""
+        for value in value_list:
+            if isinstance(value, models.Account):
+                self[value.key] = value
+        # Only identifiers (such as usernames) need to be looked up.
+        keys = yield models.Account.resolve_key_list_async(value_list)
+        if not all(keys):
+            raise ValueError('Failed to resolve input list to accounts')
+        accounts = yield self.get_multi_async(keys)
+        if not all(accounts):
+            raise ValueError('Failed to resolve input list to accounts')
+        raise ndb.Return(accounts)
+
+
+def current():
+    """Gets the account map of the current request (or a new one outside of requests)."""
+    if not has_request_context():
+        return AccountMap()
+    if not hasattr(g, 'account_map'):
+        g.account_map = AccountMap()
+    return g.account_map
+
+
+def resolve_key(value):
+    """Gets the account key of a value that doesn't need a lookup, otherwise None."""
+    if isinstance(value, models.Account):
+        return value.key
+    elif isinstance(value, ndb.Key) and value.kind() == 'Account':
+        return value
+    elif isinstance(value, models.Participant):
+        return value.account
+    elif isinstance(value, (int, long)):
+        return ndb.Key('Account', value)
+    return None
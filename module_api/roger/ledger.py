@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from google.appengine.ext import ndb
+
+from roger import config, models
+
+
+GENESIS_TX = '0' * 64
+
+
+class LedgerState(object):
+    """The state of a wallet as of a point in its transaction chain."""
+    __slots__ = ['balance', 'last_tx', 'timestamp', 'total_received', 'total_sent', 'tx_count']
+
+    def __init__(self, balance=None, last_tx=GENESIS_TX, timestamp=None,
+                 total_received=0, total_sent=0, tx_count=0):
+        # The balance is unknown until the first transaction has been seen.
+        self.balance = balance
+        self.last_tx = last_tx
+        self.timestamp = timestamp
+        self.total_received = total_received
+        self.total_sent = total_sent
+        self.tx_count = tx_count
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint):
+        if not checkpoint:
+            return cls()
+        return cls(balance=checkpoint.balance,
+                   last_tx=checkpoint.last_tx,
+                   timestamp=checkpoint.timestamp,
+                   total_received=checkpoint.total_received,
+                   total_sent=checkpoint.total_sent,
+                   tx_count=checkpoint.tx_count)
+
+    def apply(self, tx, problems):
+        if self.balance is None:
+            # Wallets may be created with an initial balance that has no transaction.
+            self.balance = tx.old_balance
+            self.total_received = tx.old_balance
+        if not self.follows(tx):
+            problems.append('Transaction %s does not follow %s' % (tx.key.id(), self.last_tx))
+        if tx.old_balance != self.balance:
+            problems.append('Transaction %s has old balance %d, expected %d' % (
+                tx.key.id(), tx.old_balance, self.balance))
+        if tx.new_balance != tx.old_balance + tx.delta:
+            problems.append('Transaction %s has new balance %d, expected %d' % (
+                tx.key.id(), tx.new_balance, tx.old_balance + tx.delta))
+        self.balance += tx.delta
+        if self.balance < 0:
+            problems.append('Balance went negative at transaction %s' % (tx.key.id(),))
+        if tx.delta > 0:
+            self.total_received += tx.delta
+        else:
+            self.total_sent -= tx.delta
+        self.last_tx = tx.key.id()
+        self.timestamp = tx.timestamp
+        self.tx_count += 1
+
+    def apply_group(self, group, problems):
+        # Transactions in the same batch share a timestamp so use the chain to order them.
+        group = list(group)
+        while group:
+            for i, tx in enumerate(group):
+                if self.follows(tx):
+                    break
+            else:
+                # Let apply report the break, then keep checking the rest of the group.
+                i = 0
+            self.apply(group.pop(i), problems)
+
+    def follows(self, tx):
+        balance = tx.old_balance if self.balance is None else self.balance
+        h = models.WalletTransaction.make_hash(_HashState(self.last_tx, balance),
+                                               tx.sender, tx.receiver, tx.delta)
+        return h == tx.key.id()
+
+    def to_checkpoint(self, wallet_key):
+        return models.WalletCheckpoint(
+            id=self.last_tx,
+            parent=wallet_key,
+            balance=self.balance,
+            last_tx=self.last_tx,
+            timestamp=self.timestamp,
+            total_received=self.total_received,
+            total_sent=self.total_sent,
+            tx_count=self.tx_count)
+
+
+def audit(*args, **kwargs):
+    return audit_async(*args, **kwargs).get_result()
+
+
+@ndb.tasklet
+def audit_async(wallet_key, limit=None):
+    """Verifies the transaction chain of a wallet, starting at its latest checkpoint.
+
+    Returns a tuple of the state that was reached, whether the whole chain has been
+    verified and a list of problems. If limit is hit first, a checkpoint is written so
+    that the next audit can resume where this one stopped.
+    """
+    wallet, checkpoint = yield (wallet_key.get_async(),
+                                models.WalletCheckpoint.latest_async(wallet_key))
+    if not wallet:
+        raise ValueError('wallet_key is not a valid Wallet key')
+    state = LedgerState.from_checkpoint(checkpoint)
+    start_count = checkpoint_count = state.tx_count
+    problems = []
+    done = state.last_tx == wallet.last_tx
+    paused = False
+    q = _transactions_query(wallet_key, state)
+    carry, cursor, more = [], None, not done
+    while more:
+        page, cursor, more = yield q.fetch_page_async(config.WALLET_AUDIT_PAGE_SIZE,
+                                                      start_cursor=cursor)
+        # Only the last unfinished timestamp group is held on to between pages.
+        txs, carry = carry + page, []
+        for group, complete in _groups(txs, more):
+            if not complete:
+                carry = group
+                break
+            state.apply_group(group, problems)
+            if state.last_tx == wallet.last_tx:
+                # Later transactions happened after the wallet was loaded.
+                done = True
+                break
+            if problems:
+                continue
+            if state.tx_count - checkpoint_count >= config.WALLET_CHECKPOINT_INTERVAL:
+                yield state.to_checkpoint(wallet_key).put_async()
+                checkpoint_count = state.tx_count
+            if limit and state.tx_count - start_count >= limit:
+                paused = True
+                break
+        if done or paused:
+            break
+    if done:
+        if state.balance is None:
+            # The wallet has never had any transactions.
+            state.balance = wallet.balance
+            state.total_received = wallet.total_received
+        if (state.balance, state.total_received, state.total_sent) != (
+                wallet.balance, wallet.total_received, wallet.total_sent):
+            problems.append('Wallet is at %d (%d received, %d sent), ledger says %d (%d, %d)' % (
+                wallet.balance, wallet.total_received, wallet.total_sent,
+                state.balance, state.total_received, state.total_sent))
+    elif paused:
+        if state.tx_count > checkpoint_count:
+            yield state.to_checkpoint(wallet_key).put_async()
+    elif not problems:
+        problems.append('Ledger ends at %s but wallet is at %s' % (state.last_tx, wallet.last_tx))
+    for problem in problems:
+        logging.error('Wallet %r: %s', wallet_key.id(), problem)
+    raise ndb.Return((state, done, problems))
+
+
+def balance_at(*args, **kwargs):
+    return balance_at_async(*args, **kwargs).get_result()
+
+
+@ndb.tasklet
+def balance_at_async(wallet_key, timestamp):
+    """Gets the balance of a wallet as of the provided time (or None if it didn't exist)."""
+    checkpoint = yield models.WalletCheckpoint.latest_async(wallet_key, before=timestamp)
+    state = LedgerState.from_checkpoint(checkpoint)
+    q = _transactions_query(wallet_key, state, until=timestamp)
+    problems = []
+    carry, cursor, more = [], None, True
+    while more:
+        page, cursor, more = yield q.fetch_page_async(config.WALLET_AUDIT_PAGE_SIZE,
+                                                      start_cursor=cursor)
+        txs, carry = carry + page, []
+        for group, complete in _groups(txs, more):
+            if not complete:
+                carry = group
+                break
+            state.apply_group(group, problems)
+    if state.balance is not None:
+        raise ndb.Return(state.balance)
+    # There were no transactions before the timestamp.
+    wallet, first_tx = yield (wallet_key.get_async(),
+                              _transactions_query(wallet_key, state).get_async())
+    if not wallet or wallet.created > timestamp:
+        raise ndb.Return(None)
+    raise ndb.Return(first_tx.old_balance if first_tx else wallet.balance)
+
+
+class _HashState(object):
+    __slots__ = ['balance', 'last_tx']
+
+    def __init__(self, last_tx, balance):
+        self.balance = balance
+        self.last_tx = last_tx
+
+
+def _groups(page, more):
+    """Yields (group, complete) for transactions sharing a timestamp.
+
+    The last group of a page is incomplete when there are more pages.
+    """
+    group = []
+    for tx in page:
+        if group and tx.timestamp != group[0].timestamp:
+            yield group, True
+            group = []
+        group.append(tx)
+    if group:
+        yield group, not more
+
+
+def _transactions_query(wallet_key, state, until=None):
+    q = models.WalletTransaction.query(ancestor=wallet_key)
+    if state.timestamp:
+        q = q.filter(models.WalletTransaction.timestamp > state.timestamp)
+    if until:
+        q = q.filter(models.WalletTransaction.timestamp <= until)
+    return q.order(models.WalletTransaction.timestamp)
@@ -5,14 +5,18 @@ import collections
 from datetime import date, datetime, timedelta
 import hashlib
 from itertools import chain, izip, tee
+import json
 import logging
 import pytz
 import re
 import struct
+import time
 import urllib
+import zlib
 
-from flask import has_request_context, request
+from flask import g, has_request_context, request
 
+from google.appengine.api import taskqueue
 from google.appengine.ext import deferred, ndb
 
 from roger import config, files, localize, location, push_service
@@ -68,6 +72,8 @@ class StatusMixin(object):
 class Account(ndb.Model, StatusMixin):
     admin = ndb.BooleanProperty(default=False, indexed=False)
     birthday = ndb.DateProperty()
+    # The accounts blocked by this account (blocked_by is the same list on the other side).
+    blocked = ndb.KeyProperty(kind='Account', indexed=False, repeated=True)
     blocked_by = ndb.KeyProperty(kind='Account', repeated=True)
     callback_url = ndb.StringProperty(indexed=False)
     callback_version = ndb.IntegerProperty(indexed=False)
@@ -101,6 +107,8 @@ class Account(ndb.Model, StatusMixin):
     streak_count = ndb.IntegerProperty(default=0, indexed=False)
     streak_max = ndb.IntegerProperty(default=0, indexed=False)
     streak_time = ndb.DateTimeProperty(indexed=False)
+    # Content by the account has been left out of follower timelines (see timelines).
+    timeline_merged = ndb.BooleanProperty(default=False)
     total_content_found = ndb.IntegerProperty(default=0)
     verified = ndb.BooleanProperty(default=False, indexed=False)
     wallet = ndb.KeyProperty(kind='Wallet')
@@ -127,18 +135,30 @@ class Account(ndb.Model, StatusMixin):
         return self.key.id()
 
     @classmethod
-    @ndb.transactional
+    @ndb.transactional(xg=True)
     def add_block(cls, account_key, blocked_by):
-        account = account_key.get()
+        account, blocker = ndb.get_multi([account_key, blocked_by])
         if not blocked_by in account.blocked_by:
             account.blocked_by.append(blocked_by)
             account.put()
+        if blocker and not account_key in blocker.blocked:
+            blocker.blocked.append(account_key)
+            blocker.put()
         return account
 
     @classmethod
     def add_vote_async(cls, account_key):
         return CounterShard.increment_async('total_votes_received', parent=account_key)
 
+    @classmethod
+    @ndb.tasklet
+    def clear_blocks_cache_async(cls, account_keys):
+        # Move on to a new generation so that a set being rebuilt can't be served again.
+        context = ndb.get_context()
+        yield [context.memcache_incr('account_blocks_gen_%d' % (k.id(),),
+                                     initial_value=int(time.time()))
+               for k in account_keys]
+
     def common_teams(self, other, exclude_services=[]):
         """Finds common teams between this account and another, and generates
         the complete service identifiers for the two accounts as tuples.
@@ -189,6 +209,36 @@ class Account(ndb.Model, StatusMixin):
             identity.put()
         return account
 
+    @classmethod
+    @ndb.tasklet
+    def get_blocks_async(cls, account_key):
+        """Gets the ids of all accounts that have blocked or been blocked by an account.
+
+        The ids are cached as a sorted list and returned as a set for fast lookups, so that
+        cached lists can be filtered for the viewer without loading any other accounts.
+        """
+        context = ndb.get_context()
+        generation_key = 'account_blocks_gen_%d' % (account_key.id(),)
+        generation = yield context.memcache_get(generation_key)
+        if generation is None:
+            generation = int(time.time())
+            yield context.memcache_add(generation_key, generation)
+        cache_key = 'account_blocks_%d_%d' % (account_key.id(), generation)
+        account_ids = yield context.memcache_get(cache_key)
+        if account_ids is None:
+            # Blocks from before the blocked list are only found by the (eventually
+            # consistent) query, so its results are checked against the blocked accounts.
+            q = cls.query(cls.blocked_by == account_key)
+            account, indexed_keys = yield account_key.get_async(), q.fetch_async(keys_only=True)
+            blocked_keys = set(account.blocked if account else [])
+            others = yield ndb.get_multi_async(set(indexed_keys) - blocked_keys)
+            blocked_keys.update(a.key for a in others if a and account_key in a.blocked_by)
+            blocker_keys = account.blocked_by if account else []
+            account_ids = sorted(set(k.id() for k in chain(blocker_keys, blocked_keys)))
+            yield context.memcache_set(cache_key, account_ids,
+                                       time=config.ACCOUNT_BLOCKS_CACHE_TTL)
+        raise ndb.Return(frozenset(account_ids))
+
     def get_display_name(self):
         return self.stored_display_name or self.username
     def set_display_name(self, value):
@@ -462,14 +512,17 @@ class Account(ndb.Model, StatusMixin):
         self.populate(**integrity_check(self.key).to_dict())
 
     @classmethod
-    @ndb.transactional
+    @ndb.transactional(xg=True)
     def remove_block(cls, account_key, blocked_by):
-        account = account_key.get()
+        account, blocker = ndb.get_multi([account_key, blocked_by])
         try:
             account.blocked_by.remove(blocked_by)
             account.put()
         except ValueError:
             pass
+        if blocker and account_key in blocker.blocked:
+            blocker.blocked.remove(account_key)
+            blocker.put()
         return account
 
     @classmethod
@@ -489,6 +542,37 @@ class Account(ndb.Model, StatusMixin):
         account = yield key.get_async()
         raise ndb.Return(account)
 
+    @classmethod
+    @ndb.tasklet
+    def resolve_identifiers_async(cls, values):
+        """Resolves identifiers to account keys with a single lookup of their identities.
+
+        Returns an account key (or None) for every value, in the same order.
+        Identifiers that were already resolved during the current request are not looked
+        up again.
+        """
+        keys = [None] * len(values)
+        cache = Identity.get_request_cache()
+        lookups = []
+        for index, value in enumerate(values):
+            value, identifier_type = identifiers.parse(value)
+            if identifier_type == identifiers.ACCOUNT_ID:
+                keys[index] = ndb.Key(cls, value) if value > 0 else None
+            elif value in cache:
+                keys[index] = cache[value]
+            elif value:
+                lookups.append((index, value))
+        if lookups:
+            missing = sorted(set(value for _, value in lookups))
+            logging.debug('Looking up identifiers %r', missing)
+            identities = yield ndb.get_multi_async([ndb.Key(Identity, v) for v in missing])
+            for value, identity in zip(missing, identities):
+                if identity and identity.account:
+                    cache[value] = identity.account
+            for index, value in lookups:
+                keys[index] = cache.get(value)
+        raise ndb.Return(keys)
+
     @classmethod
     def resolve_key(cls, value):
         return cls.resolve_key_async(value).get_result()
@@ -505,23 +589,48 @@ class Account(ndb.Model, StatusMixin):
         elif isinstance(value, (int, long)):
             raise ndb.Return(ndb.Key(cls, value))
         elif isinstance(value, basestring):
-            value, identifier_type = identifiers.parse(value)
-            logging.debug('Looking up identifier %r (%s)', value, identifier_type)
-            if identifier_type == identifiers.ACCOUNT_ID:
-                if value <= 0:
-                    raise ndb.Return(None)
-                raise ndb.Return(ndb.Key(cls, value))
-            if not value:
-                raise ndb.Return(None)
-            identity = yield Identity.get_by_id_async(value)
-            if not identity:
-                raise ndb.Return(None)
-            raise ndb.Return(identity.account)
+            keys = yield cls.resolve_identifiers_async([value])
+            raise ndb.Return(keys[0])
+
+    @classmethod
+    def resolve_key_list_async(cls, value_list):
+        """Gets an account key (or None) for every value, in the same order.
+
+        Keys, accounts and participants are resolved directly, and all identifiers are
+        looked up in a single batch. The returned future is already done if there were no
+        identifiers to look up.
+        """
+        keys = []
+        lookups = []
+        for value in value_list:
+            if isinstance(value, ndb.Key) and value.kind() == cls._get_kind():
+                keys.append(value)
+            elif isinstance(value, Participant):
+                keys.append(value.account)
+            elif isinstance(value, cls):
+                keys.append(value.key)
+            elif isinstance(value, (int, long)):
+                keys.append(ndb.Key(cls, value))
+            else:
+                if isinstance(value, basestring):
+                    lookups.append((len(keys), value))
+                keys.append(None)
+        if not lookups:
+            future = ndb.Future()
+            future.set_result(keys)
+            return future
+
+        @ndb.tasklet
+        def lookup():
+            found = yield cls.resolve_identifiers_async([v for _, v in lookups])
+            for (index, _), key in zip(lookups, found):
+                keys[index] = key
+            raise ndb.Return(keys)
+        return lookup()
 
     @classmethod
     def resolve_keys(cls, value_list):
-        futures = [cls.resolve_key_async(v) for v in value_list]
-        keys = {f.get_result() for f in futures}
+        keys = set(cls.resolve_key_list_async(value_list).get_result())
         if not all(keys):
             raise ValueError('Failed to resolve input list to account keys')
         return keys
@@ -529,8 +638,7 @@ class Account(ndb.Model, StatusMixin):
     @classmethod
     @ndb.tasklet
     def resolve_keys_async(cls, value_list):
-        futures = [cls.resolve_key_async(v) for v in value_list]
-        keys = yield futures
+        keys = yield cls.resolve_key_list_async(value_list)
         keys = set(keys)
         if not all(keys):
             raise ValueError('Failed to resolve input list to account keys')
@@ -544,22 +652,14 @@ class Account(ndb.Model, StatusMixin):
     @ndb.tasklet
     def resolve_list_async(cls, value_list):
         results = list(value_list)
-        missing = []
-        indexes = []
-        for index, value in enumerate(value_list):
-            if not isinstance(value, cls):
-                future = cls.resolve_key_async(value)
-                missing.append(future)
-                indexes.append(index)
-        for index, future in enumerate(missing):
-            key = yield future
-            if not key:
-                raise ValueError('Failed to resolve input list to accounts')
-            missing[index] = key
+        indexes = [i for i, v in enumerate(value_list) if not isinstance(v, cls)]
+        missing = yield cls.resolve_key_list_async([value_list[i] for i in indexes])
+        if not all(missing):
+            raise ValueError('Failed to resolve input list to accounts')
         accounts = yield ndb.get_multi_async(missing)
-        while indexes:
-            results[indexes.pop()] = accounts.pop()
-        if accounts or not all(results):
+        for index, account in zip(indexes, accounts):
+            results[index] = account
+        if not all(results):
             raise ValueError('Failed to resolve input list to accounts')
         if missing:
             logging.debug('Loaded accounts: %s', ', '.join(str(k.id()) for k in missing))
@@ -722,7 +822,10 @@ class Account(ndb.Model, StatusMixin):
 
 
 class AccountEvent(ndb.Model):
+    # Items are stored in packed form, see pack_items for the format.
+    packed = ndb.JsonProperty()
     timestamp = ndb.DateTimeProperty(required=True)
+    # Legacy format: one internal dict per item.
     properties = ndb.JsonProperty(repeated=True)
 
     @classmethod
@@ -747,7 +850,7 @@ class AccountEvent(ndb.Model):
         timestamp = items[0].timestamp
         event_id = convert.unix_timestamp_ms(timestamp)
         event = cls(id=event_id, timestamp=timestamp,
-                    properties=[i.to_internal() for i in items],
+                    packed=cls.pack_items(timestamp, items),
                     parent=account_key)
         return event.put_async()
 
@@ -759,11 +862,184 @@ class AccountEvent(ndb.Model):
             item.event_class = ndb.GenericProperty('event_class')._get_value(self)
             item.properties = self.properties[0]
             return [item]
+        if self.packed:
+            return self.unpack_items(self.timestamp, self.packed)
         if len(self.properties) == 1 and '_ts' not in self.properties[0]:
             props = dict(self.properties[0], _ts=convert.unix_timestamp_ms(self.timestamp))
             return [AccountEventItem.from_internal(props)]
         return map(AccountEventItem.from_internal, self.properties)
 
+    @classmethod
+    def pack_items(cls, timestamp, items):
+        """Packs items into a list of strings and a list of item tuples.
+
+        Client strings, event classes, names and property keys are stored once in
+        the string list and referred to by index. Each item is a list of
+        [ms since timestamp, client, class, name, [key, value, ...], repeats, ms
+        since repeats began] where the last two are left out for unrepeated items.
+        """
+        strings = []
+        lookup = {}
+        def intern(value):
+            if value is None:
+                return None
+            if value not in lookup:
+                lookup[value] = len(strings)
+                strings.append(value)
+            return lookup[value]
+        base_ms = convert.unix_timestamp_ms(timestamp)
+        rows = []
+        for item in items:
+            item_ms = convert.unix_timestamp_ms(item.timestamp)
+            props = []
+            for key, value in sorted(item.properties.iteritems()):
+                props.extend([intern(key), value])
+            row = [item_ms - base_ms, intern(item.client), intern(item.event_class),
+                   intern(item.name), props]
+            if item.repeats > 1:
+                row.extend([item.repeats, item_ms - convert.unix_timestamp_ms(item.repeats_began)])
+            rows.append(row)
+        return {'items': rows, 'strings': strings}
+
+    @classmethod
+    def unpack_items(cls, timestamp, packed):
+        strings = packed['strings']
+        lookup = lambda index: None if index is None else strings[index]
+        base_ms = convert.unix_timestamp_ms(timestamp)
+        items = []
+        for row in packed['items']:
+            item_ms = base_ms + row[0]
+            props = row[4]
+            item = AccountEventItem(convert.from_unix_timestamp_ms(item_ms), lookup(row[3]),
+                                    event_class=lookup(row[2]),
+                                    properties={strings[props[i]]: props[i + 1]
+                                                for i in xrange(0, len(props), 2)})
+            # Set the client separately so that it isn't taken from the current request.
+            item.client = lookup(row[1])
+            if len(row) > 5:
+                item.repeats = row[5]
+                item.repeats_began = convert.from_unix_timestamp_ms(item_ms - row[6])
+            items.append(item)
+        return items
+
+
+class AccountEventDay(ndb.Model):
+    """All the compacted event items of an account for one day (UTC), stored by column.
+
+    Busy days are split into several parts, the first of which keeps count of them.
+    """
+    columns = ndb.JsonProperty(compressed=True, required=True)
+    parts = ndb.IntegerProperty(default=1, indexed=False)
+    timestamp = ndb.DateTimeProperty(required=True)
+
+    # Leave room for the rest of the entity within the 1 MB limit.
+    MAX_COLUMNS_BYTES = 900000
+
+    @classmethod
+    def compact(cls, *args, **kwargs):
+        return cls.compact_async(*args, **kwargs).get_result()
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def compact_async(cls, account_key, event_keys):
+        """Moves the items of the provided events into day entities and deletes the events."""
+        if any(k.parent() != account_key for k in event_keys):
+            raise ValueError('All events must belong to the account')
+        # Load events again in the transaction in case another compaction got to them first.
+        events = filter(None, (yield ndb.get_multi_async(event_keys)))
+        items_by_day = collections.defaultdict(list)
+        for event in events:
+            for item in event.items:
+                items_by_day[item.timestamp.date()].append(item)
+        dates = items_by_day.keys()
+        days = yield ndb.get_multi_async([cls.make_key(account_key, d) for d in dates])
+        # New items are added to the last part of each day.
+        last_keys = [cls.make_key(account_key, d, day.parts - 1)
+                     for d, day in zip(dates, days) if day and day.parts > 1]
+        last_parts = yield ndb.get_multi_async(last_keys)
+        last_parts = {p.key: p for p in last_parts if p}
+        to_put = []
+        for date_, day in zip(dates, days):
+            if not day:
+                day = cls(key=cls.make_key(account_key, date_),
+                          timestamp=datetime.combine(date_, datetime.min.time()))
+            parts = day.parts
+            last = last_parts.get(cls.make_key(account_key, date_, parts - 1), day)
+            remaining = last.set_items(last.items + items_by_day[date_])
+            to_put.append(last)
+            while remaining:
+                part = cls(key=cls.make_key(account_key, date_, day.parts),
+                           timestamp=day.timestamp)
+                remaining = part.set_items(remaining)
+                to_put.append(part)
+                day.parts += 1
+            if last is not day and day.parts > parts:
+                # The first part keeps count of the parts.
+                to_put.append(day)
+        yield ndb.put_multi_async(to_put) + ndb.delete_multi_async([e.key for e in events])
+        raise ndb.Return(sum(len(v) for v in items_by_day.itervalues()))
+
+    @property
+    def items(self):
+        c = self.columns
+        if not c:
+            return []
+        items = []
+        ts = 0
+        for i, delta in enumerate(c['ts']):
+            ts += delta
+            props = dict(c['properties'][i], _cl=c['class'][i], _ct=c['client'][i],
+                         _nm=c['name'][i], _ts=ts)
+            if c['repeats'][i] > 1:
+                props['_rc'] = c['repeats'][i]
+                props['_rt'] = ts - c['repeats_began'][i]
+            items.append(AccountEventItem.from_internal(props))
+        return items
+
+    @classmethod
+    def make_key(cls, account_key, day, part=0):
+        if part:
+            return ndb.Key(cls, '%s.%d' % (day.isoformat(), part), parent=account_key)
+        return ndb.Key(cls, day.isoformat(), parent=account_key)
+
+    def set_items(self, items):
+        """Stores as many of the (oldest) items as fit in the entity and returns the rest."""
+        # Collapse repeated items, including ones that were uploaded in separate batches.
+        collapsed = []
+        for item in sorted(items, key=lambda i: i.timestamp):
+            prev = collapsed[-1] if collapsed else None
+            if prev and prev.is_repeat_of(item):
+                prev.repeats += item.repeats
+                prev.timestamp = item.timestamp
+                continue
+            collapsed.append(item)
+        count = len(collapsed)
+        while True:
+            self.columns = self._make_columns(collapsed[:count])
+            size = len(zlib.compress(json.dumps(self.columns)))
+            if size <= self.MAX_COLUMNS_BYTES or count == 1:
+                break
+            # Items are roughly the same size, so shrink in proportion to the overflow.
+            count = max(min(count * self.MAX_COLUMNS_BYTES // size, count - 1), 1)
+        return collapsed[count:]
+
+    @classmethod
+    def _make_columns(cls, items):
+        c = {k: [] for k in ('class', 'client', 'name', 'properties', 'repeats', 'repeats_began', 'ts')}
+        prev_ts = 0
+        for item in items:
+            ts = convert.unix_timestamp_ms(item.timestamp)
+            c['class'].append(item.event_class)
+            c['client'].append(item.client)
+            c['name'].append(item.name)
+            c['properties'].append(item.properties)
+            c['repeats'].append(item.repeats)
+            c['repeats_began'].append(ts - convert.unix_timestamp_ms(item.repeats_began))
+            # Timestamps are stored as deltas since they are sorted.
+            c['ts'].append(ts - prev_ts)
+            prev_ts = ts
+        return c
+
 
 class AccountEventItem(object):
     __slots__ = ['client', 'event_class', 'name', 'properties', 'repeats', 'repeats_began', 'timestamp']
@@ -791,7 +1067,9 @@ class AccountEventItem(object):
         timestamp = convert.from_unix_timestamp_ms(timestamp_ms)
         repeats = properties.pop('_rc', 1)
         repeats_began = convert.from_unix_timestamp_ms(properties.pop('_rt', timestamp_ms))
-        item = cls(timestamp, name, client=client, event_class=event_class, properties=properties)
+        item = cls(timestamp, name, event_class=event_class, properties=properties)
+        # Set the client separately so that it isn't taken from the current request.
+        item.client = client
         item.repeats = repeats
         item.repeats_began = repeats_began
         return item
@@ -1029,6 +1307,42 @@ class AccountNotification(ndb.Model):
         raise ndb.Return(notif)
 
 
+class AccountTimelineEntry(ndb.Model):
+    """Content by a followed account (child of the follower, id is the content id)."""
+    created = ndb.DateTimeProperty(required=True)
+    creator = ndb.KeyProperty(Account, required=True)
+    tags = ndb.StringProperty(repeated=True)
+
+    @property
+    def content_key(self):
+        return ndb.Key('Content', self.key.id())
+
+    @classmethod
+    def add_async(cls, account_keys, content):
+        """Puts the content in the timeline of every one of the provided accounts."""
+        entries = [cls.from_content(k, content) for k in account_keys]
+        return ndb.put_multi_async(entries)
+
+    @classmethod
+    def from_content(cls, account_key, content):
+        return cls(key=cls.make_key(account_key, content.key),
+                   created=content.created,
+                   creator=content.creator,
+                   tags=content.tags)
+
+    @classmethod
+    def make_key(cls, account_key, content_key):
+        return ndb.Key(cls, content_key.id(), parent=account_key)
+
+    @classmethod
+    def recent_query(cls, account_key, tag, before=None):
+        q = cls.query(cls.tags == tag, ancestor=account_key)
+        if before:
+            q = q.filter(cls.created < before)
+        q = q.order(-cls.created)
+        return q
+
+
 class Attachment(ndb.Expando):
     id = ndb.StringProperty(required=True)
     type = ndb.StringProperty(required=True)
@@ -1365,6 +1679,9 @@ class Content(ndb.Model):
     tags_history = ndb.StringProperty(indexed=False, repeated=True)
     thumb_url_ = ndb.StringProperty('thumb_url', indexed=False)
     title = ndb.StringProperty(indexed=False)
+    # The best reactions by distinct creators, kept up to date by a deferred task.
+    top_reactions = ndb.KeyProperty(kind='Content', indexed=False, repeated=True)
+    top_reactions_updated = ndb.DateTimeProperty(indexed=False)
     useragent = ndb.StringProperty(indexed=False)
     video_url_ = ndb.StringProperty('video_url', indexed=False)
     views = ndb.IntegerProperty(default=0)
@@ -1378,22 +1695,14 @@ class Content(ndb.Model):
     youtube_views = ndb.IntegerProperty()
     youtube_views_updated = ndb.DateTimeProperty(indexed=False)
 
-    def add_comment_count(self, account, count=1):
+    MAX_TOP_REACTIONS = 5
+
+    def add_comment_count(self, count, bonus=0):
         if count < 0 and -count > self.comment_count:
             count = -self.comment_count
         self.comment_count += count
-        if account.key != self.creator:
-            if account.quality >= 4:
-                bonus = 2000
-            elif account.quality == 3:
-                bonus = 1500
-            elif account.quality == 2:
-                bonus = 750 + min(account.follower_count * 5, 250)
-            elif account.quality == 1:
-                bonus = 250 + min(account.follower_count * 5, 500)
-            else:
-                bonus = 100
-            self.add_sort_index_bonus(bonus * count)
+        if bonus:
+            self.add_sort_index_bonus(bonus)
 
     def add_related_count(self, account, count=1, account_reacted_already=False):
         # Note: Returns True if this resulted in first_related_creator being set.
@@ -1433,11 +1742,11 @@ class Content(ndb.Model):
         if bonus < 0 and -bonus > self.sort_bonus:
             bonus = -self.sort_bonus
         age = (datetime.utcnow() - self.created).total_seconds()
-        val = float(age + self.sort_bonus) ** 2 / 186624000000
-        bonus_w_penalty = int(bonus * min(max(1 - val, 0.1), 1))
+        bonus_w_penalty = int(bonus * self.get_sort_bonus_weight(age, self.sort_bonus))
         self.sort_bonus += bonus
         self.sort_bonus_penalty += bonus - bonus_w_penalty
         self.sort_index += bonus_w_penalty
+        self._top_reactions_changed = True
         if self.sort_bonus > 50000:
             self.add_tag('is hot', allow_restricted=True)
 
@@ -1516,6 +1825,39 @@ class Content(ndb.Model):
             title = title[:-len(s)]
         return title.strip()
 
+    @ndb.tasklet
+    def count_comment_async(self, account, count=1):
+        """Counts a new (or deleted) comment without writing to the content entity group.
+
+        The count and sort bonus are kept in sharded counters and folded into the content
+        shortly after, so a busy content doesn't serialize its comments.
+        """
+        bonus = self.get_comment_bonus(account) * count
+        content_id = self.key.id()
+        yield (CounterShard.increment_async('comment_count_%d' % (content_id,), delta=count,
+                                            num_shards=config.CONTENT_COMMENT_SHARDS),
+               CounterShard.increment_async('comment_bonus_%d' % (content_id,), delta=bonus,
+                                            num_shards=config.CONTENT_COMMENT_SHARDS))
+        Content.schedule_comment_counts_fold(self.key)
+
+    @classmethod
+    def decay_sort_indexes(cls, content_list, now):
+        """Computes the sort index that every content would have if all of its bonus
+        decayed with its current age.
+
+        Returns (sort_index, sort_bonus_penalty) for each content. The penalty never goes
+        down, so content that already decayed further keeps its current values.
+        """
+        # Work column by column so that large pages stay cheap to process.
+        ages = [(now - c.created).total_seconds() for c in content_list]
+        bonuses = [c.sort_bonus for c in content_list]
+        bases = [c.sort_base for c in content_list]
+        penalties = [c.sort_bonus_penalty for c in content_list]
+        weights = map(cls.get_sort_bonus_weight, ages, bonuses)
+        penalties = [max(b - int(b * w), p) for b, w, p in zip(bonuses, weights, penalties)]
+        indexes = [s + b - p for s, b, p in zip(bases, bonuses, penalties)]
+        return zip(indexes, penalties)
+
     @classmethod
     def decorate(cls, content_list, include_creator=False, include_related=False, for_account_key=None):
         keys = []
@@ -1555,10 +1897,49 @@ class Content(ndb.Model):
             entities[1 if include_creator else 0] if include_related and self.related_to else None,
             entities[-1] is not None if for_account_key else False)
 
+    @classmethod
+    def fold_comment_counts(cls, *args, **kwargs):
+        return cls.fold_comment_counts_async(*args, **kwargs).get_result()
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def fold_comment_counts_async(cls, content_key):
+        content_id = content_key.id()
+        content, count, bonus = yield (
+            content_key.get_async(),
+            CounterShard.drain_async('comment_count_%d' % (content_id,),
+                                     num_shards=config.CONTENT_COMMENT_SHARDS),
+            CounterShard.drain_async('comment_bonus_%d' % (content_id,),
+                                     num_shards=config.CONTENT_COMMENT_SHARDS))
+        if not content or not (count or bonus):
+            raise ndb.Return(content)
+        content.add_comment_count(count, bonus=bonus)
+        yield content.put_async()
+        raise ndb.Return(content)
+
     @classmethod
     def get_by_youtube_id_async(cls, youtube_id):
         return cls.query(cls.youtube_id_history == youtube_id).get_async()
 
+    def get_comment_bonus(self, account):
+        if account.key == self.creator:
+            return 0
+        if account.quality >= 4:
+            return 2000
+        elif account.quality == 3:
+            return 1500
+        elif account.quality == 2:
+            return 750 + min(account.follower_count * 5, 250)
+        elif account.quality == 1:
+            return 250 + min(account.follower_count * 5, 500)
+        return 100
+
+    @classmethod
+    def get_sort_bonus_weight(cls, age, sort_bonus):
+        # Bonuses are worth less the older the content is and the more bonus it has.
+        val = float(age + sort_bonus) ** 2 / 186624000000
+        return min(max(1 - val, 0.1), 1)
+
     @classmethod
     def get_sort_index(cls):
         delta = datetime.utcnow() - datetime(2017, 5, 1)
@@ -1669,6 +2050,20 @@ class Content(ndb.Model):
             tags = set(t for t in tags if not self.is_tag_restricted(t))
         self.set_tags(set(self.tags) - tags, allow_restricted=True, keep_restricted=False)
 
+    @classmethod
+    def pick_top_reactions(cls, reactions):
+        """Picks the best reactions (sorted by sort_bonus) with at most one per creator."""
+        top = []
+        for r in reactions:
+            if not r or not r.is_public or 'reaction' not in r.tags or 'repost' in r.tags:
+                continue
+            if any(r.creator == rr.creator for rr in top):
+                continue
+            top.append(r)
+            if len(top) >= cls.MAX_TOP_REACTIONS:
+                break
+        return top
+
     @property
     def s3_key(self):
         if not self.video_url:
@@ -1701,6 +2096,7 @@ class Content(ndb.Model):
             self.tags = list(tags)
         if not self.tags:
             raise errors.InvalidArgument('Content must have at least one valid tag')
+        self._top_reactions_changed = True
         if self.is_public and not self.slug:
             # A public tag was added to user content.
             self.slug = self.slug_from_video_url()
@@ -1752,6 +2148,32 @@ class Content(ndb.Model):
             return slug
         return None
 
+    @classmethod
+    def schedule_comment_counts_fold(cls, content_key):
+        # Name the task so that a burst of comments only writes to the content once.
+        window = int(time.time()) // config.CONTENT_COMMENTS_FOLD_DELAY
+        name = 'comment-counts-%d-%d' % (content_key.id(), window)
+        try:
+            deferred.defer(Content._deferred_fold_comment_counts, content_key,
+                           _countdown=config.CONTENT_COMMENTS_FOLD_DELAY,
+                           _name=name,
+                           _queue=config.INTERNAL_QUEUE)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
+    @classmethod
+    def schedule_top_reactions_update(cls, original_key):
+        # Name the task so that a burst of votes and views only updates the original once.
+        window = int(time.time()) // config.TOP_REACTIONS_UPDATE_DELAY
+        name = 'top-reactions-%d-%d' % (original_key.id(), window)
+        try:
+            deferred.defer(Content._deferred_update_top_reactions, original_key,
+                           _countdown=config.TOP_REACTIONS_UPDATE_DELAY,
+                           _name=name,
+                           _queue=config.INTERNAL_QUEUE)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+
     @property
     def sort_base(self):
         return self.sort_index - self.sort_bonus + self.sort_bonus_penalty
@@ -1841,6 +2263,59 @@ class Content(ndb.Model):
             return None
         return 'https://www.youtube.com/watch?v=' + vid
 
+    @classmethod
+    @ndb.transactional_tasklet
+    def rerank_async(cls, content_key, now=None, min_change=0):
+        """Decays the sort index of content to its current age. Returns the content if
+        its sort index changed, otherwise None."""
+        content = yield content_key.get_async()
+        if not content or not content.created:
+            raise ndb.Return(None)
+        [(sort_index, penalty)] = cls.decay_sort_indexes([content], now or datetime.utcnow())
+        if content.sort_index - sort_index <= min_change:
+            raise ndb.Return(None)
+        content.populate(sort_bonus_penalty=penalty, sort_index=sort_index)
+        yield content.put_async()
+        raise ndb.Return(content)
+
+    @classmethod
+    def update_top_reactions(cls, *args, **kwargs):
+        return cls.update_top_reactions_async(*args, **kwargs).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def update_top_reactions_async(cls, original_key):
+        q = cls.query()
+        q = q.filter(cls.related_to == original_key)
+        q = q.filter(cls.tags == 'reaction')
+        q = q.order(-cls.sort_bonus)
+        reactions = yield q.fetch_async(cls.MAX_TOP_REACTIONS * 2)
+        top_keys = [r.key for r in cls.pick_top_reactions(reactions)]
+        original = yield cls._set_top_reactions_async(original_key, top_keys)
+        raise ndb.Return(original)
+
+    @classmethod
+    def _deferred_fold_comment_counts(cls, content_key):
+        content = cls.fold_comment_counts(content_key)
+        if content:
+            logging.debug('Updated content %d comment count to %d',
+                          content_key.id(), content.comment_count)
+
+    @classmethod
+    def _deferred_update_top_reactions(cls, original_key):
+        original = cls.update_top_reactions(original_key)
+        if original:
+            logging.debug('Updated top reactions of %d: %r', original_key.id(),
+                          [k.id() for k in original.top_reactions])
+
+    def _post_put_hook(self, future):
+        if not getattr(self, '_top_reactions_changed', False):
+            return
+        self._top_reactions_changed = False
+        if self.related_to:
+            # The ranking of this reaction on the original may have changed.
+            Content.schedule_top_reactions_update(self.related_to)
+
     def _pre_put_hook(self):
         if self.youtube_id_history:
             # Clean up redundant data in history.
@@ -1856,14 +2331,49 @@ class Content(ndb.Model):
             attrs['video_url_'] = files.storage_url(attrs.pop('video_url'))
         super(Content, self)._set_attributes(attrs)
 
+    @classmethod
+    @ndb.transactional_tasklet
+    def _set_top_reactions_async(cls, original_key, top_keys):
+        original = yield original_key.get_async()
+        if not original:
+            raise ndb.Return(None)
+        if original.top_reactions_updated and original.top_reactions == top_keys:
+            raise ndb.Return(original)
+        # The timestamp tells an empty summary apart from one never computed.
+        original.top_reactions = top_keys
+        original.top_reactions_updated = datetime.utcnow()
+        yield original.put_async()
+        raise ndb.Return(original)
+
 
 class ContentComment(ndb.Model):
     created = ndb.DateTimeProperty(auto_now_add=True)
     creator = ndb.KeyProperty(Account, required=True)
     offset = ndb.IntegerProperty()
+    reply_count = ndb.IntegerProperty(default=0, indexed=False)
     reply_to = ndb.KeyProperty(kind='ContentComment')
     text = ndb.StringProperty(indexed=False)
 
+    @classmethod
+    @ndb.tasklet
+    def get_cache_generation_async(cls, content_key):
+        """Gets the number that cached comment lists of a content are stored under."""
+        context = ndb.get_context()
+        cache_key = 'content_comments_gen_%d' % (content_key.id(),)
+        generation = yield context.memcache_get(cache_key)
+        if generation is None:
+            # Start from the current time so that lists cached under an evicted generation
+            # are never served again.
+            generation = int(time.time())
+            yield context.memcache_add(cache_key, generation)
+        raise ndb.Return(generation)
+
+    @classmethod
+    def invalidate_cache_async(cls, content_key):
+        """Invalidates all cached comment lists of a content (for all API versions)."""
+        cache_key = 'content_comments_gen_%d' % (content_key.id(),)
+        return ndb.get_context().memcache_incr(cache_key, initial_value=int(time.time()))
+
     def public(self, creator=None, version=None, **kwargs):
         data = {
             'created': self.created,
@@ -1876,6 +2386,7 @@ class ContentComment(ndb.Model):
             data['creator_image_url'] = creator.image_url
             data['creator_username'] = creator.username
         if version >= 47:
+            data['reply_count'] = self.reply_count
             data['reply_to'] = self.reply_to.id() if self.reply_to else None
         return data
 
@@ -1892,12 +2403,28 @@ class ContentRequestPublic(ndb.Model):
     properties = ndb.JsonProperty()
     requested = ndb.DateTimeProperty(auto_now_add=True)
     requested_by = ndb.KeyProperty(Account, required=True)
+    # The balance of the reward wallet, copied here whenever the wallet changes.
+    reward = ndb.IntegerProperty(default=0)
+    reward_version = ndb.IntegerProperty(indexed=False)
     sort_index = ndb.IntegerProperty()
     tags = ndb.StringProperty(repeated=True)
     wallet = ndb.KeyProperty(indexed=False, kind='Wallet')
 
+    REWARD_WALLET_ID = re.compile(r'^request_(\d+)_reward$')
     SPECIAL_STATES = {'approved', 'archived', 'denied', 'pending'}
 
+    @property
+    def has_reward(self):
+        """Whether the reward can be read from the request instead of its wallet."""
+        return not self.wallet or self.reward_version is not None
+
+    @classmethod
+    def key_from_wallet_key(cls, wallet_key):
+        match = cls.REWARD_WALLET_ID.match(wallet_key.id())
+        if not match:
+            return None
+        return ndb.Key(cls, int(match.group(1)))
+
     def public(self, version=None, **kwargs):
         data = {
             'closed': self.closed or False,
@@ -1908,6 +2435,20 @@ class ContentRequestPublic(ndb.Model):
             data['reward'] = kwargs.pop('reward')
         return data
 
+    @classmethod
+    @ndb.transactional_tasklet
+    def set_reward_async(cls, request_key, balance, version):
+        request = yield request_key.get_async()
+        if not request:
+            raise ndb.Return(None)
+        if request.reward_version is not None and request.reward_version >= version:
+            # A newer balance has already been stored.
+            raise ndb.Return(request)
+        request.reward = balance
+        request.reward_version = version
+        yield request.put_async()
+        raise ndb.Return(request)
+
     def set_state(self, new_state):
         if not isinstance(new_state, basestring):
             raise TypeError('State must be a string')
@@ -1920,6 +2461,10 @@ class ContentRequestPublic(ndb.Model):
         # TODO: Consider supporting this to be different from requested_by.
         return self.requested_by
 
+    @classmethod
+    def _deferred_set_reward(cls, request_key, balance, version):
+        cls.set_reward_async(request_key, balance, version).get_result()
+
 
 class ContentRequestPublicEntry(ndb.Model):
     VALID_STATUSES = {
@@ -1933,6 +2478,10 @@ class ContentRequestPublicEntry(ndb.Model):
         'pending-youtube',
     }
 
+    # One wallet for the reward pool, then one entry, one wallet and one payment feed entry
+    # per rewarded entry, which has to stay within 25 entity groups.
+    REWARD_BATCH_SIZE = 8
+
     account = ndb.KeyProperty(Account, required=True)
     content = ndb.KeyProperty(Content)
     created = ndb.DateTimeProperty(auto_now_add=True)
@@ -2017,67 +2566,92 @@ class ContentRequestPublicEntry(ndb.Model):
         return cls.reward_async(*args, **kwargs).get_result()
 
     @classmethod
-    @ndb.transactional_tasklet(xg=True)
+    @ndb.tasklet
     def reward_async(cls, entry_key, content, wallet_owner_key, wallet_key):
-        if not isinstance(entry_key, ndb.Key) or entry_key.kind() != cls._get_kind():
-            raise TypeError('Invalid entry_key value')
-        if not isinstance(content, Content):
-            raise TypeError('Invalid content value')
+        amounts = yield cls.reward_multi_async([(entry_key, content)], wallet_owner_key, wallet_key)
+        raise ndb.Return(amounts[0])
+
+    @classmethod
+    def reward_multi(cls, *args, **kwargs):
+        return cls.reward_multi_async(*args, **kwargs).get_result()
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def reward_multi_async(cls, entries, wallet_owner_key, wallet_key):
+        """Rewards a list of (entry_key, content) pairs out of one wallet in a single transaction."""
+        if len(entries) > cls.REWARD_BATCH_SIZE:
+            raise ValueError('Too many entries to reward at once')
+        for entry_key, content in entries:
+            if not isinstance(entry_key, ndb.Key) or entry_key.kind() != cls._get_kind():
+                raise TypeError('Invalid entry_key value')
+            if not isinstance(content, Content):
+                raise TypeError('Invalid content value')
         if not isinstance(wallet_owner_key, ndb.Key) or wallet_owner_key.kind() != 'Account':
             raise TypeError('Invalid wallet_owner_key value')
         if not isinstance(wallet_key, ndb.Key) or wallet_key.kind() != 'Wallet':
             raise TypeError('Invalid wallet_key value')
-        entry = yield entry_key.get_async()
-        if not entry:
+        loaded = yield ndb.get_multi_async([k for k, _ in entries])
+        if not all(loaded):
             raise ValueError('Entry does not exist')
-        # Only update active entries.
-        if entry.status != 'active':
-            logging.debug('Entry %s is not active (content %d)', entry.key.id(), content.key.id())
-            raise ndb.Return(0)
-        # If the YouTube video is broken state switches to inactive.
-        if content.youtube_broken:
-            entry.status = 'inactive'
-            entry.status_reason = 'We could not load your YouTube video. It may have been blocked or deleted.'
-            yield entry.put_async()
-            logging.debug('Entry %s became inactive due to broken YouTube video (content %d)',
-                entry.key.id(), content.key.id())
-            raise ndb.Return(0)
-        # TODO: Validate YouTube description.
-        old_youtube_views = entry.youtube_views or 0
-        new_youtube_views = content.youtube_views or 0
-        # TODO: Consider a threshold to avoid updating too often.
-        if new_youtube_views <= old_youtube_views:
-            logging.debug('Entry %s had no additional YouTube views to reward (content %d)',
-                entry.key.id(), content.key.id())
-            raise ndb.Return(0)
-        # Determine reward amount, up to a maximum every time (to distribute reward better).
-        amount = min(new_youtube_views - old_youtube_views, 250)
-        # TODO: Support rare corner cases where user may not have a wallet.
-        target_wallet_id = 'account_%d' % (entry.account.id(),)
-        target_wallet_key = Wallet.key_from_id(target_wallet_id)
-        tx = yield Wallet.create_tx_async(
-            wallet_owner_key, wallet_key,
-            target_wallet_key, amount, u'Request reward',
-            require_full_amount=False)
-        try:
-            _, _, _, tx2 = yield tx()
-            actual_amount = tx2.delta
-        except WalletInsufficientFunds:
-            actual_amount = 0
-        assert 0 <= actual_amount <= amount
-        entry.reward_earned = (entry.reward_earned or 0) + actual_amount
-        if not actual_amount and entry.youtube_views == new_youtube_views:
-            # Nothing changed.
-            raise ndb.Return(0)
-        # Increment YouTube views on entry only by the awarded amount so we don't forget unpaid rewards.
-        entry.youtube_views = old_youtube_views + actual_amount
-        yield entry.put_async()
-        logging.debug('Added %d to wallet for owner of entry %s (content %d)',
-            actual_amount, entry.key.id(), content.key.id())
-        if actual_amount < amount:
-            logging.warning('Could not award remaining %d due to insufficient funds',
-                amount - actual_amount)
-        raise ndb.Return(actual_amount)
+        amounts = [0] * len(entries)
+        dirty = []
+        pending = []
+        for i, ((_, content), entry) in enumerate(zip(entries, loaded)):
+            # Only update active entries.
+            if entry.status != 'active':
+                logging.debug('Entry %s is not active (content %d)', entry.key.id(), content.key.id())
+                continue
+            # If the YouTube video is broken state switches to inactive.
+            if content.youtube_broken:
+                entry.status = 'inactive'
+                entry.status_reason = 'We could not load your YouTube video. It may have been blocked or deleted.'
+                dirty.append(entry)
+                logging.debug('Entry %s became inactive due to broken YouTube video (content %d)',
+                    entry.key.id(), content.key.id())
+                continue
+            # TODO: Validate YouTube description.
+            old_youtube_views = entry.youtube_views or 0
+            new_youtube_views = content.youtube_views or 0
+            # TODO: Consider a threshold to avoid updating too often.
+            if new_youtube_views <= old_youtube_views:
+                logging.debug('Entry %s had no additional YouTube views to reward (content %d)',
+                    entry.key.id(), content.key.id())
+                continue
+            # Determine reward amount, up to a maximum every time (to distribute reward better).
+            amount = min(new_youtube_views - old_youtube_views, 250)
+            pending.append((i, entry, content, amount))
+        if pending:
+            # TODO: Support rare corner cases where user may not have a wallet.
+            transfers = []
+            for _, entry, _, amount in pending:
+                target_wallet_key = Wallet.key_from_id('account_%d' % (entry.account.id(),))
+                transfers.append((target_wallet_key, amount, u'Request reward'))
+            tx = yield Wallet.create_batch_tx_async(
+                wallet_owner_key, wallet_key, transfers,
+                require_full_amount=False)
+            try:
+                _, results = yield tx()
+            except WalletInsufficientFunds:
+                results = [None] * len(pending)
+            for (i, entry, content, amount), result in zip(pending, results):
+                actual_amount = result[2].delta if result else 0
+                assert 0 <= actual_amount <= amount
+                if actual_amount < amount:
+                    logging.warning('Could not award remaining %d to entry %s due to insufficient funds',
+                        amount - actual_amount, entry.key.id())
+                if not actual_amount:
+                    # Nothing changed.
+                    continue
+                entry.reward_earned = (entry.reward_earned or 0) + actual_amount
+                # Increment YouTube views on entry only by the awarded amount so we don't forget unpaid rewards.
+                entry.youtube_views = (entry.youtube_views or 0) + actual_amount
+                dirty.append(entry)
+                amounts[i] = actual_amount
+                logging.debug('Added %d to wallet for owner of entry %s (content %d)',
+                    actual_amount, entry.key.id(), content.key.id())
+        if dirty:
+            yield ndb.put_multi_async(dirty)
+        raise ndb.Return(amounts)
 
     @classmethod
     def split_key(cls, entry_key):
@@ -2169,6 +2743,22 @@ class CounterShard(ndb.Model):
     def decrement_async(cls, name, delta=1, num_shards=3, parent=None):
         return cls._change_async(name, -delta, num_shards, parent)
 
+    @classmethod
+    @ndb.tasklet
+    def drain_async(cls, name, num_shards=3, parent=None):
+        """Resets a counter to zero and returns what it was at. Should be run in the same
+        transaction that applies the count elsewhere."""
+        all_keys = cls._make_keys(name, num_shards, parent=parent)
+        counters = yield ndb.get_multi_async(all_keys)
+        counters = [c for c in counters if c and c.count]
+        total = sum(c.count for c in counters)
+        for counter in counters:
+            counter.count = 0
+        if counters:
+            prefix = parent.urlsafe() if parent else ''
+            yield ndb.put_multi_async(counters), ndb.get_context().memcache_delete(prefix + name)
+        raise ndb.Return(total)
+
     @classmethod
     @ndb.tasklet
     def get_count_async(cls, name, num_shards=3, parent=None):
@@ -2457,9 +3047,19 @@ class Identity(ndb.Model, StatusMixin):
         else:
             identity = cls(id=identifier)
         identity.put()
+        cls.get_request_cache().pop(identifier, None)
         logging.debug('Claimed identifier %r', identifier)
         return identity
 
+    @classmethod
+    def get_request_cache(cls):
+        """Gets the account keys of identifiers that were looked up during this request."""
+        if not has_request_context():
+            return {}
+        if not hasattr(g, 'identity_accounts'):
+            g.identity_accounts = {}
+        return g.identity_accounts
+
     @classmethod
     @ndb.transactional(xg=True)
     def release(cls, identifier, assert_account_key=None):
@@ -2474,6 +3074,7 @@ class Identity(ndb.Model, StatusMixin):
         identity.account = None
         identity.status = None
         identity.put()
+        cls.get_request_cache().pop(identifier, None)
         # Remove the identifier from the associated account (if any).
         if not account_key:
             logging.debug('Freed identifier %r (no account)', identifier)
@@ -3325,16 +3926,115 @@ class ThreadMessageCached(ThreadMessage):
         return self.public_with_id(self.message_id, **kwargs)
 
 
+class ThreadInboxEntry(ndb.Model):
+    """A thread in the inbox of an account (child of the Account, id is the thread id)."""
+    last_interaction = ndb.DateTimeProperty(required=True)
+    last_message = ndb.LocalStructuredProperty(ThreadMessageCached)
+    seen_until = ndb.KeyProperty(indexed=False, kind='ThreadMessage')
+    seen_until_timestamp = ndb.DateTimeProperty(indexed=False)
+    visible = ndb.BooleanProperty(default=True, required=True)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def add_from_thread_async(cls, account_key, thread):
+        """Creates the entry for a thread that predates inboxes unless it already exists."""
+        entry = yield cls.make_key(account_key, thread.key).get_async()
+        if not entry:
+            entry = cls.from_thread(account_key, thread)
+            yield entry.put_async()
+        raise ndb.Return(entry)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def deliver_async(cls, account_key, thread, message, keep_hidden=False):
+        """Puts a new message at the top of the account's inbox.
+
+        Only the account's own entity group is touched so participants are updated
+        independently of each other and of the thread.
+        """
+        entry = yield cls.make_key(account_key, thread.key).get_async()
+        if not entry:
+            # New threads are not visible_by anyone so they start out hidden.
+            entry = cls.from_thread(account_key, thread)
+        elif entry.last_interaction > message.created:
+            # A newer message has already been delivered.
+            raise ndb.Return(entry)
+        entry.last_interaction = message.created
+        entry.last_message = ThreadMessageCached.from_message(message)
+        if message.account == account_key:
+            entry.seen_until = message.key
+            entry.seen_until_timestamp = message.created
+        if not (keep_hidden and not entry.visible):
+            entry.visible = True
+        yield entry.put_async()
+        raise ndb.Return(entry)
+
+    @classmethod
+    def from_thread(cls, account_key, thread):
+        entry = cls(key=cls.make_key(account_key, thread.key),
+                    last_interaction=thread.last_interaction,
+                    last_message=thread.messages[0] if thread.messages else None,
+                    visible=account_key in thread.visible_by)
+        for thread_account in thread.accounts:
+            if thread_account.account == account_key:
+                entry.seen_until = thread_account.seen_until
+                entry.seen_until_timestamp = thread_account.seen_until_timestamp
+                break
+        return entry
+
+    @property
+    def is_seen(self):
+        if not self.last_message:
+            return True
+        return self.seen_until == self.last_message.key_with_parent(self.thread_key)
+
+    @classmethod
+    def make_key(cls, account_key, thread_key):
+        return ndb.Key(cls, thread_key.id(), parent=account_key)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def set_seen_until_async(cls, account_key, thread, message_key, timestamp):
+        entry = yield cls.make_key(account_key, thread.key).get_async()
+        if not entry:
+            entry = cls.from_thread(account_key, thread)
+        elif entry.seen_until and entry.seen_until.id() >= message_key.id():
+            raise ndb.Return(entry)
+        entry.seen_until = message_key
+        entry.seen_until_timestamp = timestamp
+        yield entry.put_async()
+        raise ndb.Return(entry)
+
+    @classmethod
+    @ndb.transactional_tasklet
+    def set_visible_async(cls, account_key, thread, visible):
+        entry = yield cls.make_key(account_key, thread.key).get_async()
+        if not entry:
+            entry = cls.from_thread(account_key, thread)
+        elif entry.visible == visible:
+            raise ndb.Return(entry)
+        entry.visible = visible
+        yield entry.put_async()
+        raise ndb.Return(entry)
+
+    @property
+    def thread_key(self):
+        return ndb.Key('Thread', self.key.id())
+
+
 class Thread(ndb.Model):
     accounts = ndb.LocalStructuredProperty(ThreadAccount, repeated=True)
     created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
     last_interaction = ndb.DateTimeProperty(auto_now_add=True)
     messages = ndb.LocalStructuredProperty(ThreadMessageCached, repeated=True)
+    # Only kept for threads that have not been copied to ThreadInboxEntry yet.
     visible_by = ndb.KeyProperty(Account, repeated=True)
 
+    MAX_CACHED_MESSAGES = 10
+
     @classmethod
     @ndb.transactional_tasklet
-    def add_message_async(cls, thread_key, account_key, type, text, data, account=None, allow_nonuser_type=False, keep_hidden_from_sender=False):
+    def add_message_async(cls, thread_key, account_key, type, text, data, account=None, allow_nonuser_type=False):
         if not isinstance(thread_key, ndb.Key) or thread_key.kind() != 'Thread':
             raise ValueError('Invalid Thread key')
         if not isinstance(account_key, ndb.Key) or account_key.kind() != 'Account':
@@ -3366,8 +4066,9 @@ class Thread(ndb.Model):
         message = ThreadMessage(key=message_key, account=account_key,
                                 created=datetime.utcnow(),
                                 data=data, text=text, type=type)
-        # Insert a cached message object in the thread (maximum of 10).
-        thread.messages = [ThreadMessageCached.from_message(message)] + thread.messages[:9]
+        # Insert a cached message object in the thread.
+        cached = ThreadMessageCached.from_message(message)
+        thread.messages = [cached] + thread.messages[:cls.MAX_CACHED_MESSAGES - 1]
         # Update the account object in the thread.
         del thread.accounts[index]
         thread_account.seen_until = message_key
@@ -3376,12 +4077,8 @@ class Thread(ndb.Model):
             # Update the ThreadAccount entity with new metadata.
             thread_account.update(account)
         thread.accounts.insert(0, thread_account)
-        # Update the thread properties.
+        # Update the thread properties. Inboxes are updated separately (see ThreadInboxEntry).
         thread.last_interaction = now
-        hidden_from_sender = account_key not in thread.visible_by
-        thread.visible_by = [a.account for a in thread.accounts]
-        if keep_hidden_from_sender and hidden_from_sender:
-            thread.visible_by.remove(account_key)
         # Store the thread and message objects, then return them.
         yield ndb.put_multi_async([thread, message])
         raise ndb.Return((thread, message))
@@ -3419,6 +4116,45 @@ class Thread(ndb.Model):
         return ndb.Key('Thread', base64.urlsafe_b64encode(binary).rstrip('='))
 
 
+class TopAccountsSnapshot(ndb.Model):
+    CATEGORIES = ('first', 'payments', 'votes')
+    CATEGORIES_WITH_TAG = ('first', 'votes')
+
+    category = ndb.StringProperty(indexed=False, required=True)
+    requested = ndb.DateTimeProperty()
+    rows = ndb.JsonProperty(required=True)
+    tag = ndb.StringProperty(indexed=False)
+    ts_max = ndb.DateTimeProperty(indexed=False, required=True)
+    ts_min = ndb.DateTimeProperty(indexed=False, required=True)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    @classmethod
+    def current_window(cls):
+        """Returns the (ts_min, ts_max) range of the leaderboards that should currently be
+        shown, which is the past seven days up until the most recent New York midnight.
+        """
+        tz = pytz.timezone('America/New_York')
+        midnight = pytz.utc.localize(datetime.utcnow()).astimezone(tz)
+        midnight = midnight.replace(hour=0, minute=0, second=0, microsecond=0)
+        ts_max = midnight.astimezone(pytz.utc).replace(tzinfo=None)
+        return ts_max - timedelta(days=7), ts_max
+
+    @property
+    def is_current(self):
+        _, ts_max = self.current_window()
+        return self.ts_max == ts_max
+
+    @classmethod
+    def make_key(cls, category, tag=None):
+        if category not in cls.CATEGORIES:
+            raise ValueError('Invalid category %r' % (category,))
+        if tag:
+            if category not in cls.CATEGORIES_WITH_TAG:
+                raise ValueError('Category %r does not support tags' % (category,))
+            return ndb.Key(cls, u'%s:%s' % (category, tag))
+        return ndb.Key(cls, category)
+
+
 class Wallet(ndb.Model):
     account = ndb.KeyProperty(Account, required=True)
     balance = ndb.IntegerProperty(default=0, required=True)
@@ -3429,6 +4165,10 @@ class Wallet(ndb.Model):
     total_sent = ndb.IntegerProperty(default=0, required=True)
     updated = ndb.DateTimeProperty(auto_now=True, required=True)
 
+    # The source wallet, then one wallet and one payment feed entry per transfer, which has
+    # to stay within 25 entity groups.
+    MAX_BATCH_SIZE = 12
+
     @classmethod
     def create(cls, *args, **kwargs):
         return cls.create_async(*args, **kwargs).get_result()
@@ -3480,6 +4220,85 @@ class Wallet(ndb.Model):
         # Return the updated destination wallet.
         raise ndb.Return(wallet)
 
+    @classmethod
+    def create_batch_tx(cls, *args, **kwargs):
+        return cls.create_batch_tx_async(*args, **kwargs).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def create_batch_tx_async(cls, account_key, w1_key, transfers, require_full_amount=True):
+        """Creates a transaction that pays out of w1 to many wallets at once.
+
+        The transfers argument is a list of (wallet_key, amount, comment) tuples. When
+        require_full_amount is False, transfers are paid in order until w1 runs out and
+        transfers that could not be paid at all get None in the result.
+        """
+        if not isinstance(account_key, ndb.Key) or account_key.kind() != 'Account':
+            raise TypeError('account_key must be an Account key')
+        if not isinstance(w1_key, ndb.Key) or w1_key.kind() != 'Wallet':
+            raise TypeError('w1_key must be a Wallet key')
+        if not transfers:
+            raise ValueError('transfers must not be empty')
+        if len(transfers) > cls.MAX_BATCH_SIZE:
+            raise ValueError('Too many transfers in one batch')
+        w2_keys = []
+        for w2_key, amount, comment in transfers:
+            if not isinstance(w2_key, ndb.Key) or w2_key.kind() != 'Wallet':
+                raise TypeError('w2_key must be a Wallet key')
+            if not isinstance(amount, (int, long)) or amount < 1:
+                raise TypeError('amount must be a positive integer')
+            if not isinstance(comment, basestring) or not len(comment):
+                raise TypeError('comment must be a valid string')
+            if w2_key == w1_key:
+                raise ValueError('Do not transfer to same wallet')
+            if w2_key in w2_keys:
+                raise ValueError('Do not transfer to the same wallet twice in one batch')
+            w2_keys.append(w2_key)
+        total = sum(amount for _, amount, _ in transfers)
+        wallets = yield ndb.get_multi_async([w1_key] + w2_keys)
+        if not all(wallets):
+            raise ValueError('All keys must be valid Wallet keys')
+        w1 = wallets[0]
+        if w1.account != account_key:
+            raise ValueError('w1 must be owned by account_key')
+        if (require_full_amount and w1.balance < total) or not w1.balance:
+            @ndb.tasklet
+            def tx():
+                raise WalletInsufficientFunds()
+            raise ndb.Return(tx)
+        @ndb.transactional_tasklet(xg=True)
+        def tx():
+            wallets_ = yield ndb.get_multi_async([w1_key] + w2_keys)
+            if [w.last_tx for w in wallets_] != [w.last_tx for w in wallets]:
+                raise WalletChanged()
+            if require_full_amount and wallets_[0].balance < total:
+                raise WalletInsufficientFunds()
+            if not wallets_[0].balance:
+                raise WalletInsufficientFunds()
+            w1_ = wallets_[0]
+            now = datetime.utcnow()
+            entities = []
+            results = []
+            # Every transfer chains onto the w1 transaction created before it.
+            for (_, amount, comment), w2_ in zip(transfers, wallets_[1:]):
+                amount_ = min(amount, w1_.balance)
+                if not amount_:
+                    results.append(None)
+                    continue
+                tx1, tx2, tx_entities = cls._transfer(w1_, w2_, amount_, comment, now)
+                entities.extend(tx_entities)
+                entities.append(w2_)
+                results.append((tx1, w2_, tx2))
+            entities.append(w1_)
+            yield ndb.put_multi_async(entities)
+            if sum(w.balance for w in wallets) != sum(w.balance for w in wallets_):
+                raise errors.ServerError('Balance mismatch')
+            for w in wallets_:
+                if w.total_received - w.total_sent != w.balance:
+                    raise errors.ServerError('Balance mismatch')
+            raise ndb.Return((w1_, results))
+        raise ndb.Return(tx)
+
     @classmethod
     def create_internal(cls, *args, **kwargs):
         return cls.create_internal_async(*args, **kwargs).get_result()
@@ -3551,23 +4370,8 @@ class Wallet(ndb.Model):
                 amount_ = amount
             if w1_.balance < amount_:
                 raise WalletInsufficientFunds()
-            tx1_hash = WalletTransaction.make_hash(w1_, w1_.account, w2_.account, -amount_)
-            w1_.last_tx = tx1_hash
-            tx1_key = ndb.Key(WalletTransaction, tx1_hash, parent=w1_key)
-            tx2_hash = WalletTransaction.make_hash(w2_, w1_.account, w2_.account, amount_)
-            w2_.last_tx = tx2_hash
-            tx2_key = ndb.Key(WalletTransaction, tx2_hash, parent=w2_key)
-            tx1 = WalletTransaction(key=tx1_key, delta=-amount_, comment=comment, other_tx=tx2_key,
-                                    old_balance=w1_.balance, new_balance=w1_.balance - amount_,
-                                    sender=w1_.account, receiver=w2_.account)
-            w1_.balance = tx1.new_balance
-            w1_.total_sent += amount_
-            tx2 = WalletTransaction(key=tx2_key, delta=amount_, comment=comment, other_tx=tx1_key,
-                                    old_balance=w2_.balance, new_balance=w2_.balance + amount_,
-                                    sender=w1_.account, receiver=w2_.account)
-            w2_.balance = tx2.new_balance
-            w2_.total_received += amount_
-            yield ndb.put_multi_async([tx1, tx2, w1_, w2_])
+            tx1, tx2, entities = cls._transfer(w1_, w2_, amount_, comment, datetime.utcnow())
+            yield ndb.put_multi_async(entities + [w1_, w2_])
             if w1.balance + w2.balance != w1_.balance + w2_.balance:
                 raise errors.ServerError('Balance mismatch')
             if w1_.total_received - w1_.total_sent != w1_.balance:
@@ -3592,17 +4396,111 @@ class Wallet(ndb.Model):
             'created': self.created,
         }
 
+    def _pre_put_hook(self):
+        request_key = ContentRequestPublic.key_from_wallet_key(self.key)
+        if not request_key:
+            return
+        # Every transfer increases one of the totals so their sum orders balance updates.
+        deferred.defer(ContentRequestPublic._deferred_set_reward, request_key,
+                       self.balance, self.total_received + self.total_sent,
+                       _queue=config.INTERNAL_QUEUE,
+                       _transactional=ndb.in_transaction())
+
+    @classmethod
+    def _transfer(cls, w1, w2, amount, comment, timestamp):
+        # Note: Updates both wallets in place, only the transactions are returned for storage.
+        tx1_hash = WalletTransaction.make_hash(w1, w1.account, w2.account, -amount)
+        w1.last_tx = tx1_hash
+        tx1_key = ndb.Key(WalletTransaction, tx1_hash, parent=w1.key)
+        tx2_hash = WalletTransaction.make_hash(w2, w1.account, w2.account, amount)
+        w2.last_tx = tx2_hash
+        tx2_key = ndb.Key(WalletTransaction, tx2_hash, parent=w2.key)
+        tx1 = WalletTransaction(key=tx1_key, delta=-amount, comment=comment, other_tx=tx2_key,
+                                old_balance=w1.balance, new_balance=w1.balance - amount,
+                                sender=w1.account, receiver=w2.account, timestamp=timestamp)
+        w1.balance = tx1.new_balance
+        w1.total_sent += amount
+        tx2 = WalletTransaction(key=tx2_key, delta=amount, comment=comment, other_tx=tx1_key,
+                                old_balance=w2.balance, new_balance=w2.balance + amount,
+                                sender=w1.account, receiver=w2.account, timestamp=timestamp)
+        w2.balance = tx2.new_balance
+        w2.total_received += amount
+        entities = [tx1, tx2]
+        # Add the transfer to the public payment feed if it qualifies.
+        payment = WalletPayment.from_transaction(tx2)
+        if payment:
+            entities.append(payment)
+        return tx1, tx2, entities
+
 
 class WalletChanged(Exception):
     def __init__(self):
         super(WalletChanged, self).__init__('Another transaction occurred, please try again')
 
 
+class WalletCheckpoint(ndb.Model):
+    """The verified state of a wallet right after one of its transactions."""
+    balance = ndb.IntegerProperty(indexed=False, required=True)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    last_tx = ndb.StringProperty(indexed=False, required=True)
+    timestamp = ndb.DateTimeProperty(required=True)
+    total_received = ndb.IntegerProperty(indexed=False, required=True)
+    total_sent = ndb.IntegerProperty(indexed=False, required=True)
+    tx_count = ndb.IntegerProperty(indexed=False, required=True)
+
+    @classmethod
+    def latest(cls, *args, **kwargs):
+        return cls.latest_async(*args, **kwargs).get_result()
+
+    @classmethod
+    def latest_async(cls, wallet_key, before=None):
+        q = cls.query(ancestor=wallet_key)
+        if before:
+            q = q.filter(cls.timestamp <= before)
+        q = q.order(-cls.timestamp)
+        return q.get_async()
+
+
 class WalletInsufficientFunds(errors.InvalidArgument):
     def __init__(self):
         super(WalletInsufficientFunds, self).__init__('Insufficient funds')
 
 
+class WalletPayment(ndb.Model):
+    """An entry in the public payment feed, written together with the transaction."""
+    amount = ndb.IntegerProperty(indexed=False, required=True)
+    comment = ndb.StringProperty(indexed=False)
+    receiver = ndb.KeyProperty(Account, indexed=False, required=True)
+    sender = ndb.KeyProperty(Account, indexed=False, required=True)
+    timestamp = ndb.DateTimeProperty(required=True)
+    tx = ndb.KeyProperty(kind='WalletTransaction', indexed=False, required=True)
+
+    @classmethod
+    def from_transaction(cls, tx):
+        # Transactions where coins were removed are represented by the other side.
+        if tx.delta <= 0:
+            return None
+        # Don't show transactions where user bought coins.
+        if tx.receiver == tx.sender:
+            return None
+        # Don't show free coins via admin (sent by @reaction.cam).
+        if tx.sender.id() == config.REACTION_CAM_ID:
+            return None
+        comment = re.sub(r'^Payment \((.*?)\)$', r'\1', tx.comment)
+        if comment == 'None':
+            comment = None
+        if not comment and convert.unix_timestamp_ms(tx.timestamp) % 1000 < 950:
+            # Skip ~95% of bot transactions.
+            return None
+        return cls(id=tx.key.id(), amount=tx.delta, comment=comment,
+                   receiver=tx.receiver, sender=tx.sender,
+                   timestamp=tx.timestamp, tx=tx.key)
+
+    @classmethod
+    def latest_query(cls):
+        return cls.query().order(-cls.timestamp)
+
+
 class WalletTransaction(ndb.Model):
     comment = ndb.StringProperty(indexed=False, required=True)
     delta = ndb.IntegerProperty(required=True)
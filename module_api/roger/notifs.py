@@ -9,7 +9,7 @@ import logging
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
-from roger import config, external, models, push_service
+from roger import config, external, identity_map, models, push_service
 from roger_common import convert, events, identifiers
 
 
@@ -503,7 +503,8 @@ class Event(object):
             self.event_account_key = event_account.key
         else:
             self._account = None
-            self.event_account_key = models.Account.resolve_key(event_account)
+            self.event_account_key = (identity_map.resolve_key(event_account) or
+                                      models.Account.resolve_key(event_account))
             if not self.event_account_key:
                 raise ValueError('Expected a valid Account key or instance')
         self.event_type = event_type
@@ -514,8 +515,8 @@ class Event(object):
     @property
     def event_account(self):
         if not self._account:
-            # TODO: Propagate this to Hub.
-            self._account = self.event_account_key.get()
+            # Accounts are shared with the Hub (and streams) through the request's map.
+            self._account = identity_map.current().get_multi([self.event_account_key])[0]
             logging.debug('notifs.Event loaded account %d', self.event_account_key.id())
         return self._account
 
@@ -582,14 +583,15 @@ class Hub(object):
             self.account_key = account.key
         else:
             self._account = None
-            self.account_key = models.Account.resolve_key(account)
+            self.account_key = (identity_map.resolve_key(account) or
+                                models.Account.resolve_key(account))
             if not self.account_key:
                 raise ValueError('Expected a valid Account key or instance')
 
     @property
     def account(self):
         if not self._account:
-            self._account = self.account_key.get()
+            self._account = identity_map.current().get_multi([self.account_key])[0]
             logging.debug('notifs.Hub loaded account %d', self.account_key.id())
         return self._account
 
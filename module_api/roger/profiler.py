@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map, memcache
+
+from flask import request
+
+from roger import config
+
+
+# The RPCs worth keeping track of, by service.
+TRACKED_SERVICES = {'datastore_v3', 'memcache', 'taskqueue', 'urlfetch'}
+
+
+_local = threading.local()
+_lock = threading.Lock()
+# The API proxy that the hooks were registered on (tests replace it).
+_hooked_apiproxy = None
+
+# Per-instance aggregates that have not been flushed to memcache yet.
+_pending = collections.defaultdict(int)
+_last_flush = time.time()
+
+
+class Profile(object):
+    """The RPCs made by the current request."""
+    __slots__ = ['phases', 'rpcs', 'start', 'started']
+
+    def __init__(self):
+        self.phases = {}
+        self.rpcs = []
+        self.start = time.time()
+        # Start times of RPCs that have not finished yet, by id of the RPC request.
+        self.started = {}
+
+    def elapsed_ms(self, since=None):
+        return int((time.time() - (since or self.start)) * 1000)
+
+
+def current():
+    return getattr(_local, 'profile', None)
+
+
+def current_window():
+    return int(time.time()) // config.PROFILER_WINDOW
+
+
+def get_stats(window=None):
+    """Gets aggregate stats for a window (defaults to the current one)."""
+    if window is None:
+        window = current_window()
+    prefix = 'profiler_%d_' % (window,)
+    names = memcache.get(prefix + 'index') or []
+    values = memcache.get_multi(names, key_prefix=prefix)
+    stats = {}
+    for name, value in values.iteritems():
+        endpoint, metric = name.rsplit(':', 1)
+        stats.setdefault(endpoint, {})[metric] = value
+    return stats
+
+
+def get_slow_requests():
+    keys = ['profiler_slow_%d' % (i,) for i in xrange(config.PROFILER_SLOW_REQUESTS_KEPT)]
+    traces = memcache.get_multi(keys).values()
+    return sorted(traces, key=lambda t: t['timestamp'], reverse=True)
+
+
+def install(app):
+    """Profiles all requests handled by the Flask app."""
+    _register_hooks()
+    app.before_request(_start)
+    app.teardown_request(_finish)
+
+
+def last():
+    """The profile of the last request that finished on this thread."""
+    return getattr(_local, 'last_profile', None)
+
+
+def note_phase(name, duration_ms):
+    """Records how long a named phase of the request took (e.g., authentication)."""
+    profile = current()
+    if profile:
+        profile.phases[name] = duration_ms
+
+
+def _endpoint():
+    if not request.url_rule:
+        return 'unknown'
+    version = (request.view_args or {}).get('version', '')
+    return '%s %s%s' % (request.method, request.url_rule.rule,
+                        ' ' + version if version else '')
+
+
+def _finish(exception=None):
+    profile = current()
+    if not profile:
+        return
+    # Stop profiling before flushing so the flush itself isn't counted.
+    _local.profile = None
+    _local.last_profile = profile
+    try:
+        endpoint = _endpoint()
+        duration_ms = profile.elapsed_ms()
+        with _lock:
+            _pending['%s:requests' % (endpoint,)] += 1
+            _pending['%s:ms' % (endpoint,)] += duration_ms
+            for _, rpc, rpc_ms in profile.rpcs:
+                _pending['%s:%s' % (endpoint, rpc)] += 1
+                _pending['%s:%s_ms' % (endpoint, rpc)] += rpc_ms
+        if duration_ms >= config.PROFILER_SLOW_REQUEST_MS:
+            _save_slow_request(endpoint, duration_ms, profile)
+        if time.time() - _last_flush >= config.PROFILER_FLUSH_INTERVAL:
+            _flush()
+    except:
+        logging.exception('Failed to record request profile')
+
+
+def _flush():
+    global _last_flush
+    with _lock:
+        deltas = dict(_pending)
+        _pending.clear()
+        _last_flush = time.time()
+    if not deltas:
+        return
+    prefix = 'profiler_%d_' % (current_window(),)
+    ttl = config.PROFILER_WINDOW * 3
+    memcache.offset_multi(deltas, key_prefix=prefix, initial_value=0)
+    # Keep an index of all the names so that the stats can be listed.
+    client = memcache.Client()
+    for _ in xrange(5):
+        names = client.gets(prefix + 'index')
+        if names is None:
+            if client.add(prefix + 'index', sorted(deltas), time=ttl):
+                return
+            continue
+        missing = set(deltas).difference(names)
+        if not missing:
+            return
+        if client.cas(prefix + 'index', sorted(missing.union(names)), time=ttl):
+            return
+    logging.warning('Could not update profiler index')
+
+
+def _post_call_hook(service, call, rpc_request, rpc_response, rpc=None, error=None):
+    profile = current()
+    if not profile:
+        return
+    started = profile.started.pop(id(rpc_request), None)
+    if started is None:
+        return
+    name = '%s.%s' % (service, call)
+    profile.rpcs.append((profile.elapsed_ms(), name, profile.elapsed_ms(started)))
+
+
+def _pre_call_hook(service, call, rpc_request, rpc_response, rpc=None):
+    profile = current()
+    if not profile or service not in TRACKED_SERVICES:
+        return
+    profile.started[id(rpc_request)] = time.time()
+
+
+def _register_hooks():
+    global _hooked_apiproxy
+    apiproxy = apiproxy_stub_map.apiproxy
+    if apiproxy is _hooked_apiproxy:
+        return
+    apiproxy.GetPreCallHooks().Append('roger_profiler', _pre_call_hook)
+    apiproxy.GetPostCallHooks().Append('roger_profiler', _post_call_hook)
+    _hooked_apiproxy = apiproxy
+
+
+def _save_slow_request(endpoint, duration_ms, profile):
+    trace = {
+        'duration_ms': duration_ms,
+        'endpoint': endpoint,
+        'path': request.path,
+        'phases': profile.phases,
+        # Each RPC is (ms since request start when it finished, name, ms it took).
+        'rpcs': profile.rpcs,
+        'timestamp': time.time(),
+    }
+    # Keep the most recent slow requests in a ring of memcache keys.
+    index = memcache.incr('profiler_slow_counter', initial_value=0)
+    slot = (index or 0) % config.PROFILER_SLOW_REQUESTS_KEPT
+    memcache.set('profiler_slow_%d' % (slot,), trace, time=86400)
+
+
+def _start():
+    if not config.PROFILER_ENABLED:
+        return
+    _register_hooks()
+    _local.profile = Profile()
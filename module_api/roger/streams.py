@@ -7,11 +7,11 @@ import logging
 import os.path
 import urllib
 
-from google.appengine.api import taskqueue, urlfetch
+from google.appengine.api import memcache, taskqueue, urlfetch
 from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import deferred, ndb
 
-from roger import config, files, models, notifs
+from roger import config, files, identity_map, models, notifs
 from roger_common import convert, errors, events, identifiers, reporting
 
 
@@ -111,10 +111,8 @@ class Stream(object):
         if not isinstance(stream, models.Stream):
             raise TypeError('Expected a stream')
         self._stream = stream
-        if not account_map:
-            account_keys = [p.account for p in stream.participants]
-            account_map = dict(zip(account_keys, ndb.get_multi(account_keys)))
-        self._account_map = account_map
+        # Accounts are shared by all streams in a request and loaded when first needed.
+        self._account_map = account_map if account_map is not None else identity_map.current()
         self._chunks = chunks
 
     @property
@@ -132,7 +130,8 @@ class Stream(object):
 
     def get_accounts(self, exclude_account=None):
         if exclude_account:
-            exclude_account = models.Account.resolve_key(exclude_account)
+            exclude_account = (identity_map.resolve_key(exclude_account) or
+                               models.Account.resolve_key(exclude_account))
         self._lookup_accounts(self.participants)
         return [ParticipantAccount(p, self._account_map[p.account])
                 for p in self.participants
@@ -153,7 +152,7 @@ class Stream(object):
         return '{}_{}'.format(self._stream.key.id(), chunk_id)
 
     def get_participant(self, participant):
-        key = models.Account.resolve_key(participant)
+        key = identity_map.resolve_key(participant) or models.Account.resolve_key(participant)
         # Search participants for the account key.
         for p in self._stream.participants:
             if p.account == key:
@@ -169,8 +168,7 @@ class Stream(object):
     def join(self, account, reason='unknown', **kwargs):
         # TODO: Do something with reason parameter.
         # TODO: Decide on 1:1 restrictions.
-        account = models.Account.resolve(account)
-        self._account_map[account.key] = account
+        account = self._account_map.resolve(account)
         # Create a stream object specifically for the account that joined.
         stream = MutableStream(account, self._stream, account_map=self._account_map,
                                chunks=self._chunks)
@@ -210,18 +208,7 @@ class Stream(object):
         return self.service.id() if self.service else None
 
     def _lookup_accounts(self, values):
-        accounts = []
-        for value in values:
-            if isinstance(value, models.Account):
-                self._account_map[value.key] = value
-            else:
-                value = models.Account.resolve_key(value)
-                value = self._account_map.get(value, value)
-            accounts.append(value)
-        accounts = models.Account.resolve_list(accounts)
-        for account in accounts:
-            self._account_map[account.key] = account
-        return accounts
+        return self._account_map.resolve_list(values)
 
 
 class MutableStream(Stream):
@@ -231,7 +218,7 @@ class MutableStream(Stream):
     def __init__(self, me, stream, disable_autojoin=False, **kwargs):
         super(MutableStream, self).__init__(stream, **kwargs)
         self._autojoin_disabled = disable_autojoin
-        self.account = models.Account.resolve(me)
+        self.account = self._account_map.resolve(me)
         if not self.account:
             raise ValueError('Invalid account')
         if not self.participant and stream.service_content_id and not disable_autojoin:
@@ -252,8 +239,6 @@ class MutableStream(Stream):
                 self._set_participants(add=[self.account])
                 logging.debug('Auto-joined stream %d', stream.key.id())
                 break
-        if self.participant:
-            self._account_map[self.account.key] = self.account
 
     @validate
     def announce_status(self, status, estimated_duration=None):
@@ -285,7 +270,9 @@ class MutableStream(Stream):
         self._set_participants(remove=account_keys, **kwargs)
 
     def for_participant(self, other_participant):
-        if models.Account.resolve_key(other_participant) == self.account.key:
+        key = (identity_map.resolve_key(other_participant) or
+               models.Account.resolve_key(other_participant))
+        if key == self.account.key:
             return self
         return super(MutableStream, self).for_participant(other_participant,
             disable_autojoin=self._autojoin_disabled)
@@ -726,9 +713,9 @@ class MutableStream(Stream):
                     continue
                 params['owners'][account.key] = owner
         # Update participants list and create a diff based on the changes.
-        before = models.Account.resolve_keys(self.participants)
+        before = set(p.account for p in self.participants)
         self._tx(models.Stream.set_participants, **params)
-        after = models.Account.resolve_keys(self.participants)
+        after = set(p.account for p in self.participants)
         # TODO: Make a difference of leaving vs. kicking and inviting vs. joining?
         # Notify added accounts that they joined.
         added = after - before
@@ -762,8 +749,12 @@ class MutableStream(Stream):
         else:
             # If the loop falls through, stream was never set.
             raise errors.ServerError('Failed to update stream (transaction rolled back)')
+        old_stream = self._stream
         self._stream = stream
         self._chunks = None
+        if _unplayed_state(old_stream) != _unplayed_state(stream):
+            account_keys = set(p.account for p in old_stream.participants + stream.participants)
+            _update_unplayed_cache(stream, account_keys)
 
 
 class StreamsHandler(object):
@@ -773,14 +764,15 @@ class StreamsHandler(object):
 
     """
     def __init__(self, account):
-        self.account = models.Account.resolve(account)
+        self._account_map = identity_map.current()
+        self.account = self._account_map.resolve(account)
         if not self.account:
             raise ValueError('Could not resolve provided account')
 
     def get(self, others, all_chunks=False, create=False, disable_autojoin=False,
             reason='unknown', solo=False, title=None, **kwargs):
         try:
-            accounts = models.Account.resolve_list([self.account] + others)
+            accounts = self._account_map.resolve_list([self.account] + others)
             if len(accounts) == 2 and accounts[0].key == accounts[1].key:
                 # The user specified themselves as the second user so this should be solo.
                 accounts = accounts[:1]
@@ -800,8 +792,7 @@ class StreamsHandler(object):
             raise errors.InvalidArgument('Got one or more invalid account(s)')
         if not stream:
             return None
-        handler = MutableStream(self.account, stream,
-                                account_map={a.key: a for a in accounts},
+        handler = MutableStream(self.account, stream, account_map=self._account_map,
                                 disable_autojoin=disable_autojoin)
         if new:
             # Notify all participants that a new stream including them was created.
@@ -827,7 +818,8 @@ class StreamsHandler(object):
             raise errors.InvalidArgument('Invalid stream id')
         if not stream:
             raise errors.ResourceNotFound('That stream does not exist')
-        return MutableStream(self.account, stream, chunks=chunks, **kwargs)
+        return MutableStream(self.account, stream, account_map=self._account_map,
+                             chunks=chunks, **kwargs)
 
     def get_or_create(self, others, title=None, **kwargs):
         return self.get(others, create=True, title=title, **kwargs)
@@ -840,16 +832,29 @@ class StreamsHandler(object):
         streams, next_cursor, more = q.fetch_page(max_results, start_cursor=start_cursor)
         # Batch fetch all accounts referred by the streams for efficiency.
         account_keys = set(p.account for s in streams for p in s.participants)
-        lookup = dict(zip(account_keys, ndb.get_multi(account_keys)))
+        self._account_map.get_multi(account_keys)
         # Return a list of 10 wrapped streams.
-        streams = [MutableStream(self.account, s, account_map=lookup) for s in streams]
+        streams = [MutableStream(self.account, s, account_map=self._account_map)
+                   for s in streams]
         return streams, next_cursor.urlsafe() if more else None
 
     def get_unplayed_count(self):
-        threshold = datetime.utcnow() - config.CHUNK_MAX_AGE
-        return models.Stream.query(models.Stream.not_played_by == self.account.key,
-                                   models.Stream.visible_by == self.account.key,
-                                   models.Stream.last_interaction > threshold).count()
+        # The unplayed streams are kept up to date by MutableStream whenever they change.
+        cache_key = _unplayed_cache_key(self.account.key)
+        client = memcache.Client()
+        unplayed = client.get(cache_key)
+        if not isinstance(unplayed, dict):
+            threshold = datetime.utcnow() - config.CHUNK_MAX_AGE
+            q = models.Stream.query(models.Stream.not_played_by == self.account.key,
+                                    models.Stream.visible_by == self.account.key,
+                                    models.Stream.last_interaction > threshold)
+            stream_list = q.fetch(projection=[models.Stream.last_interaction])
+            unplayed = {s.key.id(): convert.unix_timestamp_ms(s.last_interaction)
+                        for s in stream_list}
+            unplayed = _store_unplayed_cache(client, cache_key, unplayed)
+        # Streams stop counting once their chunks have expired.
+        threshold_ms = convert.unix_timestamp_ms(datetime.utcnow() - config.CHUNK_MAX_AGE)
+        return sum(1 for ts in unplayed.itervalues() if ts > threshold_ms)
 
     def join_service_content(self, service_content_id, autocreate=True, **kwargs):
         # Variable name should stay "service_content_id" to prevent duplicate in kwargs.
@@ -883,3 +888,92 @@ class StreamsHandler(object):
         stream = self.get_or_create(others, reason=reason, title=title)
         stream.send(payload, duration, **kwargs)
         return stream
+
+
+def _unplayed_cache_key(account_key):
+    return 'unplayed_streams_%d' % (account_key.id(),)
+
+
+def _unplayed_state(stream):
+    return (set(stream.not_played_by), set(stream.visible_by), stream.last_interaction,
+            set(p.account for p in stream.participants))
+
+
+def _store_unplayed_cache(client, cache_key, unplayed):
+    """Caches unplayed streams calculated from the index, adding any changes that were
+    recorded while the (eventually consistent) query was running.
+
+    Returns the unplayed streams, including the recorded changes.
+    """
+    for _ in xrange(3):
+        value = client.gets(cache_key)
+        if isinstance(value, dict):
+            # Another request already calculated the value.
+            return value
+        merged = dict(unplayed)
+        for stream_id, ts in value or []:
+            if ts:
+                merged[stream_id] = ts
+            else:
+                merged.pop(stream_id, None)
+        if value is None:
+            stored = client.add(cache_key, merged, time=config.UNPLAYED_STREAMS_CACHE_TTL)
+        else:
+            stored = client.cas(cache_key, merged, time=config.UNPLAYED_STREAMS_CACHE_TTL)
+        if stored:
+            return merged
+    # Let the next request try again.
+    return merged
+
+
+def _update_unplayed_cache(stream, account_keys):
+    """Updates the cached unplayed streams of the provided accounts for a stream.
+
+    Accounts without a cached value get the change recorded instead, so that a value that
+    is being calculated from the index at the same time won't miss it.
+    """
+    stream_id = stream.key.id()
+    ts = convert.unix_timestamp_ms(stream.last_interaction)
+    threshold_ms = convert.unix_timestamp_ms(datetime.utcnow() - config.CHUNK_MAX_AGE)
+    keys = {_unplayed_cache_key(k): k for k in account_keys}
+    client = memcache.Client()
+    for _ in xrange(3):
+        cached = client.get_multi(keys.keys(), for_cas=True)
+        changes = {}
+        updates = {}
+        for cache_key, account_key in keys.iteritems():
+            is_unplayed = (account_key in stream.not_played_by and
+                           account_key in stream.visible_by)
+            unplayed = cached.get(cache_key)
+            if not isinstance(unplayed, dict):
+                # The value is missing or still being calculated (a list of changes).
+                changes[cache_key] = (unplayed or []) + [(stream_id, ts if is_unplayed else 0)]
+                continue
+            if is_unplayed:
+                if unplayed.get(stream_id) == ts:
+                    continue
+                unplayed = dict(unplayed)
+                unplayed[stream_id] = ts
+            elif stream_id in unplayed:
+                unplayed = dict(unplayed)
+                del unplayed[stream_id]
+            else:
+                continue
+            # Also forget streams that have expired since the value was cached.
+            updates[cache_key] = {s: t for s, t in unplayed.iteritems() if t > threshold_ms}
+        failed = []
+        if changes:
+            added = {k: v for k, v in changes.iteritems() if k not in cached}
+            if added:
+                failed += client.add_multi(added, time=config.UNPLAYED_STREAMS_CHANGES_TTL)
+            appended = {k: v for k, v in changes.iteritems() if k in cached}
+            if appended:
+                failed += client.cas_multi(appended, time=config.UNPLAYED_STREAMS_CHANGES_TTL)
+        if updates:
+            failed += client.cas_multi(updates, time=config.UNPLAYED_STREAMS_CACHE_TTL)
+        if not failed:
+            return
+        keys = {k: keys[k] for k in failed}
+    # Let the values be recalculated instead of leaving them incorrect.
+    logging.warning('Failed to update unplayed streams for %d account(s)', len(keys))
+    client.delete_multi(keys.keys())
@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 
 import functools
+import hashlib
+import logging
+import time
 
+from google.appengine.api import memcache, taskqueue
+from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
-from roger import models, notifs
+from roger import config, models, notifs
 from roger_common import errors
 
 
@@ -24,7 +29,8 @@ class Handler(object):
         thread = yield models.Thread.get_by_id_async(thread_id)
         if not thread:
             raise errors.ResourceNotFound('Thread not found')
-        raise ndb.Return(ThreadWithAccount(self.account_key, thread))
+        entries = yield _get_entries_async(thread)
+        raise ndb.Return(ThreadWithAccount(self.account_key, thread, entries=entries))
 
     def get_or_create(self, *args, **kwargs):
         return self.get_or_create_async(*args, **kwargs).get_result()
@@ -37,7 +43,8 @@ class Handler(object):
             raise errors.InvalidArgument('Got one or more invalid identifiers')
         account_keys.add(self.account_key)
         thread = yield models.Thread.lookup_async(account_keys)
-        raise ndb.Return(ThreadWithAccount(self.account_key, thread))
+        entries = yield _get_entries_async(thread)
+        raise ndb.Return(ThreadWithAccount(self.account_key, thread, entries=entries))
 
     def get_recent_messages(self, *args, **kwargs):
         return self.get_recent_messages_async(*args, **kwargs).get_result()
@@ -45,14 +52,23 @@ class Handler(object):
     @ndb.tasklet
     def get_recent_messages_async(self, thread_id, cursor=None, limit=50):
         key = ndb.Key('Thread', thread_id)
-        q = models.ThreadMessage.query(ancestor=key)
-        q = q.order(-models.ThreadMessage.created)
-        q_future = q.fetch_page_async(limit, start_cursor=cursor)
-        thread, (messages, next_cursor, more) = yield key.get_async(), q_future
-        if not more:
-            next_cursor = None
+        cursor_urlsafe = cursor.urlsafe() if cursor else None
+        if cursor_urlsafe:
+            # Older pages never change so they may have been prefetched already.
+            page_future = _get_cached_page_async(thread_id, cursor_urlsafe, limit)
+            thread, page = yield key.get_async(), page_future
+        else:
+            thread = yield key.get_async()
+            page = None
         if not thread or not any(self.account_key == a.account for a in thread.accounts):
             raise errors.ResourceNotFound('Thread not found')
+        if not page and not cursor_urlsafe:
+            page = yield _get_first_page_from_thread_async(thread, limit)
+        if not page:
+            page = yield _fetch_page_async(thread_id, cursor, limit)
+        messages, next_cursor = page
+        if next_cursor:
+            yield _schedule_prefetch_async(thread_id, next_cursor, limit)
         raise ndb.Return((ThreadWithAccount(self.account_key, thread), messages, next_cursor))
 
     def get_recent_threads(self, *args, **kwargs):
@@ -60,11 +76,16 @@ class Handler(object):
 
     @ndb.tasklet
     def get_recent_threads_async(self, cursor=None, limit=50):
-        q = models.Thread.query()
-        q = q.filter(models.Thread.visible_by == self.account_key)
-        q = q.order(-models.Thread.last_interaction)
-        thread_list, next_cursor, more = yield q.fetch_page_async(limit, start_cursor=cursor)
-        thread_list = [ThreadWithAccount(self.account_key, t) for t in thread_list]
+        q = models.ThreadInboxEntry.query(ancestor=self.account_key)
+        q = q.filter(models.ThreadInboxEntry.visible == True)
+        q = q.order(-models.ThreadInboxEntry.last_interaction)
+        entries, next_cursor, more = yield q.fetch_page_async(limit, start_cursor=cursor)
+        thread_list = yield ndb.get_multi_async([e.thread_key for e in entries])
+        thread_list = filter(None, thread_list)
+        # The seen state of the other participants is in their own inbox entries.
+        entries_list = yield _get_entries_multi_async(thread_list)
+        thread_list = [ThreadWithAccount(self.account_key, t, entries=e)
+                       for t, e in zip(thread_list, entries_list)]
         raise ndb.Return((thread_list, next_cursor if more else None))
 
     def message(self, *args, **kwargs):
@@ -75,10 +96,17 @@ class Handler(object):
         # TODO: Respect block status.
         if not isinstance(thread_id, basestring):
             raise TypeError('Expected string id')
+        keep_hidden = kwargs.pop('keep_hidden_from_sender', False)
         thread, message = yield models.Thread.add_message_async(
             ndb.Key('Thread', thread_id), self.account_key,
             type, text, data, **kwargs)
-        twa = ThreadWithAccount(self.account_key, thread)
+        # Fan the message out to the inbox of every participant.
+        entry_list = yield tuple(
+            models.ThreadInboxEntry.deliver_async(a.account, thread, message,
+                keep_hidden=keep_hidden and a.account == self.account_key)
+            for a in thread.accounts)
+        entries = {e.key.parent(): e for e in entry_list}
+        twa = ThreadWithAccount(self.account_key, thread, entries=entries)
         futures = []
         for a in thread.accounts:
             hub = notifs.Hub(a.account)
@@ -111,10 +139,11 @@ class Thread(object):
         self._thread = thread
 
     def for_account(self, account, lite=False):
+        entries = getattr(self, 'entries', None)
         if lite:
-            return ThreadWithAccountLite(account, self._thread)
+            return ThreadWithAccountLite(account, self._thread, entries=entries)
         else:
-            return ThreadWithAccount(account, self._thread)
+            return ThreadWithAccount(account, self._thread, entries=entries)
 
     def get_account(self, account_key):
         for a in self._thread.accounts:
@@ -124,51 +153,32 @@ class Thread(object):
 
 
 class ThreadWithAccount(Thread):
-    __slots__ = ['account_key']
+    __slots__ = ['account_key', 'entries']
 
-    def __init__(self, account_key, thread, **kwargs):
+    def __init__(self, account_key, thread, entries=None, **kwargs):
         if not isinstance(account_key, ndb.Key) or account_key.kind() != 'Account':
             raise TypeError('Expected an Account key')
         super(ThreadWithAccount, self).__init__(thread, **kwargs)
         self.account_key = account_key
+        # Inbox entries by account key, which have the most recent seen state.
+        self.entries = entries or {}
 
     @property
     def current(self):
-        return next(a for a in self._thread.accounts if a.account == self.account_key)
+        a = next(a for a in self._thread.accounts if a.account == self.account_key)
+        return self._with_entry(a)
 
     def get_lite(self):
         if isinstance(self, ThreadWithAccountLite):
             return self
-        return ThreadWithAccountLite(self.account_key, self._thread)
+        return ThreadWithAccountLite(self.account_key, self._thread, entries=self.entries)
 
-    @ndb.transactional
     def hide(self):
-        t = self._thread.key.get()
-        if self.account_key not in t.visible_by:
-            return
-        for a in t.accounts:
-            if a.account == self.account_key:
-                break
-        else:
-            raise errors.ForbiddenAction('Cannot update that thread')
-        t.visible_by.remove(self.account_key)
-        t.put()
-        self._thread = t
+        self._set_visible([self.account_key], False)
 
-    @ndb.transactional
     def hide_for_all(self):
         # Note: Intended for admin only.
-        t = self._thread.key.get()
-        if not t.visible_by:
-            return
-        for a in t.accounts:
-            if a.account == self.account_key:
-                break
-        else:
-            raise errors.ForbiddenAction('Cannot update that thread')
-        t.visible_by = []
-        t.put()
-        self._thread = t
+        self._set_visible([a.account for a in self._thread.accounts], False)
 
     @property
     def is_seen(self):
@@ -181,7 +191,7 @@ class ThreadWithAccount(Thread):
 
     @property
     def others(self):
-        return [a for a in self._thread.accounts if a.account != self.account_key]
+        return [self._with_entry(a) for a in self._thread.accounts if a.account != self.account_key]
 
     def public(self, version=None, **kwargs):
         data = {
@@ -195,39 +205,43 @@ class ThreadWithAccount(Thread):
             data['seen_until'] = self.current.seen_until.id() if self.current.seen_until else None
         return data
 
-    @ndb.transactional
     def set_seen_until(self, seen_until):
-        t = self._thread.key.get()
-        for m in t.messages:
+        for m in self._thread.messages:
             if m.message_id == seen_until:
                 break
         else:
             # TODO: Have another look at this logic.
             raise errors.InvalidArgument('Message id must be one of 10 most recent')
-        for a in t.accounts:
-            if a.account == self.account_key:
-                break
-        else:
+        if not self.get_account(self.account_key):
             raise errors.ForbiddenAction('Cannot update that thread')
-        if a.seen_until and a.seen_until.id() >= seen_until:
-            return
-        a.seen_until = m.key_with_parent(self.key)
-        t.put()
-        self._thread = t
+        # Only the inbox entry of the account is updated, not the thread.
+        entry = models.ThreadInboxEntry.set_seen_until_async(
+            self.account_key, self._thread, m.key_with_parent(self.key), m.created).get_result()
+        self.entries[self.account_key] = entry
 
-    @ndb.transactional
     def show(self):
-        t = self._thread.key.get()
-        if self.account_key in t.visible_by:
-            return
-        for a in t.accounts:
-            if a.account == self.account_key:
-                break
-        else:
+        self._set_visible([self.account_key], True)
+
+    def _set_visible(self, account_keys, visible):
+        if not self.get_account(self.account_key):
             raise errors.ForbiddenAction('Cannot update that thread')
-        t.visible_by.insert(0, self.account_key)
-        t.put()
-        self._thread = t
+        futures = [models.ThreadInboxEntry.set_visible_async(k, self._thread, visible)
+                   for k in account_keys]
+        for f in futures:
+            entry = f.get_result()
+            self.entries[entry.key.parent()] = entry
+
+    def _with_entry(self, thread_account):
+        entry = self.entries.get(thread_account.account)
+        if not entry or not entry.seen_until_timestamp:
+            return thread_account
+        if entry.seen_until_timestamp <= thread_account.seen_until_timestamp:
+            return thread_account
+        # The thread is not updated when messages are seen so use the newer inbox state.
+        merged = models.ThreadAccount(**thread_account.to_dict())
+        merged.seen_until = entry.seen_until
+        merged.seen_until_timestamp = entry.seen_until_timestamp
+        return merged
 
 
 class ThreadWithAccountLite(ThreadWithAccount):
@@ -236,3 +250,109 @@ class ThreadWithAccountLite(ThreadWithAccount):
         if version >= 50:
             del data['messages']
         return data
+
+
+def prefetch_page(thread_id, cursor_urlsafe, limit):
+    """Caches a page of messages so that the client's next request doesn't hit the datastore."""
+    cursor = datastore_query.Cursor(urlsafe=cursor_urlsafe)
+    messages, next_cursor = _fetch_page_async(thread_id, cursor, limit).get_result()
+    next_cursor_urlsafe = next_cursor.urlsafe() if next_cursor else None
+    memcache.set(_page_cache_key(thread_id, cursor_urlsafe, limit),
+                 (messages, next_cursor_urlsafe),
+                 time=config.THREAD_MESSAGES_CACHE_TTL)
+
+
+def _cursor_cache_key(thread_id, message_id):
+    return 'thread_cursor_%s_%s' % (thread_id, message_id)
+
+
+@ndb.tasklet
+def _fetch_page_async(thread_id, cursor, limit):
+    q = models.ThreadMessage.query(ancestor=ndb.Key('Thread', thread_id))
+    q = q.order(-models.ThreadMessage.created)
+    messages, next_cursor, more = yield q.fetch_page_async(limit, start_cursor=cursor)
+    if not more:
+        next_cursor = None
+    if messages and next_cursor:
+        # Remember where the page ended so the first page can be served from the thread.
+        context = ndb.get_context()
+        yield context.memcache_set(_cursor_cache_key(thread_id, messages[-1].key.id()),
+                                   next_cursor.urlsafe(),
+                                   time=config.THREAD_MESSAGES_CACHE_TTL)
+    raise ndb.Return((messages, next_cursor))
+
+
+@ndb.tasklet
+def _get_cached_page_async(thread_id, cursor_urlsafe, limit):
+    context = ndb.get_context()
+    page = yield context.memcache_get(_page_cache_key(thread_id, cursor_urlsafe, limit))
+    if not page:
+        raise ndb.Return(None)
+    messages, next_cursor_urlsafe = page
+    if next_cursor_urlsafe:
+        next_cursor = datastore_query.Cursor(urlsafe=next_cursor_urlsafe)
+    else:
+        next_cursor = None
+    raise ndb.Return((messages, next_cursor))
+
+
+@ndb.tasklet
+def _get_entries_async(thread):
+    entries_list = yield _get_entries_multi_async([thread])
+    raise ndb.Return(entries_list[0])
+
+
+@ndb.tasklet
+def _get_entries_multi_async(thread_list):
+    # Loads the inbox entries of every participant of every thread in one batch.
+    keys_list = [[models.ThreadInboxEntry.make_key(a.account, t.key) for a in t.accounts]
+                 for t in thread_list]
+    entry_list = yield ndb.get_multi_async([k for keys in keys_list for k in keys])
+    lookup = {e.key: e for e in entry_list if e}
+    raise ndb.Return([{k.parent(): lookup[k] for k in keys if k in lookup}
+                      for keys in keys_list])
+
+
+@ndb.tasklet
+def _get_first_page_from_thread_async(thread, limit):
+    """Gets the first page from the messages cached on the thread, if they cover it."""
+    cached = thread.messages
+    # A thread with fewer cached messages than the maximum has all its messages cached.
+    complete = len(cached) < models.Thread.MAX_CACHED_MESSAGES
+    if limit > len(cached) and not complete:
+        raise ndb.Return(None)
+    messages = cached[:limit]
+    if not messages or (complete and limit >= len(cached)):
+        raise ndb.Return((messages, None))
+    # The cursor for the end of the page is needed to let the client continue.
+    thread_id = thread.key.id()
+    context = ndb.get_context()
+    cursor_urlsafe = yield context.memcache_get(
+        _cursor_cache_key(thread_id, messages[-1].message_id))
+    if not cursor_urlsafe:
+        raise ndb.Return(None)
+    raise ndb.Return((messages, datastore_query.Cursor(urlsafe=cursor_urlsafe)))
+
+
+def _page_cache_key(thread_id, cursor_urlsafe, limit):
+    return 'thread_messages_%s_%d_%s' % (thread_id, limit, hashlib.md5(cursor_urlsafe).hexdigest())
+
+
+@ndb.tasklet
+def _schedule_prefetch_async(thread_id, cursor, limit):
+    cursor_urlsafe = cursor.urlsafe()
+    # Name the task so that many clients paging the same thread only prefetch once.
+    window = int(time.time()) // config.THREAD_MESSAGES_CACHE_TTL
+    name = 'prefetch-messages-%s-%d' % (
+        hashlib.md5(_page_cache_key(thread_id, cursor_urlsafe, limit)).hexdigest(), window)
+    task = taskqueue.Task(
+        name=name,
+        url='/_ah/jobs/prefetch_thread_messages',
+        params={'cursor': cursor_urlsafe, 'limit': str(limit), 'thread_id': thread_id},
+        retry_options=taskqueue.TaskRetryOptions(task_retry_limit=0))
+    try:
+        yield task.add_async(queue_name=config.INTERNAL_QUEUE)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+    except:
+        logging.exception('Failed to schedule prefetch of thread messages')
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+import calendar
+from datetime import datetime, timedelta
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from roger import config, models
+from roger_common import errors
+
+
+@ndb.tasklet
+def add_recent_content_async(account_key, creator):
+    """Copies the most recent content by a creator into the timeline of an account."""
+    if is_large_creator(creator):
+        raise ndb.Return(0)
+    q = models.Content.query(models.Content.creator == creator.key)
+    q = q.order(-models.Content.created)
+    content_list = yield q.fetch_async(config.TIMELINE_FOLLOW_CONTENT_COUNT)
+    content_list = [c for c in content_list if c.is_public]
+    if content_list:
+        yield ndb.put_multi_async([models.AccountTimelineEntry.from_content(account_key, c)
+                                   for c in content_list])
+    raise ndb.Return(len(content_list))
+
+
+def get_page(*args, **kwargs):
+    return get_page_async(*args, **kwargs).get_result()
+
+
+@ndb.tasklet
+def get_page_async(account_key, tag, limit, cursor=None):
+    """Gets a page of content by the account and the accounts it follows, newest first.
+
+    Content by most creators is copied into the timeline of their followers when it is
+    published. Content by creators with too many followers for that is merged in here.
+    Returns the content list and a cursor for the next page (or None).
+    """
+    before = _parse_cursor(cursor)
+    entries_future = models.AccountTimelineEntry.recent_query(
+        account_key, tag, before=before).fetch_async(limit)
+    own_future = _content_query(account_key, tag, before=before).fetch_async(limit)
+    large_keys = yield _get_followed_large_creators_async(account_key)
+    futures = [entries_future, own_future]
+    futures.extend(_content_query(k, tag, before=before).fetch_async(limit)
+                   for k in large_keys)
+    sources = yield futures
+    entries = sources[0]
+    content_list = yield ndb.get_multi_async([e.content_key for e in entries])
+    content_list = list(content_list)
+    for results in sources[1:]:
+        content_list.extend(results)
+    # Sources that filled up may have older content that was not fetched, so only content
+    # newer than the oldest content of the most recent full source can be returned.
+    boundary = None
+    for results in sources:
+        if len(results) == limit:
+            boundary = max(boundary or results[-1].created, results[-1].created)
+    unique = {}
+    for content in content_list:
+        if not content or content.key in unique:
+            continue
+        if not content.is_public or tag not in content.tags:
+            # The content was deleted or retagged after it was added to the timeline.
+            continue
+        if boundary and content.created < boundary:
+            continue
+        unique[content.key] = content
+    content_list = sorted(unique.itervalues(), key=lambda c: c.created, reverse=True)
+    content_list = content_list[:limit]
+    if len(content_list) == limit:
+        next_cursor = _make_cursor(content_list[-1].created)
+    elif boundary:
+        next_cursor = _make_cursor(boundary)
+    else:
+        next_cursor = None
+    raise ndb.Return((content_list, next_cursor))
+
+
+def is_large_creator(account):
+    """Whether content by the account is merged into timelines when they are read.
+
+    Accounts stay merged after their content has been left out of timelines once, even if
+    they lose followers, since that content would disappear from timelines otherwise.
+    """
+    if account.timeline_merged:
+        return True
+    return account.follower_count > config.TIMELINE_FANOUT_MAX_FOLLOWERS
+
+
+@ndb.tasklet
+def mark_large_creator_async(creator_key):
+    """Keeps merging content by a creator whose content was left out of timelines."""
+    yield _set_timeline_merged_async(creator_key)
+    yield ndb.get_context().memcache_delete('timeline_large_creators')
+
+
+@ndb.tasklet
+def on_follow_async(account_key, creator_keys):
+    """Schedules copying recent content by newly followed accounts into the timeline."""
+    tasks = [taskqueue.Task(url='/_ah/jobs/timeline_follow',
+                            params={'account_id': account_key.id(),
+                                    'creator_id': k.id()})
+             for k in creator_keys]
+    if tasks:
+        yield taskqueue.Queue(config.INTERNAL_QUEUE).add_async(tasks)
+
+
+@ndb.tasklet
+def on_unfollow_async(account_key, creator_key):
+    """Schedules removing content by an unfollowed account from the timeline."""
+    task = taskqueue.Task(url='/_ah/jobs/timeline_unfollow',
+                          params={'account_id': account_key.id(),
+                                  'creator_id': creator_key.id()})
+    yield task.add_async(queue_name=config.INTERNAL_QUEUE)
+
+
+@ndb.tasklet
+def remove_creator_async(account_key, creator_key):
+    """Removes all content by a creator from the timeline of an account."""
+    q = models.AccountTimelineEntry.query(
+        models.AccountTimelineEntry.creator == creator_key,
+        ancestor=account_key)
+    keys = yield q.fetch_async(keys_only=True)
+    if keys:
+        yield ndb.delete_multi_async(keys)
+    raise ndb.Return(len(keys))
+
+
+def _content_query(creator_key, tag, before=None):
+    q = models.Content.query()
+    q = q.filter(models.Content.creator == creator_key)
+    q = q.filter(models.Content.tags == tag)
+    if before:
+        q = q.filter(models.Content.created < before)
+    q = q.order(-models.Content.created)
+    return q
+
+
+@ndb.tasklet
+def _get_followed_large_creators_async(account_key):
+    creator_ids = yield _get_large_creator_ids_async()
+    if not creator_ids:
+        raise ndb.Return([])
+    follow_keys = [ndb.Key('AccountFollow', i, parent=account_key) for i in creator_ids]
+    follows = yield ndb.get_multi_async(follow_keys)
+    raise ndb.Return([f.account for f in follows if f])
+
+
+@ndb.tasklet
+def _get_large_creator_ids_async():
+    context = ndb.get_context()
+    creator_ids = yield context.memcache_get('timeline_large_creators')
+    if creator_ids is not None:
+        raise ndb.Return(creator_ids)
+    q1 = models.Account.query(
+        models.Account.follower_count > config.TIMELINE_FANOUT_MAX_FOLLOWERS)
+    q2 = models.Account.query(models.Account.timeline_merged == True)
+    results = yield (q1.fetch_async(config.TIMELINE_LARGE_CREATORS_MAX, keys_only=True),
+                     q2.fetch_async(config.TIMELINE_LARGE_CREATORS_MAX, keys_only=True))
+    if any(len(keys) == config.TIMELINE_LARGE_CREATORS_MAX for keys in results):
+        logging.warning('There are more than %d large creators',
+                        config.TIMELINE_LARGE_CREATORS_MAX)
+    creator_ids = sorted(set(k.id() for keys in results for k in keys))
+    yield context.memcache_set('timeline_large_creators', creator_ids,
+                               time=config.TIMELINE_LARGE_CREATORS_CACHE_TTL)
+    raise ndb.Return(creator_ids)
+
+
+def _make_cursor(timestamp):
+    # Microseconds since epoch so that no content is skipped between pages.
+    return str(calendar.timegm(timestamp.timetuple()) * 1000000 + timestamp.microsecond)
+
+
+def _parse_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        return datetime(1970, 1, 1) + timedelta(microseconds=int(cursor))
+    except (OverflowError, ValueError):
+        raise errors.InvalidArgument('Invalid cursor')
+
+
+@ndb.transactional_tasklet
+def _set_timeline_merged_async(creator_key):
+    creator = yield creator_key.get_async()
+    if creator and not creator.timeline_merged:
+        creator.timeline_merged = True
+        yield creator.put_async()
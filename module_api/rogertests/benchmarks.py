@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#
+# Benchmarks for the hottest API endpoints. These are not discovered with the regular
+# tests since seeding takes a while. Run them with:
+# python -m scripts.run_benchmarks
+#
+# Record a baseline (and a new one after an intentional change) with:
+# python -m scripts.run_benchmarks --update-baseline
+#
+# The baseline depends on the machine, so it is not checked in. Endpoints without a
+# baseline are only reported, not checked for regressions.
+
+from datetime import datetime, timedelta
+import json
+import os
+import os.path
+import random
+import time
+
+from google.appengine.ext import ndb
+
+import mock
+
+from roger import accounts, config, models, profiler
+from rogertests import test_api
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'benchmarks_baseline.json')
+
+# Data volumes to seed.
+NUM_FOLLOWERS = 500
+NUM_REACTIONS = 2000
+NUM_SEARCHABLE_ACCOUNTS = 200
+NUM_STREAM_CHUNKS = 100
+NUM_STREAMS = 60
+NUM_THREAD_MESSAGES = 100
+NUM_THREADS = 60
+
+# Number of requests per endpoint in the replayed mix.
+REQUESTS_PER_ENDPOINT = 50
+
+# How much worse than the baseline a benchmark can get before it fails. Latency
+# varies between machines so it gets a lot more slack than RPC counts.
+LATENCY_TOLERANCE = 1.5
+LATENCY_SLACK_MS = 20
+RPC_TOLERANCE = 1.1
+RPC_SLACK = 1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    index = int(round((len(values) - 1) * p / 100.0))
+    return values[index]
+
+
+class Benchmarks(test_api.BaseTestCase):
+    def assertNoRegressions(self, report):
+        baseline = self.load_baseline()
+        if os.environ.get('ROGER_BENCHMARK_UPDATE'):
+            baseline.update(report)
+            with open(BASELINE_PATH, 'w') as f:
+                json.dump(baseline, f, indent=2, sort_keys=True)
+                f.write('\n')
+            return
+        regressions = []
+        for name, stats in sorted(report.iteritems()):
+            expected = baseline.get(name)
+            if not expected:
+                print 'No baseline for %s' % (name,)
+                continue
+            max_ms = expected['p90_ms'] * LATENCY_TOLERANCE + LATENCY_SLACK_MS
+            if stats['p90_ms'] > max_ms:
+                regressions.append('%s: p90 %.1f ms > %.1f ms' % (name, stats['p90_ms'], max_ms))
+            max_rpcs = expected['rpcs'] * RPC_TOLERANCE + RPC_SLACK
+            if stats['rpcs'] > max_rpcs:
+                regressions.append('%s: %.1f RPCs > %.1f RPCs' % (name, stats['rpcs'], max_rpcs))
+        self.assertEqual(regressions, [], 'Performance regressed:\n' + '\n'.join(regressions))
+
+    def load_baseline(self):
+        if not os.path.exists(BASELINE_PATH):
+            return {}
+        with open(BASELINE_PATH) as f:
+            return json.load(f)
+
+    def measure(self, name, method, path, expected_code=200, **kwargs):
+        start = time.time()
+        result, status = self.open(method, path, **kwargs)
+        duration_ms = (time.time() - start) * 1000
+        self.assertValidResult(result, status, expected_code)
+        profile = profiler.last()
+        samples = self.samples.setdefault(name, {'ms': [], 'rpcs': []})
+        samples['ms'].append(duration_ms)
+        samples['rpcs'].append(len(profile.rpcs) if profile else 0)
+        return result
+
+    def report(self):
+        report = {}
+        print
+        print '%-28s %8s %8s %8s %8s' % ('endpoint', 'p50 ms', 'p90 ms', 'p99 ms', 'RPCs')
+        for name, samples in sorted(self.samples.iteritems()):
+            stats = {
+                'p50_ms': percentile(samples['ms'], 50),
+                'p90_ms': percentile(samples['ms'], 90),
+                'p99_ms': percentile(samples['ms'], 99),
+                'rpcs': sum(samples['rpcs']) / float(len(samples['rpcs'])),
+            }
+            print '%-28s %8.1f %8.1f %8.1f %8.1f' % (
+                name, stats['p50_ms'], stats['p90_ms'], stats['p99_ms'], stats['rpcs'])
+            report[name] = stats
+        return report
+
+    def seed_accounts(self):
+        # A popular account with lots of followers.
+        self.star = accounts.create('benchstar', status='active')
+        follower_keys = []
+        follows = []
+        for i in xrange(NUM_FOLLOWERS):
+            key = ndb.Key('Account', 10000000 + i)
+            follower_keys.append(key)
+            follows.append(models.AccountFollow(
+                key=ndb.Key('AccountFollow', self.star.account_id, parent=key),
+                account=self.star.key))
+        followers = [models.Account(key=k,
+                                    following_count=1,
+                                    status='active',
+                                    stored_display_name='Follower %d' % (i,))
+                     for i, k in enumerate(follower_keys)]
+        ndb.put_multi(followers + follows)
+        star = self.star.account
+        star.follower_count = NUM_FOLLOWERS
+        star.put()
+        self.followers = followers
+        # Accounts with similar usernames for search.
+        for i in xrange(NUM_SEARCHABLE_ACCOUNTS):
+            accounts.create('bench%d' % (i,), status='active')
+
+    def seed_content(self):
+        now = datetime.utcnow()
+        original = models.Content.new(allow_restricted_tags=True,
+            created=now - timedelta(days=1),
+            creator=self.star.key,
+            original_url='https://www.youtube.com/watch?v=benchmark',
+            related_count=NUM_REACTIONS,
+            tags=['original', 'is hot', 'is reacted'],
+            thumb_url='https://www.example.com/original.jpg',
+            title='Most reacted video')
+        original.put()
+        reactions = []
+        for i in xrange(NUM_REACTIONS):
+            creator = self.followers[i % len(self.followers)]
+            reactions.append(models.Content.new(allow_restricted_tags=True,
+                created=now - timedelta(minutes=i),
+                creator=creator.key,
+                duration=30000,
+                related_to=original.key,
+                sort_index=original.sort_index - i,
+                tags=['reaction', 'published'],
+                thumb_url='https://www.example.com/%d.jpg' % (i,),
+                title='Reaction %d' % (i,),
+                video_url='https://www.example.com/%d.mp4' % (i,),
+                views=i * 10,
+                votes=i))
+        ndb.put_multi(reactions)
+        self.original = original
+        self.reactions = reactions
+
+    def seed_conversations(self):
+        # Busy streams and threads for the popular account.
+        others = self.followers[:max(NUM_STREAMS, NUM_THREADS)]
+        with mock.patch('roger.files.gcs'):
+            for i in xrange(NUM_STREAM_CHUNKS):
+                other = others[i % NUM_STREAMS]
+                self.star.streams.send([other.key], 'bench%d.mp3' % (i,), 1234,
+                                       reason='benchmark', mute_notification=True)
+        star_threads = self.star.threads
+        for i in xrange(NUM_THREAD_MESSAGES):
+            other = others[i % NUM_THREADS]
+            star_threads.message_identifiers([other.key], 'text', 'Message %d' % (i,), {})
+
+    def setUp(self):
+        super(Benchmarks, self).setUp()
+        self.samples = {}
+        self.seed_accounts()
+        self.seed_content()
+        self.seed_conversations()
+        # Start with empty caches and queues so that the mix sees cold and warm paths.
+        ndb.get_context().clear_cache()
+        self.clear_memcache()
+        self.taskqueue_stub.FlushQueue('default')
+        self.taskqueue_stub.FlushQueue(config.INTERNAL_QUEUE)
+
+    def test_request_mix(self):
+        rnd = random.Random(1)
+        token = self.star.create_access_token()
+        voter_tokens = [self.bob.create_access_token(), self.cecilia.create_access_token(),
+                        self.dennis.create_access_token()]
+        mix = []
+        for i in xrange(REQUESTS_PER_ENDPOINT):
+            reaction = rnd.choice(self.reactions)
+            mix += [
+                ('GET content/original', 'GET', '/v51/content/original/', {}),
+                ('GET content/reaction', 'GET', '/v51/content/reaction/',
+                 {'sort': rnd.choice(['hot', 'recent', 'top'])}),
+                ('GET original', 'GET', '/v51/original/',
+                 {'sort': rnd.choice(['hot', 'recent', 'top'])}),
+                ('PUT content/views', 'PUT', '/v51/content/%d/views' % (reaction.key.id(),),
+                 {'user_agent': 'ReactionCam/123 Benchmark/%d' % (rnd.randint(0, 20),)}),
+                ('PUT content/votes', 'PUT', '/v51/content/%d/votes' % (reaction.key.id(),),
+                 {'access_token': rnd.choice(voter_tokens)}),
+                ('GET streams', 'GET', '/v51/streams', {'access_token': token}),
+                ('GET threads', 'GET', '/v51/threads/', {'access_token': token}),
+                ('GET profile/search', 'GET', '/v51/profile/search',
+                 {'query': 'bench%d' % (rnd.randint(0, 30),)}),
+            ]
+        rnd.shuffle(mix)
+        for name, method, path, kwargs in mix:
+            self.measure(name, method, path, **kwargs)
+        self.assertNoRegressions(self.report())
@@ -1,6 +1,9 @@
+from datetime import datetime, timedelta
+
+import flask
 import mock
 
-from roger import accounts, streams
+from roger import accounts, models, streams
 from roger_common import errors
 import rogertests
 
@@ -97,6 +100,74 @@ class Creation(BaseTestCase):
             zandra_2.change_identifier('zandra', 'alexandra')
 
 
+class Events(BaseTestCase):
+    def test_compact(self):
+        account = accounts.create('ricardovice', status='active')
+        start = datetime(2018, 3, 1, 23, 57)
+        # Upload the same event in two batches, with the second one crossing into the next day.
+        for i in xrange(2):
+            items = [models.AccountEventItem(start + timedelta(minutes=i * 2 + j), 'Tap',
+                                             client='test', event_class='info')
+                     for j in xrange(2)]
+            models.AccountEvent.create_batch(account.key, items)
+        keys = models.AccountEvent.query(ancestor=account.key).fetch(keys_only=True)
+        self.assertEqual(models.AccountEventDay.compact(account.key, keys), 4)
+        self.assertEqual(models.AccountEvent.query(ancestor=account.key).count(), 0)
+        days = models.AccountEventDay.query(ancestor=account.key).fetch()
+        self.assertEqual(len(days), 2)
+        # Repeats should be collapsed across batches within each day.
+        first = days[0].items
+        self.assertEqual(len(first), 1)
+        self.assertEqual(first[0].repeats, 3)
+        self.assertEqual(first[0].repeats_began, start)
+        self.assertEqual(days[1].items[0].repeats, 1)
+
+    def test_compact_keeps_missing_client(self):
+        account = accounts.create('ricardovice', status='active')
+        item = models.AccountEventItem(datetime(2018, 3, 1, 12, 0), 'Tap')
+        models.AccountEvent.create_batch(account.key, [item])
+        keys = models.AccountEvent.query(ancestor=account.key).fetch(keys_only=True)
+        models.AccountEventDay.compact(account.key, keys)
+        day = models.AccountEventDay.query(ancestor=account.key).get()
+        with flask.Flask(__name__).test_request_context(headers={'User-Agent': 'Reader/1.0'}):
+            self.assertIsNone(day.items[0].client)
+
+    @mock.patch.object(models.AccountEventDay, 'MAX_COLUMNS_BYTES', 200)
+    def test_compact_splits_busy_day(self):
+        account = accounts.create('ricardovice', status='active')
+        start = datetime(2018, 3, 1, 12, 0)
+        for i in xrange(3):
+            items = [models.AccountEventItem(start + timedelta(minutes=i * 20 + j), 'Tap',
+                                             client='test', properties={'Index': i * 20 + j})
+                     for j in xrange(20)]
+            models.AccountEvent.create_batch(account.key, items)
+            keys = models.AccountEvent.query(ancestor=account.key).fetch(keys_only=True)
+            self.assertEqual(models.AccountEventDay.compact(account.key, keys), 20)
+        days = models.AccountEventDay.query(ancestor=account.key).fetch()
+        self.assertGreater(len(days), 1)
+        first = models.AccountEventDay.make_key(account.key, start.date()).get()
+        self.assertEqual(first.parts, len(days))
+        items = sorted((i for d in days for i in d.items), key=lambda i: i.timestamp)
+        self.assertEqual([i.properties['Index'] for i in items], range(60))
+
+    def test_packed_items(self):
+        account = accounts.create('ricardovice', status='active')
+        start = datetime(2018, 3, 1, 12, 0)
+        items = [
+            models.AccountEventItem(start, 'Tap', client='test', event_class='info',
+                                    properties={'Button': 'Record'}),
+            models.AccountEventItem(start + timedelta(seconds=5), 'Tap', client='test',
+                                    event_class='info', properties={'Button': 'Stop'}),
+        ]
+        items[1].repeats = 2
+        items[1].repeats_began = start + timedelta(seconds=3)
+        models.AccountEvent.create_batch(account.key, items)
+        event = models.AccountEvent.query(ancestor=account.key).get()
+        # Repeated strings should only be stored once.
+        self.assertEqual(event.packed['strings'], ['Button', 'test', 'info', 'Tap'])
+        self.assertEqual([i.public() for i in event.items], [i.public() for i in items])
+
+
 class Identifiers(BaseTestCase):
     def test_brazil_number(self):
         # Brazil has a special rule where a phone number can have two variants.
@@ -8,12 +8,14 @@ import time
 import unittest
 from urlparse import urlparse
 
-from google.appengine.ext import ndb
+from google.appengine.ext import deferred, ndb
 
 import mock
 from mock import ANY, call
 
-from roger import accounts, config, files, location, models
+from roger import accounts, chat, config, contacts, files, location, models, notifs
+from roger import timelines
+from roger.apps import utils
 from roger_common import convert, errors, identifiers, reporting
 import rogertests
 
@@ -536,8 +538,203 @@ class Contacts(BaseTestCase):
                         if i != 'bobby'}
         self.assertEqual(result['map'], expected_map)
 
+    def test_hashed(self):
+        bob = accounts.create('+12345678', status='active')
+        headers = {'Authorization': 'Bearer %s' % (self.anna.create_access_token(),)}
+        response = self.client.open('/v30/contacts', method='POST', headers=headers,
+                                    data='+12345678\n+12345678\n+23456789')
+        result, status = json.loads(response.data), response.status_code
+        self.assertValidResult(result, status, 200)
+        self.assertEqual(result['map'].keys(), ['+12345678'])
+        # Previously uploaded contacts can be referred to by their hash.
+        known = contacts.contact_hash('+12345678')
+        unknown = contacts.contact_hash('+34567890')
+        response = self.client.open('/v30/contacts?hashed=true', method='POST', headers=headers,
+                                    data='\n'.join([known, unknown]))
+        result, status = json.loads(response.data), response.status_code
+        self.assertValidResult(result, status, 200)
+        self.assertEqual(result['map'], {known: {'id': bob.account_id, 'active': True}})
+        self.assertEqual(result['unknown'], [unknown])
+
 
 class Content(BaseTestCase):
+    def test_comments(self):
+        result, status = self.post('/v42/content',
+                                   access_token=self.anna.create_access_token(),
+                                   duration='12345',
+                                   tags='reaction',
+                                   url='https://storage.googleapis.com/rcam/F3CBDwQ4gzX2UQlG4t57x')
+        self.assertValidResult(result, status, 200)
+        content_id = result['content']['id']
+        sort_index = models.Content.get_by_id(content_id).sort_index
+        result, status = self.put('/v42/content/%d/comments/' % (content_id,),
+                                  access_token=self.bob.create_access_token(),
+                                  text='First!')
+        self.assertValidResult(result, status, 200)
+        result, status = self.get('/v42/content/%d/comments/' % (content_id,))
+        self.assertValidResult(result, status, 200)
+        self.assertEqual([c['text'] for c in result['data']], ['First!'])
+        # Posting a comment invalidates the cached comments.
+        result, status = self.put('/v42/content/%d/comments/' % (content_id,),
+                                  access_token=self.cecilia.create_access_token(),
+                                  text='Second')
+        self.assertValidResult(result, status, 200)
+        result, status = self.get('/v42/content/%d/comments/' % (content_id,))
+        self.assertValidResult(result, status, 200)
+        self.assertEqual(len(result['data']), 2)
+        # The comment count is folded into the content by a deferred task.
+        self.assertEqual(models.Content.get_by_id(content_id).comment_count, 0)
+        for task in self.flush_taskqueue(config.INTERNAL_QUEUE):
+            if task['url'] == '/_ah/queue/deferred':
+                deferred.run(base64.b64decode(task['body']))
+        content = models.Content.get_by_id(content_id)
+        self.assertEqual(content.comment_count, 2)
+        self.assertGreater(content.sort_index, sort_index)
+
+    def test_comments_blocked(self):
+        result, status = self.post('/v42/content',
+                                   access_token=self.anna.create_access_token(),
+                                   duration='12345',
+                                   tags='reaction',
+                                   url='https://storage.googleapis.com/rcam/F3CBDwQ4gzX2UQlG4t57x')
+        self.assertValidResult(result, status, 200)
+        path = '/v51/content/%d/comments/' % (result['content']['id'],)
+        for account in (self.bob, self.cecilia):
+            result, status = self.put(path, access_token=account.create_access_token(),
+                                      text='Hi from %s' % (account.username,))
+            self.assertValidResult(result, status, 200)
+        self.dennis.block('bob')
+        # The cached comments are shared but filtered for every viewer.
+        for sort in ('created', 'created', 'threaded'):
+            result, status = self.get(path, sort=sort)
+            self.assertValidResult(result, status, 200)
+            self.assertEqual(len(result['data']), 2)
+            result, status = self.get(path, access_token=self.dennis.create_access_token(),
+                                      sort=sort)
+            self.assertValidResult(result, status, 200)
+            self.assertEqual([c['creator_id'] for c in result['data']], [self.cecilia.account_id])
+        # Unblocking clears the cached blocks of both accounts.
+        self.dennis.unblock('bob')
+        result, status = self.get(path, access_token=self.dennis.create_access_token(),
+                                  sort='created')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual(len(result['data']), 2)
+
+    def test_comments_blocked_immediately(self):
+        result, status = self.post('/v42/content',
+                                   access_token=self.anna.create_access_token(),
+                                   duration='12345',
+                                   tags='reaction',
+                                   url='https://storage.googleapis.com/rcam/F3CBDwQ4gzX2UQlG4t57x')
+        self.assertValidResult(result, status, 200)
+        path = '/v51/content/%d/comments/' % (result['content']['id'],)
+        for account in (self.bob, self.cecilia):
+            result, status = self.put(path, access_token=account.create_access_token(),
+                                      text='Hi from %s' % (account.username,))
+            self.assertValidResult(result, status, 200)
+        # Cache the (empty) blocks of the viewer.
+        result, status = self.get(path, access_token=self.dennis.create_access_token(),
+                                  sort='created')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual(len(result['data']), 2)
+        # Blocks apply right away even when queries don't see them yet.
+        self.policy.SetProbability(0)
+        self.dennis.block('bob')
+        result, status = self.get(path, access_token=self.dennis.create_access_token(),
+                                  sort='created')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual([c['creator_id'] for c in result['data']], [self.cecilia.account_id])
+        self.dennis.unblock('bob')
+        result, status = self.get(path, access_token=self.dennis.create_access_token(),
+                                  sort='created')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual(len(result['data']), 2)
+
+    def test_comments_threaded(self):
+        result, status = self.post('/v42/content',
+                                   access_token=self.anna.create_access_token(),
+                                   duration='12345',
+                                   tags='reaction',
+                                   url='https://storage.googleapis.com/rcam/F3CBDwQ4gzX2UQlG4t57x')
+        self.assertValidResult(result, status, 200)
+        path = '/v57/content/%d/comments/' % (result['content']['id'],)
+        result, status = self.put(path, access_token=self.bob.create_access_token(), text='A')
+        self.assertValidResult(result, status, 200)
+        root_id = result['id']
+        # Load (and cache) the threads before adding more comments.
+        result, status = self.get(path, sort='threaded')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual([c['text'] for c in result['data']], ['A'])
+        for text in ('A1', 'A2'):
+            result, status = self.put(path, access_token=self.cecilia.create_access_token(),
+                                      reply_to=root_id, text=text)
+            self.assertValidResult(result, status, 200)
+        result, status = self.put(path, access_token=self.dennis.create_access_token(), text='B')
+        self.assertValidResult(result, status, 200)
+        # New comments are added to the cached threads.
+        result, status = self.get(path, sort='threaded')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual([c['text'] for c in result['data']], ['B', 'A', 'A1', 'A2'])
+        self.assertEqual(result['data'][1]['reply_count'], 2)
+        self.assertIsNone(result['cursor'])
+        # The same threads are loaded from the datastore.
+        self.clear_memcache()
+        result, status = self.get(path, sort='threaded')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual([c['text'] for c in result['data']], ['B', 'A', 'A1', 'A2'])
+        # Replies can be paged separately.
+        result, status = self.get(path, sort='threaded', reply_to=root_id)
+        self.assertValidResult(result, status, 200)
+        self.assertEqual([c['text'] for c in result['data']], ['A1', 'A2'])
+
+    def test_comments_threaded_legacy(self):
+        result, status = self.post('/v42/content',
+                                   access_token=self.anna.create_access_token(),
+                                   duration='12345',
+                                   tags='reaction',
+                                   url='https://storage.googleapis.com/rcam/F3CBDwQ4gzX2UQlG4t57x')
+        self.assertValidResult(result, status, 200)
+        path = '/v51/content/%d/comments/' % (result['content']['id'],)
+        result, status = self.put(path, access_token=self.bob.create_access_token(), text='A')
+        self.assertValidResult(result, status, 200)
+        root_id = result['id']
+        for text in ('A1', 'A2'):
+            result, status = self.put(path, access_token=self.cecilia.create_access_token(),
+                                      reply_to=root_id, text=text)
+            self.assertValidResult(result, status, 200)
+        result, status = self.put(path, access_token=self.dennis.create_access_token(), text='B')
+        self.assertValidResult(result, status, 200)
+        # Older clients get all comments at once, without a cursor.
+        result, status = self.get(path, sort='threaded')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual([c['text'] for c in result['data']], ['B', 'A', 'A1', 'A2'])
+        self.assertNotIn('cursor', result)
+
+    def test_comments_threaded_stale_page(self):
+        result, status = self.post('/v42/content',
+                                   access_token=self.anna.create_access_token(),
+                                   duration='12345',
+                                   tags='reaction',
+                                   url='https://storage.googleapis.com/rcam/F3CBDwQ4gzX2UQlG4t57x')
+        self.assertValidResult(result, status, 200)
+        content_key = ndb.Key('Content', result['content']['id'])
+        path = '/v57/content/%d/comments/' % (content_key.id(),)
+        result, status = self.put(path, access_token=self.bob.create_access_token(), text='A')
+        self.assertValidResult(result, status, 200)
+        result, status = self.get(path, sort='threaded')
+        self.assertValidResult(result, status, 200)
+        cache_key = 'content_comment_threads_%d' % (content_key.id(),)
+        context = ndb.get_context()
+        stale_page = context.memcache_get(cache_key).get_result()
+        self.assertIsNotNone(stale_page)
+        result, status = self.put(path, access_token=self.cecilia.create_access_token(), text='B')
+        self.assertValidResult(result, status, 200)
+        # A slow reader that loaded the threads before the new comment caches them last.
+        context.memcache_set(cache_key, stale_page).get_result()
+        result, status = self.get(path, sort='threaded')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual([c['text'] for c in result['data']], ['B', 'A'])
+
     def test_create(self):
         result, status = self.post('/v42/content',
                                    access_token=self.anna.create_access_token(),
@@ -624,6 +821,10 @@ class Content(BaseTestCase):
         result, status = self.put('/v42/profile/me/following/dennis',
                                   access_token=self.bob.create_access_token())
         self.assertValidResult(result, status, 200)
+        # Recent content by the followed user is copied into the timeline by a job.
+        tasks = self.flush_taskqueue(config.INTERNAL_QUEUE)
+        self.assertTrue(any(t['url'] == '/_ah/jobs/timeline_follow' for t in tasks))
+        timelines.add_recent_content_async(self.bob.key, self.dennis.account).get_result()
         # Check first item in feed.
         result, status = self.get('/v42/profile/me/following/content/reaction/',
                                   access_token=self.bob.create_access_token())
@@ -645,6 +846,220 @@ class Content(BaseTestCase):
         self.assertEqual(len(result['data']), 2)
         self.assertEqual(result['data'][0]['content']['id'], content_id)
 
+    def test_get_subs_pages(self):
+        now = datetime.utcnow()
+        models.AccountFollow.follow_async(self.bob.key, [self.cecilia.key, self.dennis.key]).get_result()
+        content_list = []
+        for i, creator in enumerate([self.bob, self.cecilia, self.dennis] * 2):
+            content = models.Content.new(
+                created=now - timedelta(minutes=i),
+                creator=creator.key,
+                duration=12345,
+                tags=['reaction'],
+                video_url='https://www.example.com/%d.mp4' % (i,))
+            content.put()
+            content_list.append(content)
+            if creator is self.cecilia:
+                models.AccountTimelineEntry.add_async([self.bob.key], content).get_result()
+        # Dennis has so many followers that their content is only merged in when reading.
+        dennis = self.dennis.account
+        dennis.follower_count = config.TIMELINE_FANOUT_MAX_FOLLOWERS + 1
+        dennis.put()
+        # Page through the timeline.
+        content_ids = []
+        cursor = None
+        for _ in xrange(4):
+            result, status = self.get('/v42/profile/me/following/content/reaction/',
+                                      access_token=self.bob.create_access_token(),
+                                      cursor=cursor,
+                                      limit=4)
+            self.assertValidResult(result, status, 200)
+            content_ids.extend(item['content']['id'] for item in result['data'])
+            cursor = result['cursor']
+            if not cursor:
+                break
+        self.assertEqual(content_ids, [c.key.id() for c in content_list])
+        # Content that stops being public disappears from the timeline.
+        content_list[1].tags = ['deleted']
+        content_list[1].put()
+        result, status = self.get('/v42/profile/me/following/content/reaction/',
+                                  access_token=self.bob.create_access_token())
+        self.assertValidResult(result, status, 200)
+        self.assertNotIn(content_list[1].key.id(), [item['content']['id'] for item in result['data']])
+
+    def test_get_subs_former_large_creator(self):
+        models.AccountFollow.follow_async(self.bob.key, [self.dennis.key]).get_result()
+        dennis = self.dennis.account
+        dennis.follower_count = config.TIMELINE_FANOUT_MAX_FOLLOWERS + 1
+        dennis.put()
+        content = models.Content.new(
+            creator=self.dennis.key,
+            duration=12345,
+            tags=['reaction'],
+            video_url='https://www.example.com/large.mp4')
+        content.put()
+        # The content is not copied into timelines, which keeps the creator merged on read.
+        self.assertTrue(timelines.is_large_creator(dennis))
+        timelines.mark_large_creator_async(self.dennis.key).get_result()
+        # Losing followers should not make the content disappear from the timeline.
+        dennis = self.dennis.key.get()
+        dennis.follower_count = 1
+        dennis.put()
+        self.assertTrue(timelines.is_large_creator(dennis))
+        result, status = self.get('/v42/profile/me/following/content/reaction/',
+                                  access_token=self.bob.create_access_token())
+        self.assertValidResult(result, status, 200)
+        self.assertEqual([item['content']['id'] for item in result['data']], [content.key.id()])
+
+    def test_list_pages(self):
+        content_ids = set()
+        for i in xrange(5):
+            content = models.Content.new(
+                creator=self.bob.key,
+                duration=12345,
+                sort_bonus=1000 if i == 2 else 0,
+                tags=['vlog'],
+                video_url='https://www.example.com/%d.mp4' % (i,))
+            content.put()
+            content_ids.add(content.key.id())
+        # Page through content with mostly the same sort value.
+        seen_ids = []
+        cursors = []
+        cursor = None
+        for _ in xrange(5):
+            result, status = self.get('/v51/content/vlog/', cursor=cursor, limit=2, sort='top')
+            self.assertValidResult(result, status, 200)
+            seen_ids.extend(item['content']['id'] for item in result['data'])
+            cursor = result['cursor']
+            if not cursor:
+                break
+            cursors.append(cursor)
+        self.assertEqual(len(seen_ids), 5)
+        self.assertEqual(set(seen_ids), content_ids)
+        # The cursor only depends on the position in the list.
+        self.clear_memcache()
+        result, status = self.get('/v51/content/vlog/', limit=2, sort='top')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual(result['cursor'], cursors[0])
+
+    def test_list_blocked(self):
+        content_ids = {}
+        for account in (self.bob, self.cecilia):
+            content = models.Content.new(
+                creator=account.key,
+                duration=12345,
+                tags=['vlog'],
+                video_url='https://www.example.com/%s.mp4' % (account.username,))
+            content.put()
+            content_ids[account.username] = content.key.id()
+        self.dennis.block('bob')
+        # The cached pages are shared but filtered for every viewer.
+        for _ in xrange(2):
+            result, status = self.get('/v51/content/vlog/', sort='recent')
+            self.assertValidResult(result, status, 200)
+            self.assertEqual(len(result['data']), 2)
+            result, status = self.get('/v51/content/vlog/', sort='recent',
+                                      access_token=self.dennis.create_access_token())
+            self.assertValidResult(result, status, 200)
+            self.assertEqual([item['content']['id'] for item in result['data']],
+                             [content_ids['cecilia']])
+            self.assertFalse(result['data'][0]['voted'])
+        # The same applies to cached single content.
+        path = '/v51/content/%d' % (content_ids['bob'],)
+        result, status = self.get(path)
+        self.assertValidResult(result, status, 200)
+        result, status = self.get(path, access_token=self.dennis.create_access_token())
+        self.assertValidResult(result, status, 404)
+
+    def test_original_top_reactions(self):
+        original = models.Content.new(allow_restricted_tags=True,
+            created=datetime.utcnow(),
+            creator=self.anna.key,
+            original_url='https://www.youtube.com/watch?v=aBcDeF87',
+            related_count=4,
+            tags=['original'],
+            thumb_url='https://www.example.com/original.jpg',
+            title='The best song ever')
+        original.put()
+        reactions = []
+        creators = [self.bob, self.cecilia, self.bob, self.dennis]
+        for i, creator in enumerate(creators):
+            reaction = models.Content.new(
+                created=datetime.utcnow(),
+                creator=creator.key,
+                related_to=original.key,
+                sort_bonus=1000 - i,
+                tags=['reaction', 'repost'] if creator is self.dennis else ['reaction'],
+                video_url='https://www.example.com/%d.mp4' % (i,))
+            reaction.put()
+            reactions.append(reaction)
+        # Putting reactions schedules an update of the original's top reactions.
+        tasks = self.flush_taskqueue(config.INTERNAL_QUEUE)
+        self.assertTrue(any(t['name'].startswith('top-reactions-') for t in tasks))
+        original = models.Content.update_top_reactions(original.key)
+        self.assertEqual(original.top_reactions, [reactions[0].key, reactions[1].key])
+        # The page is built from the top reactions without querying for them.
+        result, status = self.get('/v51/original/', sort='top')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual(len(result['data']), 1)
+        related_ids = [r['id'] for r in result['data'][0]['related']]
+        self.assertEqual(related_ids, [reactions[0].key.id(), reactions[1].key.id()])
+        self.assertEqual(result['data'][0]['creator']['id'], self.anna.account_id)
+
+    def test_original_top_reactions_empty(self):
+        original = models.Content.new(allow_restricted_tags=True,
+            created=datetime.utcnow(),
+            creator=self.anna.key,
+            original_url='https://www.youtube.com/watch?v=aBcDeF88',
+            related_count=1,
+            tags=['original'],
+            thumb_url='https://www.example.com/original.jpg',
+            title='The second best song ever')
+        original.put()
+        reaction = models.Content.new(
+            created=datetime.utcnow(),
+            creator=self.bob.key,
+            related_to=original.key,
+            tags=['reaction', 'repost'],
+            video_url='https://www.example.com/repost.mp4')
+        reaction.put()
+        self.flush_taskqueue(config.INTERNAL_QUEUE)
+        # An original without eligible reactions still has a computed summary.
+        original = models.Content.update_top_reactions(original.key)
+        self.assertEqual(original.top_reactions, [])
+        self.assertIsNotNone(original.top_reactions_updated)
+        result, status = self.get('/v51/original/', sort='top')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual(result['data'][0]['related'], [])
+        # Reading the page does not queue any more updates.
+        tasks = self.flush_taskqueue(config.INTERNAL_QUEUE)
+        self.assertFalse(any(t['name'].startswith('top-reactions-') for t in tasks))
+
+    def test_rerank(self):
+        now = datetime.utcnow()
+        content_list = []
+        for days in (0, 2, 4):
+            content = models.Content.new(
+                created=now - timedelta(days=days),
+                creator=self.anna.key,
+                tags=['reaction'],
+                video_url='https://www.example.com/%d.mp4' % (days,))
+            content.add_sort_index_bonus(20000)
+            content.put()
+            content_list.append(content)
+        # Content that stops getting bonuses keeps decaying as it gets older.
+        later = now + timedelta(days=1)
+        ranks = models.Content.decay_sort_indexes(content_list, later)
+        for content, (sort_index, penalty) in zip(content_list, ranks):
+            self.assertLess(sort_index, content.sort_index)
+            self.assertEqual(sort_index + penalty, content.sort_base + content.sort_bonus)
+        # Only content that moved enough is written.
+        content = models.Content.rerank_async(content_list[0].key, now=later).get_result()
+        self.assertEqual(content.sort_index, ranks[0][0])
+        self.assertEqual(content.key.get().sort_bonus_penalty, ranks[0][1])
+        content = models.Content.rerank_async(content_list[0].key, now=later).get_result()
+        self.assertIsNone(content)
+
     def test_tag_internal(self):
         # Try an internal tag.
         result, status = self.post('/v42/content',
@@ -1025,6 +1440,27 @@ class PublicRequests(BaseTestCase):
                                    tags='approved,default')
         self.assertValidResult(result, status, 501)
 
+    def test_list_requests_by_reward(self):
+        requests = [self.create_public_request(add_reward=amount, approve=True)
+                    for amount in (100, 300, 200)]
+        # Wallet changes are copied onto the requests by deferred tasks.
+        for task in self.flush_taskqueue(config.INTERNAL_QUEUE):
+            if task['url'] == '/_ah/queue/deferred':
+                deferred.run(base64.b64decode(task['body']))
+        for r in requests:
+            self.assertTrue(r.key.get().has_reward)
+        result, status = self.get('/v54/requests/public/default/', sort='reward')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual([d['request']['reward'] for d in result['data']], [300, 200, 100])
+        self.assertEqual([d['request']['id'] for d in result['data']],
+                         [requests[i].key.id() for i in (1, 2, 0)])
+        result, status = self.get('/v54/requests/public/default/', sort='recent')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual([d['request']['id'] for d in result['data']],
+                         [r.key.id() for r in reversed(requests)])
+        result, status = self.get('/v54/requests/public/default/', sort='random')
+        self.assertValidResult(result, status, 400)
+
     def test_review_entry(self):
         # Create approved request with a reward pool.
         r = self.create_public_request(add_reward=100, approve=True)
@@ -1778,6 +2214,24 @@ class Profile(BaseTestCase):
                                   access_token=self.anna.create_access_token())
         self.assertEqual(len(result['data']), 1)
 
+    def test_chat_mentions(self):
+        result, status = self.post('/v51/profile/anna/chat/mentions',
+                                   access_token=self.bob.create_access_token(),
+                                   identifier='dennis',
+                                   text='@bob @cecilia @nobody check this out')
+        self.assertValidResult(result, status, 200)
+        # Recipients are resolved and notified by a job instead of the request.
+        tasks = self.flush_taskqueue(config.INTERNAL_QUEUE)
+        self.assertEqual([t['url'] for t in tasks], ['/_ah/jobs/chat_mentions'])
+        events = chat.resolve_mentions_async(self.bob.key, '@bob @cecilia @nobody hi',
+                                             ['dennis', 'cecilia']).get_result()
+        self.assertEqual(events, {self.cecilia.key: notifs.ON_CHAT_MENTION,
+                                  self.dennis.key: notifs.ON_CHAT_MESSAGE})
+        result, status = self.post('/v51/profile/nobody/chat/mentions',
+                                   access_token=self.bob.create_access_token(),
+                                   text='@cecilia hi')
+        self.assertValidResult(result, status, 400)
+
     def test_can_see_own_active(self):
         result, status = self.get('/v30/profile/me',
                                   access_token=self.anna.create_access_token())
@@ -2045,6 +2499,24 @@ class Profile(BaseTestCase):
         self.assertValidResult(result, status, 200)
         self.assertItemsEqual([old_username, '+12345322', new_username], result['identifiers'])
 
+    def test_resolve_keys(self):
+        participant = models.Participant(account=self.cecilia.key)
+        keys = models.Account.resolve_keys([self.anna.key, self.bob.account, participant,
+                                            self.dennis.account_id, 'bob', 'cecilia'])
+        self.assertEqual(keys, {self.anna.key, self.bob.key, self.cecilia.key, self.dennis.key})
+        with self.assertRaises(ValueError):
+            models.Account.resolve_keys(['bob', 'nobody'])
+        account_list = models.Account.resolve_list(['anna', self.bob.account, self.cecilia.key])
+        self.assertEqual([a.key for a in account_list],
+                         [self.anna.key, self.bob.key, self.cecilia.key])
+        from roger.apps import api
+        with api.app.test_request_context():
+            self.assertEqual(models.Account.resolve_keys(['bob']), {self.bob.key})
+            # Identifiers that change during the request are looked up again.
+            self.bob.change_identifier('bob', 'bobby')
+            self.assertIsNone(models.Account.resolve_key('bob'))
+            self.assertEqual(models.Account.resolve_keys(['bobby']), {self.bob.key})
+
     def test_update_username(self):
         new_username = 'annayolo'
         result, status = self.post('/v30/profile/me', username=new_username,
@@ -2233,6 +2705,38 @@ class Threads(BaseTestCase):
         self.assertValidResult(result, status, 200)
         self.assertEqual(result['data'][0]['id'], thread_id)
 
+    def test_message_pages(self):
+        result, status = self.put('/v51/threads/', identifier='bob',
+                                  access_token=self.anna.create_access_token())
+        self.assertValidResult(result, status, 200)
+        thread_id = result['id']
+        for i in xrange(12):
+            result, status = self.post('/v51/threads/%s/messages/' % (thread_id,),
+                                       access_token=self.anna.create_access_token(),
+                                       type='text', text='Message %d' % (i,))
+            self.assertValidResult(result, status, 200)
+        # Page through the messages twice (the second time pages come from cache).
+        for _ in xrange(2):
+            texts = []
+            cursor = None
+            while True:
+                params = {'limit': 5}
+                if cursor:
+                    params['cursor'] = cursor
+                result, status = self.get('/v51/threads/%s/messages/' % (thread_id,),
+                                          access_token=self.bob.create_access_token(),
+                                          **params)
+                self.assertValidResult(result, status, 200)
+                self.assertLessEqual(len(result['data']), 5)
+                texts += [m['text'] for m in result['data']]
+                cursor = result['cursor']
+                if not cursor:
+                    break
+            self.assertEqual(texts, ['Message %d' % (i,) for i in xrange(11, -1, -1)])
+        # The next pages are prefetched in the background.
+        tasks = self.flush_taskqueue(config.INTERNAL_QUEUE)
+        self.assertTrue(any(t['url'] == '/_ah/jobs/prefetch_thread_messages' for t in tasks))
+
     def test_seen_until(self):
         result, status = self.put('/v50/threads/', identifier='bob',
                                   access_token=self.anna.create_access_token())
@@ -2256,6 +2760,98 @@ class Threads(BaseTestCase):
                                    seen_until=message['id'])
         self.assertValidResult(result, status, 200)
         self.assertEqual(result['seen_until'], message['id'])
+        # Anna should see that Bob has seen the message.
+        result, status = self.get('/v50/threads/%s/' % (thread_id,),
+                                  access_token=self.anna.create_access_token())
+        self.assertValidResult(result, status, 200)
+        self.assertEqual(result['others'][0]['seen_until'], message['id'])
+        # The thread list shows the same.
+        result, status = self.get('/v50/threads/', access_token=self.anna.create_access_token())
+        self.assertValidResult(result, status, 200)
+        self.assertEqual([t['id'] for t in result['data']], [thread_id])
+        self.assertEqual(result['data'][0]['others'][0]['seen_until'], message['id'])
+
+    def test_visibility(self):
+        result, status = self.put('/v51/threads/', identifier='bob',
+                                  access_token=self.anna.create_access_token())
+        self.assertValidResult(result, status, 200)
+        thread_id = result['id']
+        # Threads without messages are not listed.
+        result, status = self.get('/v51/threads/', access_token=self.anna.create_access_token())
+        self.assertValidResult(result, status, 200)
+        self.assertEqual(result['data'], [])
+        result, status = self.post('/v51/threads/%s/messages/' % (thread_id,),
+                                   access_token=self.anna.create_access_token(),
+                                   type='text', text='Hello world!')
+        self.assertValidResult(result, status, 200)
+        # Bob hides the thread.
+        result, status = self.post('/v51/threads/%s/' % (thread_id,),
+                                   access_token=self.bob.create_access_token(),
+                                   visible='false')
+        self.assertValidResult(result, status, 200)
+        result, status = self.get('/v51/threads/', access_token=self.bob.create_access_token())
+        self.assertValidResult(result, status, 200)
+        self.assertEqual(result['data'], [])
+        # Anna still sees it.
+        result, status = self.get('/v51/threads/', access_token=self.anna.create_access_token())
+        self.assertValidResult(result, status, 200)
+        self.assertEqual([t['id'] for t in result['data']], [thread_id])
+        # A new message makes it visible to Bob again.
+        result, status = self.post('/v51/threads/%s/messages/' % (thread_id,),
+                                   access_token=self.anna.create_access_token(),
+                                   type='text', text='Are you there?')
+        self.assertValidResult(result, status, 200)
+        result, status = self.get('/v51/threads/', access_token=self.bob.create_access_token())
+        self.assertValidResult(result, status, 200)
+        self.assertEqual([t['id'] for t in result['data']], [thread_id])
+        self.assertEqual(result['data'][0]['messages'][0]['text'], 'Are you there?')
+
+
+class TopAccounts(BaseTestCase):
+    @mock.patch('roger.apps.utils.bigquery_client')
+    def test_missing_snapshot(self, bigquery_mock):
+        bigquery_mock.query.return_value.rows.return_value = [
+            mock.Mock(account_id=str(self.cecilia.account_id), score='7')]
+        result, status = self.get('/v51/top/accounts/votes', tag='Funny')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual(result['data'], [])
+        # The request only schedules the query, once per window.
+        self.assertFalse(bigquery_mock.query.called)
+        result, status = self.get('/v51/top/accounts/votes', tag='Funny')
+        self.assertValidResult(result, status, 200)
+        tasks = self.flush_taskqueue(config.INTERNAL_QUEUE)
+        self.assertEqual([t['url'] for t in tasks], ['/_ah/cron/update_top_accounts'])
+        utils.update_top_accounts_snapshot('votes', 'funny', requested=True)
+        result, status = self.get('/v51/top/accounts/votes', tag='Funny')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual(len(result['data']), 1)
+        self.assertEqual(result['data'][0]['account']['id'], self.cecilia.account_id)
+        self.assertEqual(result['data'][0]['score'], 7)
+        snapshot = models.TopAccountsSnapshot.make_key('votes', 'funny').get()
+        self.assertTrue(snapshot.is_current)
+        self.assertIsNotNone(snapshot.requested)
+        self.assertEqual(snapshot.rows, [[self.cecilia.account_id, 7]])
+
+    @mock.patch('roger.apps.utils.bigquery_client')
+    def test_snapshot(self, bigquery_mock):
+        ts_min, ts_max = models.TopAccountsSnapshot.current_window()
+        snapshot = models.TopAccountsSnapshot(
+            key=models.TopAccountsSnapshot.make_key('votes'),
+            category='votes',
+            rows=[[self.bob.account_id, 5], [self.anna.account_id, 3]],
+            ts_max=ts_max,
+            ts_min=ts_min)
+        snapshot.put()
+        result, status = self.get('/v51/top/accounts/votes')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual([(r['account']['id'], r['score']) for r in result['data']],
+                         [(self.bob.account_id, 5), (self.anna.account_id, 3)])
+        # The next request is served from the cache.
+        snapshot.key.delete()
+        result, status = self.get('/v51/top/accounts/votes')
+        self.assertValidResult(result, status, 200)
+        self.assertEqual(len(result['data']), 2)
+        self.assertFalse(bigquery_mock.query.called)
 
 
 class Wallet(BaseTestCase):
@@ -2270,6 +2866,20 @@ class Wallet(BaseTestCase):
         # Validate balance in returned wallet.
         self.assertEqual(result['wallet']['balance'], 18)
 
+    def test_batch_transfer_full_size(self):
+        pool = models.Wallet.create_internal(self.bob.key, 'test_pool', 1000, 'Pool')
+        transfers = []
+        for i in xrange(models.Wallet.MAX_BATCH_SIZE):
+            payee = accounts.create('payee%d' % (i,), status='active')
+            payee.account.get_balances_async().get_result()
+            wallet_key = models.Wallet.key_from_id('account_%d' % (payee.account_id,))
+            transfers.append((wallet_key, 10, u'Payment (thanks)'))
+        tx = models.Wallet.create_batch_tx(self.bob.key, pool.key, transfers)
+        w1, results = tx().get_result()
+        self.assertEqual(w1.balance, 1000 - 10 * len(transfers))
+        self.assertTrue(all(results))
+        self.assertEqual(models.WalletPayment.query().count(), len(transfers))
+
     @mock.patch('roger.apps.api.apple')
     def test_purchase(self, apple_mock):
         apple_mock.itunes.return_value = {
@@ -2335,6 +2945,21 @@ class Wallet(BaseTestCase):
         # Validate balance in returned wallet.
         self.assertEqual(result['wallet']['balance'], 75)
 
+    def test_reward_full_batch(self):
+        pool = models.Wallet.create_internal(self.bob.key, 'test_rewards', 1000, 'Rewards')
+        request_key = ndb.Key('ContentRequestPublic', 1)
+        entries = []
+        for i in xrange(models.ContentRequestPublicEntry.REWARD_BATCH_SIZE):
+            creator = accounts.create('creator%d' % (i,), status='active')
+            creator.account.get_balances_async().get_result()
+            entry_key = models.ContentRequestPublicEntry.resolve_key(request_key, creator.key)
+            models.ContentRequestPublicEntry(key=entry_key, account=creator.key,
+                                             request=request_key, status='active').put()
+            entries.append((entry_key, models.Content(id=i + 1, youtube_views=100)))
+        amounts = models.ContentRequestPublicEntry.reward_multi(entries, self.bob.key, pool.key)
+        self.assertEqual(amounts, [100] * len(entries))
+        self.assertEqual(models.WalletPayment.query().count(), len(entries))
+
     def test_unlock(self):
         # Give Anna some currency.
         models.Wallet.create_and_transfer(self.anna.key, self.anna.wallet, 'a01', 5, 'Test')
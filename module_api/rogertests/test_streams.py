@@ -2,7 +2,9 @@ import unittest
 
 from google.appengine.ext import db
 
-from roger import accounts, streams
+import mock
+
+from roger import accounts, models, streams
 import rogertests
 
 
@@ -172,6 +174,47 @@ class Streams(BaseTestCase):
         self.assertFalse(stream.is_played)
         self.assertEqual(stream.chunks[-1].payload, 'dennis2.mp3')
 
+    def test_shared_accounts(self):
+        self.bob.streams.send(['anna'], 'bob1.mp3', 1000)
+        self.cecilia.streams.send(['anna', 'bob'], 'cecilia1.mp3', 1000)
+        recents, _ = self.anna.streams.get_recent()
+        self.assertEqual(len(recents), 2)
+        # Streams on the same page should share account instances instead of loading them.
+        accounts_1 = {a.key: a.account for a in recents[0].get_accounts()}
+        accounts_2 = {a.key: a.account for a in recents[1].get_accounts()}
+        self.assertIs(accounts_1[self.anna.account.key], accounts_2[self.anna.account.key])
+        self.assertIs(accounts_1[self.bob.account.key], accounts_2[self.bob.account.key])
+        self.assertIs(recents[0].account, recents[1].account)
+
+    def test_unplayed_count(self):
+        self.assertEqual(self.cecilia.streams.get_unplayed_count(), 0)
+        self.dennis.streams.send(['cecilia'], 'dennis1.mp3', 1000)
+        self.bob.streams.send(['cecilia'], 'bob1.mp3', 1000)
+        # The count is calculated once, then kept up to date as streams change.
+        self.assertEqual(self.cecilia.streams.get_unplayed_count(), 2)
+        self.anna.streams.send(['cecilia'], 'anna1.mp3', 1000)
+        self.assertEqual(self.cecilia.streams.get_unplayed_count(), 3)
+        recents, _ = self.cecilia.streams.get_recent()
+        recents[0].set_played_until(recents[0].last_chunk_end)
+        self.assertEqual(self.cecilia.streams.get_unplayed_count(), 2)
+        recents[1].hide()
+        self.assertEqual(self.cecilia.streams.get_unplayed_count(), 1)
+        # Senders don't have any unplayed streams.
+        self.assertEqual(self.dennis.streams.get_unplayed_count(), 0)
+        # The cached count should match a fresh count.
+        self.clear_memcache()
+        self.assertEqual(self.cecilia.streams.get_unplayed_count(), 1)
+
+    def test_unplayed_count_stale_index(self):
+        self.dennis.streams.send(['cecilia'], 'dennis1.mp3', 1000)
+        self.assertEqual(self.cecilia.streams.get_unplayed_count(), 1)
+        self.clear_memcache()
+        # A stream that changes while the count is calculated may be missing from the index.
+        self.bob.streams.send(['cecilia'], 'bob1.mp3', 1000)
+        with mock.patch.object(models.Stream, 'query') as query_mock:
+            query_mock.return_value.fetch.return_value = []
+            self.assertEqual(self.cecilia.streams.get_unplayed_count(), 1)
+
     def test_receiving_change_status(self):
         cecilia = self.cecilia
         self.assertEqual(cecilia.account.status, 'active')
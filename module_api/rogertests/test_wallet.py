@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from roger import accounts, models
+from roger import accounts, ledger, models
 from roger_common import errors
 import rogertests
 
@@ -57,6 +57,28 @@ class Wallet(BaseTestCase):
         self.assertEqual(wallet.total_received, 100)
         self.assertEqual(wallet.total_sent, 0)
 
+    def test_batch_transfer(self):
+        bob = accounts.create('bob', status='active')
+        _, bob_wallet = models.Wallet.create_async(bob.key).get_result()
+        mint_wallet = models.Wallet.create_internal(self.bank.key, 'batch_wallet', 100, 'Batch')
+        transfers = [(self.anna_wallet_key, 60, u'Anna'), (bob_wallet.key, 60, u'Bob')]
+        # Ensure that the full batch cannot be paid.
+        tx = models.Wallet.create_batch_tx(self.bank.key, mint_wallet.key, transfers)
+        with self.assertRaises(models.WalletInsufficientFunds):
+            tx().get_result()
+        # Pay as much as possible in order instead.
+        tx = models.Wallet.create_batch_tx(self.bank.key, mint_wallet.key, transfers,
+                                           require_full_amount=False)
+        w1, results = tx().get_result()
+        self.assertEqual(w1.balance, 0)
+        self.assertEqual([r[2].delta for r in results], [60, 40])
+        self.assertEqual(self.anna_wallet_key.get().balance, 60)
+        self.assertEqual(bob_wallet.key.get().balance, 40)
+        # The source transactions should form a chain ending in the wallet.
+        tx1_a, tx1_b = results[0][0], results[1][0]
+        self.assertEqual(tx1_b.old_balance, tx1_a.new_balance)
+        self.assertEqual(w1.last_tx, tx1_b.key.id())
+
     def test_transfer(self):
         _, tx = self.mint_and_create_tx(100, self.anna_wallet_key, 13, 'Testing 13')
         # Execute transaction to transfer some coins and verify end result.
@@ -66,6 +88,17 @@ class Wallet(BaseTestCase):
         self.assertEqual(w2.balance, 13)
         self.assertEqual(tx2.delta, 13)
 
+    def test_transfer_payment_feed(self):
+        _, tx = self.mint_and_create_tx(100, self.anna_wallet_key, 13, 'Payment (Thanks!)')
+        _, _, _, tx2 = tx().get_result()
+        # The transfer should have been added to the public payment feed.
+        payments = models.WalletPayment.latest_query().fetch()
+        self.assertEqual(len(payments), 1)
+        self.assertEqual(payments[0].amount, 13)
+        self.assertEqual(payments[0].comment, 'Thanks!')
+        self.assertEqual(payments[0].receiver, self.anna.key)
+        self.assertEqual(payments[0].tx, tx2.key)
+
     def test_transfer_double(self):
         mint_wallet, tx = self.mint_and_create_tx(100, self.anna_wallet_key, 13, 'Testing 13')
         tx().get_result()
@@ -83,3 +116,37 @@ class Wallet(BaseTestCase):
         # Check wallets to ensure they haven't changed.
         self.assertEqual(mint_wallet.key.get().balance, 100)
         self.assertEqual(self.anna_wallet_key.get().balance, 0)
+
+
+class Ledger(BaseTestCase):
+    def test_audit(self):
+        for amount in (10, 20, 30):
+            _, tx = self.mint_and_create_tx(100, self.anna_wallet_key, amount, 'Testing')
+            tx().get_result()
+        state, done, problems = ledger.audit(self.anna_wallet_key)
+        self.assertTrue(done)
+        self.assertEqual(problems, [])
+        self.assertEqual(state.balance, 60)
+        self.assertEqual(state.tx_count, 3)
+
+    def test_audit_resumes_from_checkpoint(self):
+        for amount in (10, 20, 30):
+            _, tx = self.mint_and_create_tx(100, self.anna_wallet_key, amount, 'Testing')
+            tx().get_result()
+        state, done, problems = ledger.audit(self.anna_wallet_key, limit=2)
+        self.assertFalse(done)
+        self.assertEqual(state.tx_count, 2)
+        checkpoint = models.WalletCheckpoint.latest(self.anna_wallet_key)
+        self.assertEqual(checkpoint.balance, 30)
+        state, done, problems = ledger.audit(self.anna_wallet_key)
+        self.assertTrue(done)
+        self.assertEqual(problems, [])
+        self.assertEqual(state.tx_count, 3)
+
+    def test_audit_tampered(self):
+        _, tx = self.mint_and_create_tx(100, self.anna_wallet_key, 13, 'Testing')
+        _, _, _, tx2 = tx().get_result()
+        tx2.new_balance = 1000
+        tx2.put()
+        _, _, problems = ledger.audit(self.anna_wallet_key)
+        self.assertTrue(problems)
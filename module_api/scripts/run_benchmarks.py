@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+#
+# Run the API benchmarks by running this in a terminal:
+# python -m scripts.run_benchmarks
+#
+# Store the current results as the new baseline by running this:
+# python -m scripts.run_benchmarks --update-baseline
+
+import logging
+import os
+import os.path
+import sys
+import unittest
+
+import scripts
+
+
+class RunBenchmarks(scripts.ScriptBase):
+    def before_setup(self):
+        # Add `lib` subdirectory to `sys.path` for third-party libraries.
+        lib_path = os.path.join(os.path.dirname(__file__), '../lib')
+        sys.path.insert(0, lib_path)
+
+    def main(self):
+        # Turn off warnings.
+        logging.disable(logging.WARNING)
+
+        argv = [sys.argv[0]]
+        for arg in self.args:
+            if arg == '--update-baseline':
+                os.environ['ROGER_BENCHMARK_UPDATE'] = '1'
+            else:
+                argv.append(arg)
+
+        try:
+            unittest.main('rogertests.benchmarks', argv=argv)
+        except KeyboardInterrupt:
+            print 'Interrupted.'
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    RunBenchmarks().run()